@@ -28,3 +28,11 @@ class ExecutorCheckError(NoticeError):
 
 class LockConflictError(RollbackError):
     pass
+
+
+class TupleCodecError(RollbackError):
+    pass
+
+
+class FileReadError(RollbackError):
+    pass
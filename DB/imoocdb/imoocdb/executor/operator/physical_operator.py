@@ -1,3 +1,4 @@
+import itertools
 import os
 import pickle
 import time
@@ -10,21 +11,27 @@ from imoocdb.constant import TEMP_DIRECTORY
 from imoocdb.errors import ExecutorCheckError, RollbackError
 from imoocdb.session_manager import get_current_session_id
 from imoocdb.sql.logical_operator import *
-from imoocdb.sql.utils import table_exists, column_exists
+from imoocdb.sql.utils import table_exists, column_exists, index_exists
 from imoocdb.sql.parser.ast import JoinType, CreateTable, CreateIndex
-from imoocdb.storage.entry import (table_tuple_get_all,
-                                   table_tuple_insert_one,
+from imoocdb.storage.entry import (table_tuple_scan,
+                                   table_tuple_insert_many,
                                    covered_index_tuple_get_range,
                                    covered_index_tuple_get_equal_value,
                                    index_tuple_insert_one,
                                    index_tuple_delete_one,
                                    index_tuple_update_one,
                                    index_tuple_get_equal_value_locations, index_tuple_get_range_locations,
-                                   table_tuple_get_one, table_tuple_get_all_locations, table_tuple_update_one,
-                                   table_tuple_delete_multiple, index_tuple_create)
+                                   table_tuple_get_one, table_tuple_update_one,
+                                   table_tuple_delete_multiple, index_tuple_create,
+                                   table_tuple_reorganize)
 from imoocdb.storage.lock.lock import lock_manager
 from imoocdb.storage.transaction.entry import checkpoint, transaction_mgr
 
+# 手动执行 VACUUM 时加锁使用的 xid. VACUUM 不在事务中执行，session 中的 xid
+# 可能是 INVALID_XID 或者上一个已经结束的事务，要区别于它们以及后台线程的 xid.
+# 从 -4 开始往下分配，每次 VACUUM 都不同，否则并发的 VACUUM 会被当作同一个锁的持有者
+vacuum_xids = itertools.count(-4, -1)
+
 
 def is_condition_true(values: dict, condition):
     left = condition.left if not isinstance(condition.left, TableColumn) else \
@@ -114,6 +121,8 @@ class TableScan(PhysicalOperator):
         self.table_name = table_name
         self.condition = condition
         self.columns = None
+        # 正在进行的扫描，扫描过程中当前的数据页是被 pin 住的
+        self.scans = []
 
     def open(self):
         # 表采集到的 columns 要跟这个采集到的 tuple 元素下标一一对应上
@@ -126,13 +135,28 @@ class TableScan(PhysicalOperator):
         lock_manager.acquire_lock(('table', self.table_name), xid, 's')
 
     def close(self):
+        # 上层算子没有把扫描遍历完 (例如 LIMIT), 也要释放数据页上的 pin
+        for scan in self.scans:
+            scan.close()
+        self.scans.clear()
         xid = transaction_mgr.session_xid()
         lock_manager.release_lock(('table', self.table_name), xid)
 
     def next(self):
-        for tup in table_tuple_get_all(self.table_name):
+        for _, tup in self.scan():
+            yield tup
+
+    def next_location(self):
+        for location, _ in self.scan():
+            yield location
+
+    def scan(self):
+        """按页批量扫描，返回满足条件的 (location, tuple) 二元组"""
+        scan = table_tuple_scan(self.table_name)
+        self.scans.append(scan)
+        for location, tup in scan:
             if not self.condition:
-                yield tup
+                yield location, tup
             else:
                 # 案例：
                 # 表结构 t1 (id, name)
@@ -142,17 +166,7 @@ class TableScan(PhysicalOperator):
                 # values = {k: tup[i] for i, k in enumerate(self.columns)}, 等价于
                 values = cast_tuple_pair_to_values(self.columns, tup)
                 if is_condition_true(values, self.condition):
-                    yield tup
-
-    def next_location(self):
-        for location in table_tuple_get_all_locations(self.table_name):
-            tup = table_tuple_get_one(self.table_name, location)
-            if not self.condition:
-                yield location
-            else:
-                values = cast_tuple_pair_to_values(self.columns, tup)
-                if is_condition_true(values, self.condition):
-                    yield location
+                    yield location, tup
 
 
 class IndexScan(PhysicalOperator):
@@ -739,19 +753,19 @@ class PhysicalInsert(PhysicalOperator):
         return tuple(full_tuple)
 
     def next(self):
-        for tup in self.logical_operator.values:
-            # 更新基础数据表
-            try:
-                location = table_tuple_insert_one(
-                    self.logical_operator.table_name, self._pad_null(
-                        tup, self.column_ids, self.table_column_num
-                    )
-                )
-            except Exception as e:
-                # 出现问题了，要回滚！
-                raise RollbackError(
-                    f'cannot insert data into the table {self.logical_operator.table_name}.'
-                )
+        # 更新基础数据表，多行数据一次性批量插入
+        try:
+            locations = table_tuple_insert_many(
+                self.logical_operator.table_name,
+                [self._pad_null(tup, self.column_ids, self.table_column_num)
+                 for tup in self.logical_operator.values]
+            )
+        except Exception as e:
+            # 出现问题了，要回滚！
+            raise RollbackError(
+                f'cannot insert data into the table {self.logical_operator.table_name}.'
+            )
+        for tup, location in zip(self.logical_operator.values, locations):
             # 同步更新所有涉及到的索引
             # insert into t1 (id) values ...; 补充null的场景
             # insert into t1 values ...;
@@ -956,6 +970,10 @@ class PhysicalDDL(PhysicalOperator):
             table_name = self.ast.table.parts
             if not table_exists(table_name):
                 raise ExecutorCheckError(f'not found the table {table_name}.')
+            # 表和索引的数据页在 buffer pool 中都是以 (名字, pageno) 作为 key 的，
+            # 所以，索引不能与已有的表或者索引重名
+            if table_exists(index_name) or index_exists(index_name):
+                raise ExecutorCheckError(f'relation {index_name} already exists.')
 
             columns = []
             for column in self.ast.columns:
@@ -1004,10 +1022,40 @@ class CommandOperator(PhysicalOperator):
     def close(self):
         pass
 
+    @staticmethod
+    def vacuum(table_name):
+        # 整理过程会移动元组、修改索引，所以要对表和索引都加排他锁
+        xid = next(vacuum_xids)
+        index_names = [r.index_name for r in catalog_index.select(
+            lambda r: r.table_name == table_name)]
+        # 只释放真正加上了的锁
+        locked = []
+        try:
+            for resource in ([('table', table_name)] +
+                             [('index', index_name) for index_name in index_names]):
+                lock_manager.acquire_lock(resource, xid, 'x')
+                locked.append(resource)
+            table_tuple_reorganize(table_name)
+        finally:
+            for resource in reversed(locked):
+                lock_manager.release_lock(resource, xid)
+
     def next(self):
         if self.command == 'CHECKPOINT':
             checkpoint()
             yield
+        elif self.command == 'VACUUM':
+            if self.args:
+                table_names = self.args
+            else:
+                # 不指定表名，则整理所有的表
+                table_names = [r.table_name for r in catalog_table.select(lambda r: True)]
+            for table_name in table_names:
+                if not table_exists(table_name):
+                    raise ExecutorCheckError(f'not found the table {table_name}.')
+            for table_name in table_names:
+                self.vacuum(table_name)
+            yield
         elif self.command == 'SHOW':
             if self.args[0] == 'variables':
                 rows = [
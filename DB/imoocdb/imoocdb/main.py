@@ -13,6 +13,8 @@ from imoocdb.sql.optimizier.planner import query_plan
 from imoocdb.executor import exec_plan, Result
 from imoocdb.errors import RollbackError, NoticeError
 from imoocdb.storage.transaction.entry import transaction_mgr
+from imoocdb.storage.autovacuum import start_autovacuum
+from imoocdb.storage.bgwriter import start_bgwriter
 from network.pg_protocol import PGHandler, Int8Field, TextField, start_server
 from session_manager import set_session_parameter, get_session_parameter
 import instr
@@ -35,6 +37,8 @@ def init_database(path=DEFAULT_WORKING_DIRECTORY):
     init_database_working_directory(path)
     init_catalog()
     transaction_mgr.recovery()
+    start_autovacuum()
+    start_bgwriter()
 
 
 def exec_imoocdb_query(query_string, notice_client=notice_client_terminal) -> Result:
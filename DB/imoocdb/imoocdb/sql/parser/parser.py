@@ -39,7 +39,7 @@ class SQLLexer(sly.Lexer):
         INTEGER, QUOTE_STRING, DQUOTE_STRING, NULL,
 
         # command
-        CHECKPOINT, SHOW
+        CHECKPOINT, SHOW, VACUUM
     }
 
     CREATE = 'CREATE'
@@ -79,6 +79,7 @@ class SQLLexer(sly.Lexer):
     # command
     CHECKPOINT = 'CHECKPOINT'
     SHOW = 'SHOW'
+    VACUUM = 'VACUUM'
 
     # punctuation
     DOT = r'\.'
@@ -131,6 +132,8 @@ class SQLParser(sly.Parser):
 
     # command 解析
     @_('CHECKPOINT',
+       'VACUUM',
+       'VACUUM expr_list',
        'SHOW expr_list')
     def command(self, p):
         if len(p) > 1:
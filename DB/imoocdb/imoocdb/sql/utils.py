@@ -1,4 +1,4 @@
-from imoocdb.catalog import catalog_table, catalog_function
+from imoocdb.catalog import catalog_table, catalog_index, catalog_function
 
 
 # 可以用于判断表或者列是否存在，用于检验输入SQL语句的合法性
@@ -7,6 +7,10 @@ def table_exists(table_name):
     return bool(catalog_table.select(lambda r: r.table_name == table_name))
 
 
+def index_exists(index_name):
+    return bool(catalog_index.select(lambda r: r.index_name == index_name))
+
+
 def column_exists(table_name, column_name):
     tables = catalog_table.select(lambda r: r.table_name == table_name)
     if len(tables) == 1 and column_name in tables[0].columns:
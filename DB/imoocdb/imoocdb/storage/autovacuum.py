@@ -0,0 +1,83 @@
+import logging
+import threading
+
+from imoocdb.catalog.entry import catalog_table, catalog_index
+from imoocdb.storage.entry import table_tuple_reorganize
+from imoocdb.storage.lock.lock import lock_manager
+from imoocdb.storage.stat import relation_stat_mgr
+
+# 下述参数参考了 Postgres 中 autovacuum 的相关参数
+AUTOVACUUM = True
+# 两次检查之间的间隔, unit: second
+AUTOVACUUM_NAPTIME = 1
+# 死元组数量超过该值，就触发整理
+AUTOVACUUM_VACUUM_THRESHOLD = 50
+# 被更新的元组数量超过该值，就触发整理
+AUTOVACUUM_UPDATE_THRESHOLD = 100
+# autovacuum 加锁时使用的 xid, 要区别于普通事务以及 INVALID_XID
+AUTOVACUUM_XID = -2
+
+
+class AutoVacuumWorker(threading.Thread):
+    def __init__(self, naptime=AUTOVACUUM_NAPTIME):
+        super().__init__(name='autovacuum', daemon=True)
+        self.naptime = naptime
+        self.stop_event = threading.Event()
+
+    def run(self):
+        while not self.stop_event.wait(self.naptime):
+            try:
+                self.run_once()
+            except Exception as e:
+                # 后台线程不能因为一次失败就退出
+                logging.exception(e)
+
+    def stop(self):
+        self.stop_event.set()
+
+    @staticmethod
+    def need_vacuum(table_name):
+        dead_tuples, updated_tuples, _ = relation_stat_mgr.get(table_name)
+        return (dead_tuples >= AUTOVACUUM_VACUUM_THRESHOLD or
+                updated_tuples >= AUTOVACUUM_UPDATE_THRESHOLD)
+
+    def run_once(self):
+        for table_name in relation_stat_mgr.relations():
+            if not catalog_table.select(lambda r: r.table_name == table_name):
+                continue
+            if self.need_vacuum(table_name):
+                self.vacuum_table(table_name)
+
+    @staticmethod
+    def vacuum_table(table_name):
+        index_names = [r.index_name for r in catalog_index.select(
+            lambda r: r.table_name == table_name)]
+        _, _, pagenos = relation_stat_mgr.get(table_name)
+        # 与手动执行 VACUUM 不同，这里每次只对一个数据页加锁并整理，
+        # 避免长时间阻塞前台的查询
+        for pageno in pagenos:
+            locked = []
+            try:
+                for resource in ([('table', table_name)] +
+                                 [('index', index_name) for index_name in index_names]):
+                    # 前台正在使用这张表，跳过，下一轮再来，不能让前台等待 autovacuum
+                    if not lock_manager.try_acquire_lock(resource, AUTOVACUUM_XID, 'x'):
+                        return
+                    locked.append(resource)
+                table_tuple_reorganize(table_name, [pageno])
+            finally:
+                for resource in locked:
+                    lock_manager.release_lock(resource, AUTOVACUUM_XID)
+
+
+autovacuum_worker = None
+
+
+def start_autovacuum():
+    global autovacuum_worker
+    if not AUTOVACUUM:
+        return
+    if autovacuum_worker is not None and autovacuum_worker.is_alive():
+        return
+    autovacuum_worker = AutoVacuumWorker()
+    autovacuum_worker.start()
@@ -0,0 +1,124 @@
+import logging
+import threading
+
+from imoocdb.storage.common import sync_table_pages
+from imoocdb.storage.lock.lock import lock_manager
+from imoocdb.storage.lru import buffer_pool
+from imoocdb.storage.relation import relation_cache
+from imoocdb.storage.stat import relation_stat_mgr
+from imoocdb.storage.transaction.entry import transaction_mgr
+
+# 下述参数参考了 Postgres 中 background writer 的相关参数
+BGWRITER = True
+# 两轮之间的间隔, unit: second
+BGWRITER_DELAY = 0.2
+# 每一轮最多写出的数据页数量
+BGWRITER_LRU_MAXPAGES = 100
+# 每一轮检查 LRU 尾部 (即将被淘汰) 的数据页数量
+BGWRITER_LRU_SCAN = 32
+# 脏页比例超过该值时，不只是 LRU 尾部，其他的脏页也会被写出
+BGWRITER_DIRTY_RATIO = 0.5
+# bgwriter 加锁时使用的 xid, 要区别于普通事务、INVALID_XID 以及 autovacuum
+BGWRITER_XID = -3
+
+
+class BackgroundWriter(threading.Thread):
+    """在两次 checkpoint 之间，提前把脏页写到磁盘上.
+    这样，数据页被淘汰时大多已经是干净的了，checkpoint 要做的事情也会少很多"""
+
+    def __init__(self, delay=BGWRITER_DELAY, max_pages=BGWRITER_LRU_MAXPAGES,
+                 lru_scan=BGWRITER_LRU_SCAN, dirty_ratio=BGWRITER_DIRTY_RATIO):
+        super().__init__(name='bgwriter', daemon=True)
+        self.delay = delay
+        self.max_pages = max_pages
+        self.lru_scan = lru_scan
+        self.dirty_ratio = dirty_ratio
+        self.stop_event = threading.Event()
+
+    def run(self):
+        while not self.stop_event.wait(self.delay):
+            try:
+                self.run_once()
+            except Exception as e:
+                # 后台线程不能因为一次失败就退出
+                logging.exception(e)
+
+    def stop(self):
+        self.stop_event.set()
+
+    def collect_candidates(self):
+        dirty_pages = buffer_pool.dirty_pages
+        # LRU 尾部即将被淘汰的脏页最优先写出，这样前台淘汰时就不需要写磁盘了
+        candidates = [key for key in buffer_pool.tail_keys(self.lru_scan)
+                      if key in dirty_pages]
+        if buffer_pool.dirty_ratio() > self.dirty_ratio:
+            candidates += sorted(dirty_pages)
+        # 去重，同时保持优先级顺序
+        return list(dict.fromkeys(candidates))[:self.max_pages]
+
+    def run_once(self):
+        """返回写出的数据页数量"""
+        written = 0
+        # tail_keys() 要获取分区锁，必须在 flush_mutex 之外收集候选数据页,
+        # 否则与持有分区锁、再获取 flush_mutex 的淘汰过程互相等待.
+        # 拿到 flush_mutex 之后，write_relation() 会再检查一次是否仍然是脏页
+        relation_pagenos = {}
+        for relation, pageno in self.collect_candidates():
+            relation_pagenos.setdefault(relation, []).append(pageno)
+        with buffer_pool.flush_mutex:
+            for relation, pagenos in relation_pagenos.items():
+                written += self.write_relation(relation, pagenos)
+        return written
+
+    @staticmethod
+    def write_relation(relation, pagenos):
+        # 索引的修改 (如分裂、VACUUM 修正 location) 加的是索引锁，不是表锁
+        descriptor = relation_cache.get(relation)
+        resource = (descriptor.kind, relation)
+        # 前台正在修改这张表 (或者索引)，跳过，下一轮再来，不能让前台等待 bgwriter
+        if not lock_manager.try_acquire_lock(resource, BGWRITER_XID, 's'):
+            return 0
+        images = []
+        pages = {}
+        try:
+            active_xids = set(transaction_mgr.undo_mgr.active_transactions)
+            flush_lsn = transaction_mgr.redo_mgr.flush_lsn
+            for pageno in pagenos:
+                key = (relation, pageno)
+                page = buffer_pool.peek(key)
+                if not buffer_pool.is_dirty(key) or page is None:
+                    continue
+                # 被还没有结束的事务修改过的数据页先不写出，因为这些事务的
+                # undo log 可能还没有落盘，崩溃之后就没有办法回滚了
+                if relation_stat_mgr.is_page_busy(relation, pageno, active_xids):
+                    continue
+                # WAL: 修改该数据页的 redo log 必须先落盘
+                if page.page_header.lsn > flush_lsn:
+                    continue
+                images.append((pageno, page.serialize()))
+                pages[pageno] = page, page.page_header.lsn
+        finally:
+            lock_manager.release_lock(resource, BGWRITER_XID)
+
+        # 写完之前不能清除脏页标记，否则这期间数据页被当作干净页淘汰掉，
+        # 再读上来的就是磁盘上的旧数据了
+        written = sync_table_pages(descriptor, images)
+        for pageno, (page, lsn) in pages.items():
+            key = (relation, pageno)
+            # 写出之后又被修改过 (或者被替换掉) 的数据页，仍然是脏页
+            if buffer_pool.peek(key) is page and page.page_header.lsn == lsn:
+                buffer_pool.unmark_dirty(key)
+        return written
+
+
+bgwriter = None
+
+
+def start_bgwriter():
+    global bgwriter
+    if not BGWRITER:
+        return
+    if bgwriter is not None and bgwriter.is_alive():
+        return
+    bgwriter = BackgroundWriter()
+    bgwriter.start()
@@ -1,32 +1,61 @@
+import bisect
 import pickle
 import os
 import math
 
 from imoocdb.errors import BPlusTreeError
-from imoocdb.storage.slotted_page import Page, LITTLE_ORDER, PAGE_SIZE
+from imoocdb.storage.fd import fd_mgr
+from imoocdb.storage.lru import buffer_pool
+from imoocdb.storage.relation import RelationDescriptor, relation_cache
+from imoocdb.storage.slotted_page import Page, PageHeader, Slot, LITTLE_ORDER, PAGE_SIZE
+
+# 索引页 page_header.flags 中的标志位
+PAGE_FLAG_LEAF = 1
+# key 是 BPlusTreeTuple 时，索引页中只保存其中的 tup, 加载时再包装回来，
+# 这样每一条记录中就不需要重复保存类名了
+PAGE_FLAG_TUPLE_KEYS = 2
+# 被合并掉的节点的数据页，放在空闲页链表中等待 allocate_node() 复用,
+# 此时 page_header.reserved 中存放的是链表中下一个空闲页的 pageno
+PAGE_FLAG_FREE = 4
+# 空闲页链表的结尾 (与 next_leaf 一样，用一个不合法的 pageno 表示)
+FREE_LIST_END = 0xffffffff
+# 一个节点序列化之后，最多能够占用的字节数 (records + slot 目录)
+NODE_CAPACITY = PAGE_SIZE - 1 - PageHeader.size()
+# 与 Postgres 一样，单个索引项不能超过数据页的 1/3, 这样分裂之后的两个节点都不会是空的
+MAX_ENTRY_SIZE = NODE_CAPACITY // 3
+# 节点的填充率 (百分比). 向最右边的叶子节点中顺序插入 (例如自增的 id, 或者
+# 创建索引时按照表的顺序插入) 而分裂时，左边的节点保留这么多的数据，
+# 而不是对半分，留出的空间给之后的插入，避免马上又要分裂
+BPLUS_TREE_FILLFACTOR = 90
+# 删除之后，节点占用的空间低于该比例 (百分比) 时，与相邻的兄弟节点合并，
+# 合并之后放不下的话，就在两个节点之间重新分配元素. 比分裂之后的 50% 低很多，
+# 避免在同一个位置反复插入、删除时，节点不停地分裂、合并
+BPLUS_TREE_MERGE_THRESHOLD = 25
+
+
+def _sort_key(tup):
+    """把元组转换为可以直接比较的形式：None 比任何值都小.
+    这样，比较两个元组时只需要一次 C 层面的 tuple 比较，不需要逐列调用 _cmp()"""
+    # 单列索引是最常见的情况，不需要生成器
+    if len(tup) == 1:
+        v = tup[0]
+        return (v is not None, v),
+    return tuple((v is not None, v) for v in tup)
 
 
 class BPlusTreeTuple:
     def __init__(self, tup):
         assert isinstance(tup, tuple)
         self.tup = tup
+        self.sort_key = _sort_key(tup)
 
-    @staticmethod
-    def _cmp(a, b):
-        # a - b
-        if a is None and b is None:
-            return 0
-        if a is None:
-            return -1
-        if b is None:
-            return 1
-
-        if a == b:
-            return 0
-        elif a < b:
-            return -1
-        else:
-            return 1
+    def __reduce__(self):
+        # sort_key 可以从 tup 中计算出来，不需要序列化到索引页中
+        return BPlusTreeTuple, (self.tup,)
+
+    def __setstate__(self, state):
+        # 兼容之前序列化的索引页，那时只保存了 tup
+        self.__init__(state['tup'])
 
     def __repr__(self):
         return str(self.tup)
@@ -40,60 +69,51 @@ class BPlusTreeTuple:
             return False
         return self.tup == tup
 
-    def __lt__(self, other):
-        # self < other, less than
+    def _other_sort_key(self, other):
         if isinstance(other, BPlusTreeTuple):
-            tup = other.tup
+            return other.sort_key
         elif isinstance(other, tuple):
-            tup = other
+            assert len(self.tup) == len(other)
+            return _sort_key(other)
+        return None
+
+    def __lt__(self, other):
+        # self < other, less than
+        sort_key = self._other_sort_key(other)
+        if sort_key is not None:
+            return self.sort_key < sort_key
         elif isinstance(other, float):
             # 不能直接 float('inf') == float('inf')
             if math.inf == other:
                 return True
             elif - math.inf == other:
                 return False
-            else:
-                raise
-        else:
-            raise
-
-        assert len(self.tup) == len(tup)
-
-        for i in range(len(self.tup)):
-            r = self._cmp(self.tup[i], tup[i])
-            if r == 0:
-                continue
-            elif r < 0:
-                return True
-            elif r > 0:
-                return False
-
-        # 兜底的，但是不太可能会跑到着
-        return False
+        raise BPlusTreeError(f'cannot compare {self} with {other}')
 
     def __le__(self, other):
-        if self == other:
-            return True
+        sort_key = self._other_sort_key(other)
+        if sort_key is not None:
+            return self.sort_key <= sort_key
         return self < other
 
     def __ge__(self, other):
         # >=
         # not <
-        if self == other:
-            return True
+        sort_key = self._other_sort_key(other)
+        if sort_key is not None:
+            return self.sort_key >= sort_key
         return not self < other
 
     def __gt__(self, other):
         # self > other
         # >
         # not <=
-        if self == other:
-            return False
+        sort_key = self._other_sort_key(other)
+        if sort_key is not None:
+            return self.sort_key > sort_key
         return not self < other
 
 
-# todo: 把这个node可以序列化为slotted page的字节集 bytes
-# todo: LSN的实现 -> 被修改的节点，需要显性标记一下LSN号
 class BPlusTreeNode:
     def __init__(self, is_leaf=True):
         self.is_leaf = is_leaf
@@ -108,7 +128,14 @@ class BPlusTreeNode:
         self.pageno = 0xffffffff  # 给一个初始值，不合法的值
 
         self.next_leaf = None
+        # 被修改过的节点，需要显性标记一下LSN号, 写出的时候只写出被修改过的节点
         self.lsn = 0
+        self.dirty = False
+        # 序列化之后占用的字节数，None 表示还没有计算，见 size
+        self.nbytes = None
+        # 被合并掉之后放入空闲页链表的节点，next_free 是链表中的下一个空闲页
+        self.free = False
+        self.next_free = FREE_LIST_END
 
     def get_child(self, i):
         # keys ->          [1, 3, 5]
@@ -122,57 +149,117 @@ class BPlusTreeNode:
             return len(self.children) + 1
         return len(self.children)
 
-    def to_page(self):
-        # 也就是序列化过程的一部分，因为Page本身自带序列化的方法
-        page = Page()
-        page.page_header.flags = 1 if self.is_leaf else 0
-        # page.page_header.lsn = self.lsn
+    @property
+    def tuple_keys(self):
+        return bool(self.keys) and type(self.keys[0]) is BPlusTreeTuple
+
+    @staticmethod
+    def encode_entry(k, v):
+        if type(k) is BPlusTreeTuple:
+            k = k.tup
+        return pickle.dumps((k, v))
 
+    def records(self):
+        """节点中的每一项序列化之后的 record, 与数据页中的 record 一一对应"""
         if self.is_leaf:
-            page.page_header.reserved = self.next_leaf.pageno if self.next_leaf else 0xffffffff
             for k, v in zip(self.keys, self.values):
-                page.insert(pickle.dumps((k, v)))
+                yield self.encode_entry(k, v)
         else:
             for i in range(len(self.keys)):
-                k = self.keys[i]
-                v = self.children[i].pageno
-                page.insert(pickle.dumps((k, v)))
+                yield self.encode_entry(self.keys[i], self.children[i].pageno)
             # 打补丁，因为 children 是空隙，应该是 keys + 1
             if len(self.children) > len(self.keys):
-                v = self.children[-1].pageno
-                page.insert(pickle.dumps((None, v)))
+                yield pickle.dumps((None, self.children[-1].pageno))
+
+    @property
+    def size(self):
+        """序列化之后占用的字节数. 插入、删除叶子节点中的一项时增量地维护，
+        其他修改 (例如分裂) 之后置为 None, 用到的时候再重新计算"""
+        if self.nbytes is None:
+            self.nbytes = sum(len(record) + Slot.size() for record in self.records())
+        return self.nbytes
+
+    def to_page(self):
+        # 也就是序列化过程的一部分，因为Page本身自带序列化的方法
+        page = Page()
+        if self.free:
+            page.page_header.flags = PAGE_FLAG_FREE
+            page.page_header.reserved = self.next_free
+            page.set_header(self.lsn)
+            return page
+
+        flags = PAGE_FLAG_LEAF if self.is_leaf else 0
+        if self.tuple_keys:
+            flags |= PAGE_FLAG_TUPLE_KEYS
+        page.page_header.flags = flags
+
+        if self.is_leaf:
+            page.page_header.reserved = self.next_leaf.pageno if self.next_leaf else 0xffffffff
+        for record in self.records():
+            page.insert(record)
 
         page.set_header(self.lsn)
+        # 刚刚序列化的内容就是解析的结果，之后再从 buffer pool 中取到该页时不需要再反序列化
+        if self.is_leaf:
+            page.decoded = (True, tuple(self.keys), tuple(self.values),
+                            self.next_leaf.pageno if self.next_leaf else None,
+                            page.total_record_size + page.total_slot_directory_size)
+        else:
+            page.decoded = (False, tuple(self.keys), tuple(child.pageno for child in self.children),
+                            None, page.total_record_size + page.total_slot_directory_size)
         return page
 
+    @staticmethod
+    def decode_page(page):
+        """反序列化索引页，返回 (is_leaf, keys, 叶子节点的 values 或者内部节点的 children pageno,
+        next_leaf 的 pageno, nbytes). 结果缓存在 page.decoded 中，索引页每次修改都会
+        换成一个新的 Page 对象，所以 buffer pool 命中时可以直接使用"""
+        if page.decoded is not None:
+            return page.decoded
+        is_leaf = bool(page.page_header.flags & PAGE_FLAG_LEAF)
+        tuple_keys = bool(page.page_header.flags & PAGE_FLAG_TUPLE_KEYS)
+        keys = []
+        values = []
+        next_leaf = None
+        if is_leaf and page.page_header.reserved < 0xffffffff:
+            next_leaf = page.page_header.reserved
+        # pickle 可以直接从 memoryview 中反序列化，不需要先拷贝
+        for _, view in page.iter_record_views():
+            k, v = pickle.loads(view)
+            # 内部节点最后一个 child 的 key 是 None
+            if k is not None or is_leaf:
+                if tuple_keys:
+                    k = BPlusTreeTuple(k)
+                keys.append(k)
+            values.append(v)
+        # 索引页是由 to_page() 一次性生成的，没有被删除的 record
+        nbytes = page.total_record_size + page.total_slot_directory_size
+        page.decoded = (is_leaf, tuple(keys), tuple(values), next_leaf, nbytes)
+        return page.decoded
+
     def from_page(self, page):
         # 用来把 page 中的数据，反解析一下（反序列化），用于赋值到
         # 当前的 node 上
         self.loaded = True
-        self.is_leaf = page.page_header.flags == 1
         self.lsn = page.page_header.lsn
-
+        if page.page_header.flags & PAGE_FLAG_FREE:
+            self.free = True
+            self.next_free = page.page_header.reserved
+            self.nbytes = 0
+            return
+        self.is_leaf, keys, values, next_leaf, self.nbytes = self.decode_page(page)
+        # 节点会被修改，不能直接使用缓存中的对象
+        self.keys = list(keys)
         if self.is_leaf:
-            if page.page_header.reserved < 0xffffffff:
+            self.values = list(values)
+            if next_leaf is not None:
                 self.next_leaf = BPlusTreeNode()
-                self.next_leaf.pageno = page.page_header.reserved
-
-            for sid in range(len(page.slot_directory)):
-                k, v = pickle.loads(page.select(sid))
-                self.keys.append(k)
-                self.values.append(v)
+                self.next_leaf.pageno = next_leaf
         else:
-            for sid in range(len(page.slot_directory)):
-                k, v = pickle.loads(page.select(sid))
-                if k is None:
-                    node = BPlusTreeNode()
-                    node.pageno = v
-                    self.children.append(node)
-                else:
-                    self.keys.append(k)
-                    node = BPlusTreeNode()
-                    node.pageno = v
-                    self.children.append(node)
+            for pageno in values:
+                node = BPlusTreeNode()
+                node.pageno = pageno
+                self.children.append(node)
 
     def __eq__(self, other):
         if not isinstance(other, BPlusTreeNode):
@@ -184,25 +271,57 @@ class BPlusTreeNode:
 
 
 HEADER_SIZE = 8  # 64bit int
+# 文件头的低 32 位是根节点的 pageno, 高 32 位是空闲页链表中第一个 pageno + 1.
+# 之前版本的文件头中只有根节点的 pageno, 高 32 位都是 0, 正好表示没有空闲页.
+# 两者放在同一个 8 字节的文件头中，一次 pwrite 就可以原子地同时切换
+ROOT_PAGENO_MASK = 0xffffffff
+
+
+def pack_header(root_pageno, free_pageno):
+    free = 0 if free_pageno == FREE_LIST_END else free_pageno + 1
+    return int.to_bytes(free << 32 | root_pageno, HEADER_SIZE, LITTLE_ORDER, signed=False)
+
+
+def unpack_header(buff):
+    header = int.from_bytes(buff, LITTLE_ORDER)
+    free = header >> 32
+    return header & ROOT_PAGENO_MASK, free - 1 if free else FREE_LIST_END
 
 
 def load_page_from_disk(filename, pageno):
-    with open(filename, 'rb') as f:
-        f.seek(HEADER_SIZE + pageno * PAGE_SIZE)
-        # 标志着读的数据是 [pageno, pageno + 1)
-        buff = f.read(PAGE_SIZE)
-        page = Page.deserialize(buff)
-    return page
+    # 标志着读的数据是 [pageno, pageno + 1)
+    buff = fd_mgr.read(filename, HEADER_SIZE + pageno * PAGE_SIZE, PAGE_SIZE)
+    return Page.deserialize(buff)
+
+
+def load_index_page(relation: RelationDescriptor, pageno):
+    """通过 buffer pool 加载索引页，key 是 (索引名, pageno), 与表的数据页一样
+    参与淘汰、脏页写回以及 checkpoint"""
+    return buffer_pool.get_or_load(
+        (relation.relation, pageno),
+        lambda: load_page_from_disk(relation.filename, pageno)
+    )
 
 
-def load_root_node(filename):
+def load_header(filename):
+    """返回 (根节点的 pageno, 空闲页链表中第一个 pageno)"""
     if not os.path.exists(filename):
         raise BPlusTreeError(f'not found the file {filename}.')
-    with open(filename, 'rb') as f:
-        buff = f.read(HEADER_SIZE)
-        root_node_pageno = int.from_bytes(buff, LITTLE_ORDER)
-        assert root_node_pageno >= 0
-    page = load_page_from_disk(filename, root_node_pageno)
+    buff = fd_mgr.read(filename, 0, HEADER_SIZE)
+    return unpack_header(buff)
+
+
+def load_root_node(filename, relation: RelationDescriptor = None):
+    """relation 不为空时，根节点的 pageno 缓存在 relation 中，
+    索引页也通过 buffer pool 加载，重复的查询不需要再读文件"""
+    if relation is None:
+        root_node_pageno, _ = load_header(filename)
+        page = load_page_from_disk(filename, root_node_pageno)
+    else:
+        if relation.root_pageno is None:
+            relation.root_pageno, relation.free_pageno = load_header(relation.filename)
+        root_node_pageno = relation.root_pageno
+        page = load_index_page(relation, root_node_pageno)
     node = BPlusTreeNode()
     node.from_page(page)
     # 下面这个字段，很容易遗忘！
@@ -219,47 +338,192 @@ def count_pages(filename):
 
 
 class BPlusTree:
-    def __init__(self, filename=None, root_node=None):
+    def __init__(self, filename=None, root_node=None, relation: RelationDescriptor = None):
+        # relation 不为空时，索引页通过 buffer pool 读写，见 load_index_page()
+        self.relation = relation
+        # pageno -> 已经加载到内存中的节点. 父节点的 children 以及 next_leaf
+        # 中存放的可能只是占位用的节点，通过该字典，保证同一个 pageno 只对应
+        # 一个节点对象，否则对节点的修改可能会丢失
+        self.nodes = {}
         if root_node is None:
             # 是一个新的b+树，也就是create index 过程
-            self.node_count = 0
+            self.node_count = relation.pages if relation else 0
+            self.free_pageno = FREE_LIST_END
             self.root = self.allocate_node(is_leaf=True)
+            # 文件头中记录的 (根节点, 空闲页链表), 变化之后才需要重写文件头
+            self.persisted_header = None
         else:
             # 由于走到这个分支的b+树，不是新的b+树，因此，我们
             # 需要从磁盘里的文件大小进行计算
             self.root = root_node
-            self.node_count = count_pages(filename)
+            self.nodes[root_node.pageno] = root_node
+            if relation is not None:
+                self.node_count = relation.pages
+                self.free_pageno = relation.free_pageno
+            else:
+                self.node_count = count_pages(filename)
+                _, self.free_pageno = load_header(filename)
+            self.persisted_header = (root_node.pageno, self.free_pageno)
 
         self.filename = filename
 
     def allocate_node(self, is_leaf):
         node = BPlusTreeNode(is_leaf)
-        node.pageno = self.node_count
+        if self.free_pageno != FREE_LIST_END:
+            # 优先复用空闲页链表中的数据页，不需要扩展索引文件
+            free_node = BPlusTreeNode()
+            free_node.pageno = self.free_pageno
+            free_node = self.load_node(free_node)
+            assert free_node.free
+            node.pageno = free_node.pageno
+            self.free_pageno = free_node.next_free
+        else:
+            node.pageno = self.node_count
+            self.node_count += 1
+            if self.relation is not None:
+                relation_cache.extend(self.relation.relation, node.pageno)
         node.loaded = True
-        self.node_count += 1
+        node.dirty = True
+        self.nodes[node.pageno] = node
         return node
 
+    def free_node(self, node):
+        """节点被合并掉之后，把它的数据页放到空闲页链表的头部"""
+        node.free = True
+        node.next_free = self.free_pageno
+        node.keys = []
+        node.children = []
+        node.values = []
+        node.next_leaf = None
+        node.nbytes = None
+        node.dirty = True
+        self.free_pageno = node.pageno
+
     def insert(self, key, value):
         if key is None:
             raise BPlusTreeError('invalid key')
 
+        entry_size = len(BPlusTreeNode.encode_entry(key, value)) + Slot.size()
+        if entry_size > MAX_ENTRY_SIZE:
+            raise BPlusTreeError(f'index entry size {entry_size} exceeds maximum {MAX_ENTRY_SIZE}.')
+
         # 直接插入叶子节点中
-        node = self.find_leaf_node(key)
+        path = []
+        node = self._find_insert_leaf(key, path)
         # 正因为，调用了下面的函数，我们可以保证，插入过程是
         # 有序的，因为该函数，寻找的是最右边的相同的key的下标，
         # 如果没有找到 0
         index = self._find_rightmost_key_index(node, key)
+        size = node.size
         node.keys.insert(index, key)
         node.values.insert(index, value)
+        node.nbytes = size + entry_size
+        node.dirty = True
 
         # 分裂，也就是不断递归，向父节点插入元素的过程
         if self._need_split(node):
-            self._split(node)
+            # 插入到了最右边的叶子节点的末尾，多半是顺序插入
+            rightmost = node.next_leaf is None and index == len(node.keys) - 1
+            self._split(node, path, rightmost)
+
+    def bulk_load(self, items, fillfactor=BPLUS_TREE_FILLFACTOR):
+        """从已经按照 key 排好序的 (key, value) 中自底向上地构建B+树，只能用于新的B+树.
+        每个节点按照 fillfactor 装满之后再开始下一个节点，不需要逐个插入、分裂"""
+        assert len(self.nodes) == 1 and not self.root.keys
+        target = NODE_CAPACITY * fillfactor // 100
+
+        # 先构建叶子节点，同时记录每个节点中最小的 key, 作为它在父节点中的分隔 key
+        leaf = self.root
+        leaf.nbytes = 0
+        level = [(leaf.keys, leaf)]
+        for key, value in items:
+            entry_size = len(leaf.encode_entry(key, value)) + Slot.size()
+            if entry_size > MAX_ENTRY_SIZE:
+                raise BPlusTreeError(f'index entry size {entry_size} exceeds maximum {MAX_ENTRY_SIZE}.')
+            if leaf.keys and leaf.nbytes + entry_size > target:
+                new_leaf = self.allocate_node(is_leaf=True)
+                new_leaf.nbytes = 0
+                leaf.next_leaf = new_leaf
+                leaf = new_leaf
+                level.append((leaf.keys, leaf))
+            leaf.keys.append(key)
+            leaf.values.append(value)
+            leaf.nbytes += entry_size
+        level = [(keys[0] if keys else None, node) for keys, node in level]
+
+        # 再逐层构建内部节点，直到只剩下一个根节点
+        while len(level) > 1:
+            groups = [[]]
+            total = 0
+            for min_key, child in level:
+                entry_size = len(BPlusTreeNode.encode_entry(min_key, child.pageno)) + Slot.size()
+                if len(groups[-1]) > 1 and total + entry_size > target:
+                    groups.append([])
+                    total = 0
+                groups[-1].append((min_key, child))
+                total += entry_size
+            # 最后一个节点只有一个子节点时，放得下的话，合并到前一个节点中
+            if len(groups) > 1 and len(groups[-1]) == 1 and \
+                    total + sum(len(BPlusTreeNode.encode_entry(k, c.pageno)) + Slot.size()
+                                for k, c in groups[-2]) <= NODE_CAPACITY:
+                groups[-2].extend(groups.pop())
+
+            level = []
+            for group in groups:
+                node = self.allocate_node(is_leaf=False)
+                # 与分裂时一样：keys 是除了第一个子节点之外，每个子节点中最小的 key
+                node.keys.extend(min_key for min_key, _ in group[1:])
+                node.children.extend(child for _, child in group)
+                level.append((group[0][0], node))
+        self.root = level[0][1]
+
+    @staticmethod
+    def _split_index(node, rightmost):
+        """按照序列化之后的大小 (而不是元素的个数) 选择分裂的位置"""
+        sizes = [len(record) + Slot.size() for record in node.records()]
+        if rightmost:
+            target = NODE_CAPACITY * BPLUS_TREE_FILLFACTOR // 100
+        else:
+            target = sum(sizes) // 2
+        total = 0
+        for i in range(len(node.keys)):
+            total += sizes[i]
+            if total > target:
+                break
+        # 两边都至少要有一个元素. 内部节点中间的 key 要上移到父节点中，
+        # 右边的节点也要留下至少一个 key
+        return min(max(i, 1), len(node.keys) - (1 if node.is_leaf else 2))
 
-    def _split(self, node):
-        """用于调整B+树的结构，用于做节点的分裂"""
-        middle_index = len(node.keys) // 2
-        # 把当前的 node 节点，拆分成相等元素的两个节点
+    @staticmethod
+    def _divide(node, right_node, middle_index):
+        """把 node 中从 middle_index 开始的元素移动到 right_node 中，
+        返回放到父节点中的分隔 key, 即 right_node 中最小的 key"""
+        if node.is_leaf:
+            separator = node.keys[middle_index]
+            right_node.keys = node.keys[middle_index:]
+            right_node.values = node.values[middle_index:]
+            right_node.next_leaf = node.next_leaf
+            node.keys = node.keys[:middle_index]
+            node.values = node.values[:middle_index]
+            node.next_leaf = right_node
+        else:
+            # 内部节点中 keys[i] 是 children[i + 1] 的下界，所以中间的 key 不留在
+            # 任何一边，而是上移到父节点中，作为 right_node 第一个子节点的下界
+            separator = node.keys[middle_index]
+            right_node.keys = node.keys[middle_index + 1:]
+            right_node.children = node.children[middle_index + 1:]
+            node.keys = node.keys[:middle_index]
+            node.children = node.children[:middle_index + 1]
+        for n in (node, right_node):
+            n.dirty = True
+            n.nbytes = None
+        return separator
+
+    def _split(self, node, path, rightmost=False):
+        """用于调整B+树的结构，用于做节点的分裂.
+        path 是从根节点到 node 的父节点的路径，见 find_leaf_node()"""
+        middle_index = self._split_index(node, rightmost and node.is_leaf)
+        # 把当前的 node 节点，拆分成大小相等的两个节点
         # 这块在工程上可能有不同的发挥和改良
         right_node = self.allocate_node(is_leaf=node.is_leaf)
         left_node = node
@@ -268,39 +532,32 @@ class BPlusTree:
         # 新节点就是右节点，原来的旧节点就是左节点
         # 我们这里面之所以复用原来的节点，是因为传入的参数是一个引用（指针）
         # 如果直接用新的节点进行替换，出现找不到节点的问题
-        right_node.keys.extend(node.keys[middle_index:])
-        right_node.children.extend(node.children[middle_index:])
-        right_node.values.extend(node.values[middle_index:])
-        right_node.next_leaf = node.next_leaf
-
-        left_node.keys = node.keys[:middle_index]
-        left_node.children = node.children[:middle_index]
-        left_node.values = node.values[:middle_index]
-        left_node.next_leaf = right_node
+        separator = self._divide(left_node, right_node, middle_index)
 
         assert len(left_node.keys) > 0 and len(right_node.keys) > 0
-        assert tuple(left_node.keys) < tuple(right_node.keys)
+        assert left_node.keys[-1] <= separator <= right_node.keys[0]
 
         if node is self.root:
             new_root = self.allocate_node(is_leaf=False)
-            new_root.keys.append(right_node.keys[0])
+            new_root.keys.append(separator)
             new_root.children.extend([left_node, right_node])
             self.root = new_root
         else:
-            parent = self._find_parent(self.root, node)
-            index = parent.children.index(node)
-            parent.keys.insert(index, right_node.keys[0])
+            parent, index = path.pop()
+            assert parent.children[index] == node
+            parent.keys.insert(index, separator)
             # parent.children[index] = left_node
             parent.children.insert(index + 1, right_node)
+            parent.dirty = True
+            parent.nbytes = None
 
             if self._need_split(parent):
-                self._split(parent)
+                self._split(parent, path)
 
     @staticmethod
     def _need_split(node):
-        # 这里是随便写的，意思是，B+树节点中的元素数量，如果大于这个值
-        # 那么就分裂
-        return len(node.keys) > 10
+        # 节点序列化之后放不进一个数据页了，就要分裂
+        return node.size > NODE_CAPACITY
 
     @staticmethod
     def _find_rightmost_key_index(node, key):
@@ -309,72 +566,133 @@ class BPlusTree:
         #            /    |   |      \         \
         #  [ -1, 0 ]     [2] [7]   [11, 15, 99] [101]   -> children
 
-        # 寻找小于等于key的最大下标 i
-        i = 0
-        while i < len(node.keys):
-            if node.keys[i] <= key:
-                i += 1
-            else:
-                return i
-        return i
+        # 寻找第一个大于 key 的下标 i (upper bound), 即相同的 key 中最右边的
+        # 那一个的后面. node.keys 是有序的，所以可以直接二分查找
+        return bisect.bisect_right(node.keys, key)
 
     @staticmethod
     def _find_leftmost_key_index(node, key):
-        # 寻找 key <= node.keys 中最小值时的下标 i
-        # 他有更高效实现方法：
-        # 二分查找，但是二分查找，不能解决相同元素的情况，例如：
+        # 寻找 key <= node.keys[i] 的最小下标 i (lower bound).
+        # 存在相同元素时，返回的是最左边的那一个，例如 key 为 2 时：
         # 元素值   [1,2,2,2,3,3,4,5,6]
         # 元素下标 [0,1,2,3,4,5,6,7,8]
-        # leetcode 的算法题：寻找二分搜索的最大/小值
-        i = 0
-        while i < len(node.keys):
-            if key <= node.keys[i]:
-                return i
-            i += 1
-        return len(node.keys)
-
-    def _find_parent(self, current, target):
-        if current.is_leaf or target in current.children:
-            return current
-
-        for child in current.children:
-            if target in child.children:
-                return self._find_parent(child, target)
-        return None
+        # 返回 1. bisect_left 正是这样的二分查找
+        return bisect.bisect_left(node.keys, key)
 
     def delete(self, key, value=None):
-        node = self.find_leaf_node(key)
+        key = self._search_key(key)
+        path = []
+        node = self.find_leaf_node(key, path=path)
         while node:
-            indexes = list(self._find_indexes(node.keys, key))
-            if len(indexes) == 0:
+            indexes = self._find_indexes(node.keys, key)
+            if len(indexes) == 0 and node.keys:
                 break
-            # 如何去解决删除一个元素后，对应的下标移位的问题
-            i = 0
-            deleted_count = 0
-            while i < len(indexes):
-                index = indexes[i]
-                actual_index = index - deleted_count
+            # 从后往前删除，这样删除一个元素之后，前面元素的下标不会移位
+            deleted = False
+            for index in reversed(indexes):
                 # 跳过 value 不等于参数的 key
-                if value is not None:
-                    if node.values[actual_index] != value:
-                        i += 1
-                        continue
-                node.keys.pop(actual_index)
-                node.values.pop(actual_index)
-                i += 1
-                deleted_count += 1
+                if value is not None and node.values[index] != value:
+                    continue
+                k = node.keys.pop(index)
+                v = node.values.pop(index)
+                if node.nbytes is not None:
+                    node.nbytes -= len(node.encode_entry(k, v)) + Slot.size()
+                node.dirty = True
+                deleted = True
+
+            # 节点中剩下的元素太少了 (包括之前的版本遗留下来的空叶子节点),
+            # 与兄弟节点合并或者重新分配. 树的结构发生变化之后，path 就失效了，
+            # 重新从根节点开始查找，已经被删除的元素不会再被找到
+            if (deleted or not node.keys) and self._need_merge(node) and \
+                    self._rebalance(node, path):
+                path = []
+                node = self.find_leaf_node(key, path=path)
+                continue
 
-            node = node.next_leaf
-            node = self.load_node(node)
-        # 准确来说，此时还应该补充一个合并机制(coalesce)，即把小于 n/2 的
-        # node进行合并
+            if node.next_leaf is None:
+                break
+            node = self.load_node(node.next_leaf)
+            self._move_path_right(path)
+
+    @staticmethod
+    def _need_merge(node):
+        return node.size < NODE_CAPACITY * BPLUS_TREE_MERGE_THRESHOLD // 100
+
+    @staticmethod
+    def _normalize(node):
+        """之前的版本中，内部节点分裂之后，左边的节点会多出最后一个 key (keys 与
+        children 一样多). 查找时大于等于它的 key 都会走到最后一个子节点，
+        所以去掉它并不影响查找，合并、重新分配之前先把它去掉"""
+        if not node.is_leaf and len(node.keys) == len(node.children):
+            node.keys.pop()
+            node.dirty = True
+            node.nbytes = None
+
+    def _rebalance(self, node, path):
+        """node 中删除了元素之后占用的空间太少了：与相邻的兄弟节点合并，合并之后
+        放不下的话，就在两个节点之间按照大小重新分配元素. 合并会使父节点少一个子节点，
+        可能还要继续向上调整. path 的含义与 _split() 相同.
+        返回树的结构是否发生了变化"""
+        if node is self.root:
+            # 根节点不需要满足最小的填充率. 但是内部节点只剩下一个子节点时，
+            # 这个子节点成为新的根节点，树的高度减一
+            if node.is_leaf or len(node.children) > 1:
+                return False
+            self.root = self.load_node(node.children[0])
+            self.free_node(node)
+            return True
+
+        parent, index = path.pop()
+        assert parent.children[index] == node
+        self._normalize(parent)
+        if len(parent.children) < 2:
+            return False
+        # 优先与右边的兄弟节点合并，最右边的子节点则与左边的兄弟节点合并.
+        # 总是把右边的节点合并到左边的节点中，只需要修改左边节点的 next_leaf
+        if index + 1 < len(parent.children):
+            left, right = node, self.load_node(parent.children[index + 1])
+        else:
+            index -= 1
+            left, right = self.load_node(parent.children[index]), node
+        self._normalize(left)
+        self._normalize(right)
+
+        if left.is_leaf:
+            left.keys.extend(right.keys)
+            left.values.extend(right.values)
+            left.next_leaf = right.next_leaf
+        else:
+            # 父节点中的分隔 key 下移，作为 right 第一个子节点的下界
+            left.keys.append(parent.keys[index])
+            left.keys.extend(right.keys)
+            left.children.extend(right.children)
+        left.dirty = True
+        left.nbytes = None
+        parent.dirty = True
+        parent.nbytes = None
+
+        if left.size <= NODE_CAPACITY * BPLUS_TREE_FILLFACTOR // 100:
+            del parent.keys[index]
+            del parent.children[index + 1]
+            self.free_node(right)
+            if parent is self.root or self._need_merge(parent):
+                self._rebalance(parent, path)
+            return True
+
+        # 合并之后放不下，再从中间分开. 新的分隔 key 可能比原来的长，父节点也可能要分裂
+        parent.keys[index] = self._divide(left, right, self._split_index(left, False))
+        if self._need_split(parent):
+            self._split(parent, path)
+        return True
 
     def find(self, key):
         values = []
+        key = self._search_key(key)
         node = self.find_leaf_node(key)
         while node:
-            indexes = list(self._find_indexes(node.keys, key))
-            if len(indexes) == 0:
+            indexes = self._find_indexes(node.keys, key)
+            # 之前的版本中，叶子节点被删空之后仍然留在链表中，需要跳过
+            if len(indexes) == 0 and node.keys:
                 break
             for index in indexes:
                 values.append(node.values[index])
@@ -388,97 +706,174 @@ class BPlusTree:
         # 因为，对于等值，可以直接补充等值查询即可
         # 算法复杂度没有新增多少
         values = []
+        start = self._search_key(start)
+        end = self._search_key(end)
         node = self.find_leaf_node(start)
         while node:
-            for index, key in enumerate(node.keys):
-                # 提前退出
-                if key >= end:
-                    break
-                # 如果我们不在上面指定trick start=-inf, ...
-                # 那么我们就要判断 start/end 是否为 None
-                if start < key < end:
-                    if return_keys:
-                        values.append(key)
-                    else:
-                        values.append(node.values[index])
+            # 叶子节点中满足 start < key < end 的 key 是连续的一段，
+            # 如果我们不在上面指定trick start=-inf, ...
+            # 那么我们就要判断 start/end 是否为 None
+            lo = bisect.bisect_right(node.keys, start)
+            hi = bisect.bisect_left(node.keys, end, lo)
+            if return_keys:
+                values.extend(node.keys[lo:hi])
+            else:
+                values.extend(node.values[lo:hi])
+            # 后面的 key 都不小于 end 了，提前退出
+            if hi < len(node.keys):
+                break
             node = node.next_leaf
             node = self.load_node(node)
         return values
 
-    def find_leaf_node(self, key):
-        """寻找最左边的叶子节点（我们B+树是按照从小到大组织数据的）"""
-        node = self.root
+    def find_leaf_node(self, key, path=None):
+        """寻找最左边的叶子节点（我们B+树是按照从小到大组织数据的）.
+        会越过被删空的叶子节点 (之前的版本遗留下来的) 继续往右找.
+        path 不为 None 时，把从根节点到叶子节点经过的 (内部节点, 子节点的下标)
+        依次记录在 path 中，分裂时沿着它向上调整，不需要再从根节点寻找父节点"""
+        # 注意：要先加载节点，再判断是否为叶子节点，因为没有加载的节点
+        # 其 is_leaf 字段只是默认值
+        node = self.load_node(self.root)
         while node and not node.is_leaf:
-            node = self.load_node(node)
             index = self._find_leftmost_key_index(node, key)
             # 如果没有这样的 index, 则 node 为最后一个子节点
+            # 对于唯一key，可以在 key == node.keys[index] 时直接走 index + 1,
+            # 但是不唯一的key会很麻烦，不能这么做
             if index >= len(node.keys):
-                node = node.children[-1]
-            # 对于唯一key，应该使用下述方法，但是不唯一的key
-            # 会很麻烦，不能直接使用下述代码
-            # elif key == node.keys[index]:
-            #     node = node.get_child(index + 1)
-            else:
-                node = node.get_child(index)
+                index = len(node.children) - 1
+            if path is not None:
+                path.append((node, index))
+            node = self.load_node(node.children[index])
 
-        while node.keys and node.keys[-1] < key and node.next_leaf:
+        # 叶子节点中的元素被删空之后，也要继续往右寻找
+        while node.next_leaf and (not node.keys or node.keys[-1] < key):
             node = node.next_leaf
             node = self.load_node(node)
+            if path is not None:
+                self._move_path_right(path)
+        return node
+
+    def _find_insert_leaf(self, key, path):
+        """插入时寻找叶子节点：走到 key 所在范围最右边的子节点 (upper bound), 这样
+        相同的 key 按照插入的顺序排列，分裂出来的分隔 key 也不会小于父节点中左边的 key.
+        如果像 find_leaf_node() 那样，只要叶子节点中的 key 都比较小就往右走，
+        key 会被插入到右边叶子节点的下界之前，父节点中的 key 就不再有序了.
+        只有右边的叶子节点中最小的 key 也不大于 key 时，才需要往右走
+        (之前的版本中，内部节点分裂之后的分隔 key 不准确)"""
+        node = self.load_node(self.root)
+        while not node.is_leaf:
+            index = min(self._find_rightmost_key_index(node, key), len(node.children) - 1)
+            path.append((node, index))
+            node = self.load_node(node.children[index])
+
+        while node.next_leaf and node.keys and node.keys[-1] < key:
+            next_leaf = self.load_node(node.next_leaf)
+            if not next_leaf.keys or key < next_leaf.keys[0]:
+                break
+            node = next_leaf
+            self._move_path_right(path)
         return node
 
+    def _move_path_right(self, path):
+        """叶子节点沿着 next_leaf 右移了一个，path 也要跟着指向右边的叶子节点:
+        从下往上找到第一个还有右边子节点的内部节点，再沿着最左边的子节点走下来"""
+        level = len(path) - 1
+        while level >= 0:
+            parent, index = path[level]
+            if index + 1 < len(parent.children):
+                path[level] = (parent, index + 1)
+                node = self.load_node(parent.children[index + 1])
+                for lower in range(level + 1, len(path)):
+                    path[lower] = (node, 0)
+                    node = self.load_node(node.children[0])
+                return
+            level -= 1
+        raise BPlusTreeError('not found the next leaf node.')
+
     @staticmethod
     def _find_indexes(keys, key):
-        for i, k in enumerate(keys):
-            if key == k:
-                yield i
-            # 这样可以做个剪枝
-            elif k > key:
-                break
+        # 相同的 key 是连续存放的，[lower bound, upper bound) 就是它们的下标
+        lo = bisect.bisect_left(keys, key)
+        return range(lo, bisect.bisect_right(keys, key, lo))
+
+    @staticmethod
+    def _search_key(key):
+        # 查询条件传进来的可能是普通的 tuple, 先转换为 BPlusTreeTuple,
+        # 这样二分查找时每次比较都能直接使用 sort_key
+        if type(key) is tuple:
+            return BPlusTreeTuple(key)
+        return key
 
     def load_node(self, node: BPlusTreeNode):
         if node is None:
             return None
-        if node.loaded:
-            return node
+        if node.pageno in self.nodes:
+            return self.nodes[node.pageno]
 
-        # 开始真正加载数据
-        page = load_page_from_disk(self.filename, node.pageno)
-        node.from_page(page)
+        if not node.loaded:
+            # 开始真正加载数据
+            if self.relation is not None:
+                page = load_index_page(self.relation, node.pageno)
+            else:
+                page = load_page_from_disk(self.filename, node.pageno)
+            node.from_page(page)
+        self.nodes[node.pageno] = node
         return node
 
-    def serialize(self):
+    def dirty_nodes(self):
+        # 被修改过的节点一定被加载过，所以只需要遍历 self.nodes
+        return [self.nodes[pageno] for pageno in sorted(self.nodes)
+                if self.nodes[pageno].dirty]
+
+    def _flush_dirty_nodes(self, lsn):
+        """把被修改过的节点序列化为 page, 返回 (pageno, page) 列表"""
+        pages = []
+        for node in self.dirty_nodes():
+            if lsn is not None:
+                node.lsn = lsn
+            pages.append((node.pageno, node.to_page()))
+            node.dirty = False
+        return pages
+
+    def serialize(self, lsn=None):
+        """只写出被修改过的节点：已有的数据页原地覆盖写，新分配的数据页追加到文件尾部.
+        数据页落盘之后，再更新文件头中根节点的 pageno"""
         assert self.filename
 
-        # 遍历树的节点
-        nodes = []
-        queue = [self.root]
-        while len(queue) > 0:
-            node = queue.pop(0)  # 拿第一个节点
-            # 等价于for 遍历children
-            if not node.is_leaf:
-                queue.extend(node.children)
-
-            nodes.append(node)
-
-        nodes.sort(key=lambda n: n.pageno)
-
-        # 校验所有node都有pageno，且赋值正确
-        for i in range(len(nodes)):
-            assert i == nodes[i].pageno
-
-        with open(self.filename, 'w+b') as f:
-            root_node_pageno = self.root.pageno
-            f.write(
-                int.to_bytes(root_node_pageno,
-                             HEADER_SIZE,
-                             LITTLE_ORDER,
-                             signed=False)
-            )
-            for node in nodes:
-                f.write(node.to_page().serialize())
-            # 是一个系统调用，确保文件能够刷到磁盘里
-            # 如果没有刷进去，就一直等着 blocking
-            os.fsync(f.fileno())
+        pages = self._flush_dirty_nodes(lsn)
+        for pageno, page in pages:
+            fd_mgr.write(self.filename, HEADER_SIZE + pageno * PAGE_SIZE, page.serialize())
+        if pages:
+            fd_mgr.fsync(self.filename)
+        self._write_root(self.filename)
+
+    def write_pages(self, lsn=None):
+        """把被修改过的节点序列化之后放入 buffer pool, 并标记为脏页. lsn 是修改时
+        redo log 的位置，写回磁盘之前，redo log 要先落盘到这个位置 (WAL).
+        返回 (pageno, page) 列表，由调用者写回磁盘之后，再调用 write_root()"""
+        assert self.relation is not None
+        pages = self._flush_dirty_nodes(lsn)
+        for pageno, page in pages:
+            buffer_pool.put((self.relation.relation, pageno), page, dirty=True)
+        return pages
+
+    def write_root(self):
+        """索引页都落盘之后，再更新文件头中根节点的 pageno 以及空闲页链表"""
+        assert self.relation is not None
+        self._write_root(self.relation.filename)
+        self.relation.root_pageno = self.root.pageno
+        self.relation.free_pageno = self.free_pageno
+
+    def _write_root(self, filename):
+        # 调用者要先把数据页 fsync 到磁盘上，再切换根节点. 根节点分裂时，
+        # 新的根节点是新分配的数据页，切换之前，文件头仍然指向旧的根节点.
+        # 文件头只有 8 个字节，不会跨越磁盘扇区，一次 pwrite 是原子的
+        header = (self.root.pageno, self.free_pageno)
+        if header == self.persisted_header:
+            return
+        fd_mgr.write(filename, 0, pack_header(*header))
+        fd_mgr.fsync(filename)
+        self.persisted_header = header
 
     @staticmethod
     def deserialize(filename):
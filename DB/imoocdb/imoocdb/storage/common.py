@@ -1,8 +1,13 @@
 import os
-import pickle
+from contextlib import contextmanager
 
+from imoocdb.catalog.entry import catalog_table
 from imoocdb.constant import DATA_DIRECTORY
+from imoocdb.storage.bplus_tree import BPlusTree, HEADER_SIZE, load_root_node
+from imoocdb.storage.fd import fd_mgr
 from imoocdb.storage.lru import buffer_pool
+from imoocdb.storage.relation import relation_cache, RelationDescriptor
+from imoocdb.storage.row import RowCodec
 from imoocdb.storage.slotted_page import PAGE_SIZE, Page
 
 
@@ -12,58 +17,100 @@ def get_table_filename(table_name):
     return os.path.join(DATA_DIRECTORY, table_name + '.tbl')
 
 
-def table_tuple_get_disk_pages(table_name):
-    filename = get_table_filename(table_name)
-    if not os.path.exists(filename):
-        return 0
+def table_open(table_name) -> RelationDescriptor:
+    relation = relation_cache.get(table_name)
+    if relation is None:
+        # 只有第一次打开该表时，才需要访问文件系统
+        relation = relation_cache.open(table_name, get_table_filename(table_name))
+    return relation
 
-    if os.stat(filename).st_size > 0:
-        assert os.stat(filename).st_size % PAGE_SIZE == 0
-    return os.stat(filename).st_size // PAGE_SIZE
+
+def table_tuple_get_disk_pages(table_name):
+    return table_open(table_name).disk_pages
 
 
 def table_tuple_get_pages(table_name):
-    disk_pages = table_tuple_get_disk_pages(table_name)
-    # pageno 从 0 开始，因此，衡量具体page数量的时候，要加1
-    memory_pages = buffer_pool.find_max_pageno(table_name) + 1
-    return max(memory_pages, disk_pages)
+    return table_open(table_name).pages
+
+
+def _table_page_loader(table_name, pageno):
+    """返回把该数据页加载到 buffer 中的函数，以及加载出来的是不是一个新的数据页"""
+    relation = table_open(table_name)
+    # 是否磁盘里面已经包含了数据页，但是没有加载到内存中
+    if pageno < relation.disk_pages:
+        # 意味着磁盘里面已经有该数据页了，需要先从磁盘里面加载
+        # 到内存中
+        def load():
+            buff = fd_mgr.read(relation.filename, pageno * PAGE_SIZE, PAGE_SIZE)
+            return Page.deserialize(buff)
+
+        return load, False
 
+    # 此时意味着，磁盘里面找不到对应的 pageno, 我们要创建出新的页来
+    # 同时，别忘记了他是一个脏页
+    def create():
+        new_page = Page()
+        new_page.set_header(0)
+        return new_page
 
-def table_tuple_get_page(table_name, pageno):
+    return create, True
+
+
+def table_tuple_get_page(table_name, pageno, strategy=None):
+    """strategy 是 buffer_pool.get_access_strategy() 返回的对象，
+    用于大表的顺序扫描、批量写入等场景，见 BufferAccessStrategy.
+    注意：返回的数据页没有被 pin 住，需要跨越其他数据页的访问持有它时，
+    要使用 table_tuple_pinned_page()"""
     key = (table_name, pageno)
-    if key not in buffer_pool:
-        # 是否磁盘里面已经包含了数据页，但是没有加载到内存中
-        if pageno < table_tuple_get_disk_pages(table_name):
-            # 意味着磁盘里面已经有该数据页了，需要先从磁盘里面加载
-            # 到内存中
-            filename = get_table_filename(table_name)
-            if not os.path.exists(filename):
-                return None
-
-            with open(filename, 'rb') as f:
-                f.seek(pageno * PAGE_SIZE)
-                buff = f.read(PAGE_SIZE)
-                page = Page.deserialize(buff)
-            # 把数据页装载到磁盘里面
-            buffer_pool[key] = page
-        else:
-            # 此时意味着，磁盘里面找不到对应的 pageno, 我们要创建出新的页来
-            # 同时，别忘记了他是一个脏页
-            buffer_pool[key] = Page()
-            buffer_pool.mark_dirty(key)
-
-    page = buffer_pool[key]
+    # 命中时 get_or_load() 不会调用 loader, 不要先用 buffer_pool[key] 探测一次，
+    # 否则每次未命中都会被统计两次
+    loader, new = _table_page_loader(table_name, pageno)
+    page = buffer_pool.get_or_load(key, loader, dirty=new, strategy=strategy)
+    if new:
+        relation_cache.extend(table_name, pageno)
     return page
 
 
-def tuple_to_bytes(tup):
-    return pickle.dumps(tup)
+@contextmanager
+def table_tuple_pinned_page(table_name, pageno, strategy=None):
+    """with table_tuple_pinned_page(table_name, pageno) as page:
+    在 with 语句块中，该数据页不会被淘汰"""
+    key = (table_name, pageno)
+    loader, new = _table_page_loader(table_name, pageno)
+    with buffer_pool.pinned(key, loader, dirty=new, strategy=strategy) as page:
+        if new:
+            relation_cache.extend(table_name, pageno)
+        yield page
+
+
+def table_row_codec(table_name) -> RowCodec:
+    relation = table_open(table_name)
+    if relation.row_codec is None:
+        forms = catalog_table.select(lambda r: r.table_name == table_name)
+        assert forms, f'not found the table {table_name}.'
+        relation.row_codec = RowCodec(forms[0].types)
+    return relation.row_codec
+
 
+def tuple_to_bytes(table_name, tup):
+    return table_row_codec(table_name).encode(tup)
 
-def bytes_to_tuple(bytes_):
+
+def bytes_to_tuple(table_name, bytes_):
     if len(bytes_) == 0:
         return ()
-    return pickle.loads(bytes_)
+    return table_row_codec(table_name).decode(bytes_)
+
+
+def bytes_to_column(table_name, bytes_, i):
+    """只解码元组中的第 i 列，不需要解码整个元组"""
+    return table_row_codec(table_name).decode_column(bytes_, i)
+
+
+def get_fsm_filename(table_name):
+    if not os.path.exists(DATA_DIRECTORY):
+        os.mkdir(DATA_DIRECTORY)
+    return os.path.join(DATA_DIRECTORY, table_name + '.fsm')
 
 
 def get_index_filename(index_name):
@@ -72,9 +119,37 @@ def get_index_filename(index_name):
     return os.path.join(DATA_DIRECTORY, index_name + '.idx')
 
 
-def sync_table_page(table_name, pageno, page):
-    filename = get_table_filename(table_name)
-    with open(filename, 'ab') as f:
-        f.seek(pageno * PAGE_SIZE)
-        f.write(page.serialize())
-        os.fsync(f.fileno())
+def index_open(index_name) -> RelationDescriptor:
+    relation = relation_cache.get(index_name)
+    if relation is None:
+        relation = relation_cache.open(index_name, get_index_filename(index_name),
+                                       header_size=HEADER_SIZE, kind='index')
+    return relation
+
+
+def index_tree_open(index_name) -> BPlusTree:
+    """打开索引对应的 B+ 树，索引页通过 buffer pool 加载"""
+    relation = index_open(index_name)
+    return BPlusTree(relation.filename, load_root_node(relation.filename, relation), relation)
+
+
+def sync_table_pages(relation: RelationDescriptor, images):
+    """把同一张表 (或者索引) 的多个数据页写到磁盘上. images 是 (pageno, 序列化之后的数据页) 列表.
+    pageno 连续的数据页合并成一次 pwritev, 最后整个文件只 fsync 一次.
+    数据页在文件中的偏移量取决于 relation 的 header_size, 所以要传入 relation 本身，不能按名字重新打开.
+    返回写出的数据页数量"""
+    if not images:
+        return 0
+    images = sorted(images, key=lambda item: item[0])
+    run_start = images[0][0]
+    run = []
+    for pageno, image in images:
+        if pageno != run_start + len(run):
+            fd_mgr.writev(relation.filename, relation.header_size + run_start * PAGE_SIZE, run)
+            run_start = pageno
+            run = []
+        run.append(image)
+    fd_mgr.writev(relation.filename, relation.header_size + run_start * PAGE_SIZE, run)
+    fd_mgr.fsync(relation.filename)
+    relation_cache.pages_synced(relation.relation, [pageno for pageno, _ in images])
+    return len(images)
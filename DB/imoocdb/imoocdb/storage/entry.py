@@ -1,13 +1,15 @@
-import os
-
 from imoocdb.catalog.entry import catalog_table, catalog_index
 from imoocdb.errors import PageError
-from imoocdb.storage.bplus_tree import BPlusTree, BPlusTreeTuple, load_root_node
-from imoocdb.storage.common import get_table_filename, table_tuple_get_pages, table_tuple_get_page, tuple_to_bytes, \
-    bytes_to_tuple, get_index_filename
-from imoocdb.storage.lru import buffer_pool
-from imoocdb.storage.slotted_page import Page
-from imoocdb.storage.transaction.entry import transaction_mgr
+from imoocdb.storage.bplus_tree import BPlusTree, BPlusTreeTuple
+from imoocdb.storage.common import table_tuple_get_pages, table_tuple_get_page, tuple_to_bytes, \
+    bytes_to_tuple, index_open, index_tree_open, table_row_codec, table_tuple_pinned_page
+from imoocdb.storage.fsm import free_space_map_mgr
+from imoocdb.storage.index_build import scan_index_entries, sort_index_entries
+from imoocdb.storage.lru import buffer_pool, BAS_BULKREAD, BAS_BULKWRITE, BAS_VACUUM
+from imoocdb.storage.slotted_page import Slot
+from imoocdb.storage.stat import relation_stat_mgr
+from imoocdb.storage.transaction.entry import transaction_mgr, write_back_index, index_tuple_reorganize, \
+    INVALID_XID
 from imoocdb.storage.transaction.redo import RedoRecord, RedoAction
 from imoocdb.storage.transaction.undo import UndoRecord, UndoOperation
 
@@ -17,8 +19,30 @@ def table_tuple_get_all(table_name):
     # 是有意义的，那么，此函数内部，就不需要再进行重复的判断了！！！
     assert catalog_table.select(lambda r: r.table_name == table_name)
     # 迪米特法则：（最小知道/知识原则）：上层的函数/class对底层的实现知道越少越好
-    for location in table_tuple_get_all_locations(table_name):
-        yield table_tuple_get_one(table_name, location)
+    for _, tup in table_tuple_scan(table_name):
+        yield tup
+
+
+def table_tuple_scan(table_name):
+    """按页批量扫描整张表，返回 (location, tuple) 二元组.
+    每个数据页只从 buffer 中获取一次，每个有效元组只反序列化一次."""
+    # 页数在扫描开始时确定一次即可，不必每一页都重新计算
+    codec = table_row_codec(table_name)
+    pages = table_tuple_get_pages(table_name)
+    # 与 Postgres 一样，超过 buffer pool 1/4 的大表才使用 ring buffer 扫描，
+    # 避免把其他的热点数据页挤出去
+    strategy = None
+    if pages > buffer_pool.capacity // 4:
+        strategy = buffer_pool.get_access_strategy(BAS_BULKREAD)
+    for pageno in range(0, pages):
+        # 调用者遍历该数据页上的元组期间，数据页一直被 pin 住，不会被淘汰
+        with table_tuple_pinned_page(table_name, pageno, strategy) as page:
+            # 直接从 memoryview 中解码，不需要为每个元组拷贝一份 bytes.
+            # 先把整个数据页解码完，再交给调用者，这样 memoryview 都已经被释放了，
+            # 调用者在遍历的过程中修改该数据页 (如 UPDATE) 也不会有问题
+            tuples = [((pageno, sid), codec.decode(view))
+                      for sid, view in page.iter_record_views()]
+            yield from tuples
 
 
 def table_tuple_get_page_tuples(table_name, pageno):
@@ -28,20 +52,16 @@ def table_tuple_get_page_tuples(table_name, pageno):
 
 def table_tuple_get_all_locations(table_name):
     # 我们手动跳过被标记为空的元组
-    for pageno in range(0, table_tuple_get_pages(table_name)):
-        for sid in range(0, table_tuple_get_page_tuples(table_name, pageno)):
-            # 返回的 location 是一个二元组
-            # todo: 判断当前返回给用户的tuple是否为死元组，
-            # 无效元组应该过滤
-            location = (pageno, sid)
-            if not table_tuple_is_dead(table_name, location):
-                yield location
+    for location, _ in table_tuple_scan(table_name):
+        # 返回的 location 是一个二元组
+        yield location
 
 
 def table_tuple_get_one(table_name, location):
     pageno, sid = location
-    page = table_tuple_get_page(table_name, pageno=pageno)
-    return bytes_to_tuple(page.select(sid))
+    with table_tuple_pinned_page(table_name, pageno) as page:
+        with page.select_view(sid) as view:
+            return bytes_to_tuple(table_name, view)
 
 
 def table_tuple_is_dead(table_name, location):
@@ -50,30 +70,41 @@ def table_tuple_is_dead(table_name, location):
 
 def table_tuple_update_one(table_name, location, tup):
     pageno, sid = location
-    page = table_tuple_get_page(table_name, pageno=pageno)
     xid = transaction_mgr.session_xid()
-    old_tuple_bytes = tuple_to_bytes(page.select(sid))
-
-    try:
-        new_sid = page.update(sid, tuple_to_bytes(tup))
-        buffer_pool.mark_dirty((table_name, pageno))
-        # 写日志
-        undo_record = UndoRecord(
-            xid, UndoOperation.TABLE_UPDATE, table_name, (pageno, sid),
-            old_tuple_bytes
-        )
-        redo_record = RedoRecord(
-            xid, RedoAction.TABLE_UPDATE, table_name, (pageno, new_sid),
-            tuple_to_bytes(tup)
-        )
-        transaction_mgr.undo_mgr.write(undo_record)
-        lsn = transaction_mgr.redo_mgr.write(redo_record)
-        page.set_header(lsn)
-    except PageError:
-        # 只存在 insert 无法插入数据，是因为没有空间了，才会导致
-        # 因此我们只需要处理该种异常即可
-        table_tuple_delete_one(table_name, location)
-        new_sid = table_tuple_insert_one(table_name, tup)
+    tuple_bytes = tuple_to_bytes(table_name, tup)
+
+    with table_tuple_pinned_page(table_name, pageno) as page:
+        old_tuple_bytes = page.select(sid)
+        try:
+            new_sid = page.update(sid, tuple_bytes)
+            buffer_pool.mark_dirty((table_name, pageno))
+            free_space_map_mgr.get(table_name).update(pageno, page.available_space)
+            relation_stat_mgr.report_update(table_name, pageno, xid)
+            # 写日志
+            undo_record = UndoRecord(
+                xid, UndoOperation.TABLE_UPDATE, table_name, (pageno, sid),
+                old_tuple_bytes
+            )
+            # 重放时对同一个数据页执行同样的 update(sid, ...), 搬移到的新 sid 也是一样的
+            redo_record = RedoRecord(
+                xid, RedoAction.TABLE_UPDATE, table_name, (pageno, sid),
+                tuple_bytes
+            )
+            transaction_mgr.undo_mgr.write(undo_record)
+            if new_sid != sid:
+                # 新的元组被搬移到了同一个数据页中的另一个 slot 上，回滚时要先删除它,
+                # 再在原来的 slot 上恢复旧的元组 (undo 是倒序执行的)
+                transaction_mgr.undo_mgr.write(UndoRecord(
+                    xid, UndoOperation.TABLE_DELETE, table_name, (pageno, new_sid), b''
+                ))
+            lsn = transaction_mgr.redo_mgr.write(redo_record)
+            page.set_header(lsn)
+        except PageError:
+            # 只存在 insert 无法插入数据，是因为没有空间了，才会导致
+            # 因此我们只需要处理该种异常即可
+            table_tuple_delete_one(table_name, location)
+            # 新的元组可能会被 fsm 放到其他的数据页里面
+            new_sid = table_tuple_insert_one(table_name, tup)
     return new_sid
 
 
@@ -81,27 +112,30 @@ def table_tuple_get_last_pageno(table_name):
     return max(table_tuple_get_pages(table_name) - 1, 0)
 
 
-def table_tuple_allocate_page(table_name):
-    pageno = table_tuple_get_last_pageno(table_name)
-    table_tuple_get_page(table_name, pageno)
-    new_pageno = table_tuple_get_last_pageno(table_name)
-    assert new_pageno == pageno + 1
+def table_tuple_allocate_page(table_name, strategy=None):
+    new_pageno = table_tuple_get_pages(table_name)
+    # 获取一个不存在的数据页，就会在 buffer 中创建出一个新的 (脏) 页
+    table_tuple_get_page(table_name, new_pageno, strategy)
+    assert table_tuple_get_last_pageno(table_name) == new_pageno
     return new_pageno
 
 
 def table_tuple_insert_one(table_name, tup):
-    pageno = table_tuple_get_last_pageno(table_name)
-    if pageno < 0:
-        pageno = table_tuple_allocate_page(table_name)
-
-    # 产生了非常多的 overhead, 这也进一步证明了 buffer 的重要性
-    page = table_tuple_get_page(table_name, pageno=pageno)
     xid = transaction_mgr.session_xid()
-    tuple_bytes = tuple_to_bytes(tup)
+    tuple_bytes = tuple_to_bytes(table_name, tup)
+
+    # 优先通过 fsm 寻找有足够空闲空间的数据页，这样，被删除或者被更新的元组
+    # 释放出来的空间，就可以被重新利用了；找不到的话，再使用最后一个数据页
+    fsm = free_space_map_mgr.get(table_name)
+    pageno = fsm.search(len(tuple_bytes) + Slot.size())
+    if pageno < 0 or pageno >= table_tuple_get_pages(table_name):
+        pageno = table_tuple_get_last_pageno(table_name)
 
-    try:
-        sid = page.insert(tuple_to_bytes(tup))
+    def write_page_logs(page, sid):
         buffer_pool.mark_dirty((table_name, pageno))
+        fsm.update(pageno, page.available_space)
+        relation_stat_mgr.report_insert(table_name, pageno, xid)
+
         # write logs
         undo_record = UndoRecord(xid,
                                  UndoOperation.TABLE_DELETE,
@@ -113,57 +147,197 @@ def table_tuple_insert_one(table_name, tup):
         transaction_mgr.undo_mgr.write(undo_record)
         lsn = transaction_mgr.redo_mgr.write(redo_record)
         page.set_header(lsn=lsn)
-    except PageError:
-        new_pageno = table_tuple_allocate_page(table_name)
-        new_page = table_tuple_get_page(table_name, new_pageno)
-        sid = new_page.insert(tuple_bytes)
-        buffer_pool.mark_dirty((table_name, new_pageno))
 
-        # write logs
-        undo_record = UndoRecord(xid,
-                                 UndoOperation.TABLE_DELETE,
-                                 table_name, (new_pageno, sid),
-                                 b'')
-        redo_record = RedoRecord(
-            xid, RedoAction.TABLE_INSERT, table_name, (new_pageno, sid), tuple_bytes
-        )
-        transaction_mgr.undo_mgr.write(undo_record)
-        lsn = transaction_mgr.redo_mgr.write(redo_record)
-        page.set_header(lsn=lsn)
+    # 产生了非常多的 overhead, 这也进一步证明了 buffer 的重要性
+    with table_tuple_pinned_page(table_name, pageno) as page:
+        try:
+            sid = page.insert(tuple_bytes)
+        except PageError:
+            # fsm 只是一个提示，可能是不准确的，顺便修正一下
+            fsm.update(pageno, page.available_space)
+            sid = None
+        else:
+            write_page_logs(page, sid)
+    if sid is None:
+        pageno = table_tuple_allocate_page(table_name)
+        with table_tuple_pinned_page(table_name, pageno) as page:
+            sid = page.insert(tuple_bytes)
+            write_page_logs(page, sid)
 
     return pageno, sid
 
 
+def table_tuple_insert_many(table_name, tuples):
+    """批量插入元组，返回每个元组的 location.
+    与逐条调用 table_tuple_insert_one 相比，一次把数据页填满，
+    每个数据页只写一条 undo log 和一条 redo log."""
+    xid = transaction_mgr.session_xid()
+    # 先把所有的元组都编码好，这样，如果某个元组有问题，就不会插入一半
+    records = [tuple_to_bytes(table_name, tup) for tup in tuples]
+    fsm = free_space_map_mgr.get(table_name)
+    locations = []
+    # 批量插入时新分配的数据页通过 ring buffer 写出，不会挤占 buffer pool
+    strategy = buffer_pool.get_access_strategy(BAS_BULKWRITE)
+
+    def find_page(record):
+        pageno = fsm.search(len(record) + Slot.size())
+        if pageno < 0 or pageno >= table_tuple_get_pages(table_name):
+            pageno = table_tuple_get_last_pageno(table_name)
+        return pageno
+
+    def write_page_logs(pageno, page, sids, page_records):
+        buffer_pool.mark_dirty((table_name, pageno))
+        fsm.update(pageno, page.available_space)
+        relation_stat_mgr.report_insert(table_name, pageno, xid)
+        transaction_mgr.undo_mgr.write(UndoRecord(
+            xid, UndoOperation.TABLE_DELETE_MANY, table_name, (pageno, sids), b''
+        ))
+        lsn = transaction_mgr.redo_mgr.write(RedoRecord(
+            xid, RedoAction.TABLE_INSERT_MANY, table_name, (pageno, sids), page_records
+        ))
+        page.set_header(lsn=lsn)
+
+    def fill_page(page, start):
+        # 尽可能多地把 records[start:] 放到该数据页中，返回 sid 列表
+        sids = []
+        for record in records[start:]:
+            try:
+                sids.append(page.insert(record))
+            except PageError:
+                break
+        return sids
+
+    i = 0
+    while i < len(records):
+        pageno = find_page(records[i])
+        with table_tuple_pinned_page(table_name, pageno) as page:
+            sids = fill_page(page, i)
+            if sids:
+                write_page_logs(pageno, page, sids, records[i: i + len(sids)])
+            else:
+                # 一个元组都放不下，说明 fsm 不准确，修正之后换一个新的数据页
+                fsm.update(pageno, page.available_space)
+        if not sids:
+            pageno = table_tuple_allocate_page(table_name, strategy)
+            with table_tuple_pinned_page(table_name, pageno, strategy) as page:
+                # 新的数据页也放不下，直接抛出异常
+                sids = [page.insert(records[i])] + fill_page(page, i + 1)
+                write_page_logs(pageno, page, sids, records[i: i + len(sids)])
+        locations.extend((pageno, sid) for sid in sids)
+        i += len(sids)
+    return locations
+
+
 def table_tuple_delete_one(table_name, location):
     pageno, sid = location
-    page = table_tuple_get_page(table_name, pageno=pageno)
     xid = transaction_mgr.session_xid()
-    old_tuple_bytes = tuple_to_bytes(table_tuple_get_one(table_name, location))
-    page.delete(sid)
-    buffer_pool.mark_dirty((table_name, pageno))
+    with table_tuple_pinned_page(table_name, pageno) as page:
+        old_tuple_bytes = page.select(sid)
+        page.delete(sid)
+        buffer_pool.mark_dirty((table_name, pageno))
+        free_space_map_mgr.get(table_name).update(pageno, page.available_space)
+        relation_stat_mgr.report_delete(table_name, pageno, xid)
 
-    # write logs
-    undo_record = UndoRecord(xid,
-                             UndoOperation.TABLE_INSERT,
-                             table_name, (pageno, sid),
-                             old_tuple_bytes)
-    redo_record = RedoRecord(
-        xid, RedoAction.TABLE_DELETE, table_name, (pageno, sid), b''
-    )
-    transaction_mgr.undo_mgr.write(undo_record)
-    lsn = transaction_mgr.redo_mgr.write(redo_record)
-    page.set_header(lsn=lsn)
+        # write logs
+        undo_record = UndoRecord(xid,
+                                 UndoOperation.TABLE_INSERT,
+                                 table_name, (pageno, sid),
+                                 old_tuple_bytes)
+        redo_record = RedoRecord(
+            xid, RedoAction.TABLE_DELETE, table_name, (pageno, sid), b''
+        )
+        transaction_mgr.undo_mgr.write(undo_record)
+        lsn = transaction_mgr.redo_mgr.write(redo_record)
+        page.set_header(lsn=lsn)
 
 
-def table_tuple_reorganize(table_name):
-    # 把所有的tuple的状态为 dead 的元组，统一进行整理
-    pass
+def table_tuple_reorganize(table_name, pagenos=None):
+    """把所有的tuple的状态为 dead 的元组，统一进行整理 (VACUUM).
+    整理之后，存活元组的 sid 可能会发生变化，因此还要同步修正索引.
+    被还没有结束的事务修改过的数据页会被跳过.
+    返回被回收的 slot 数量."""
+    if pagenos is None:
+        pagenos = range(0, table_tuple_get_pages(table_name))
+
+    active_xids = set(transaction_mgr.undo_mgr.active_transactions)
+    fsm = free_space_map_mgr.get(table_name)
+    strategy = buffer_pool.get_access_strategy(BAS_VACUUM)
+    # (location, tuple)，其中 tuple 用来计算索引的 key
+    dead_tuples = []
+    # (old_location, new_location, tuple)
+    moved_tuples = []
+    reclaimed = 0
+    for pageno in pagenos:
+        if relation_stat_mgr.is_page_busy(table_name, pageno, active_xids):
+            continue
+        with table_tuple_pinned_page(table_name, pageno, strategy) as page:
+            slot_count = len(page.slot_directory)
+            if page.reclaimable_space == 0 and page.dead_slot_count == 0:
+                relation_stat_mgr.report_vacuum(table_name, pageno)
+                continue
+
+            for sid, record in page.iter_dead_records():
+                dead_tuples.append(((pageno, sid), bytes_to_tuple(table_name, record)))
+            moved = page.vacuum()
+            for old_sid, new_sid in moved.items():
+                moved_tuples.append(((pageno, old_sid), (pageno, new_sid),
+                                     bytes_to_tuple(table_name, page.select(new_sid))))
+            reclaimed += slot_count - len(page.slot_directory)
+
+            # 整理过程会大范围地移动 record, 所以 redo 里面直接记录整个数据页
+            page.set_header(page.page_header.lsn)
+            lsn = transaction_mgr.redo_mgr.write(RedoRecord(
+                INVALID_XID, RedoAction.TABLE_REORGANIZE,
+                table_name, (pageno, None), page.serialize()
+            ))
+            page.set_header(lsn)
+            buffer_pool.mark_dirty((table_name, pageno))
+            fsm.update(pageno, page.available_space)
+            relation_stat_mgr.report_vacuum(table_name, pageno)
+
+    if not dead_tuples and not moved_tuples:
+        return reclaimed
+
+    table_columns = catalog_table.select(
+        lambda r: r.table_name == table_name
+    )[0].columns
+    index_changes = []
+    for index_form in catalog_index.select(lambda r: r.table_name == table_name):
+        columns_indexes = [table_columns.index(c) for c in index_form.columns]
+
+        def get_key(tup):
+            return tuple(tup[i] for i in columns_indexes)
+
+        # 顺便清理掉索引中可能残留的、指向死元组的 location
+        deletes = [(get_key(tup), location) for location, tup in dead_tuples]
+        deletes += [(get_key(tup), old_location) for old_location, _, tup in moved_tuples]
+        inserts = [(get_key(tup), new_location) for _, new_location, tup in moved_tuples]
+        index_changes.append((index_form.index_name, deletes, inserts))
+        transaction_mgr.redo_mgr.write(RedoRecord(
+            INVALID_XID, RedoAction.INDEX_REORGANIZE,
+            index_form.index_name, table_name, (deletes, inserts)
+        ))
+    if not index_changes:
+        return reclaimed
+
+    # 索引页是修改之后直接落盘的，所以，要先保证数据页整理的 redo log 以及
+    # 对索引的修正已经落盘了. 修正索引的过程中崩溃的话，恢复时会重新应用一遍
+    transaction_mgr.redo_mgr.flush()
+    for index_name, deletes, inserts in index_changes:
+        index_tuple_reorganize(index_name, deletes, inserts)
+    # 索引都已经落盘，恢复时不需要再修正了
+    transaction_mgr.redo_mgr.write(RedoRecord(
+        INVALID_XID, RedoAction.TABLE_REORGANIZE_END, table_name, None, b''
+    ))
+    return reclaimed
 
 
 def table_tuple_delete_multiple(table_name, locations):
+    # 注意：这里不能直接调用 table_tuple_reorganize(), 因为整理过程会改变其他
+    # 存活元组的 sid, 而当前的删除操作还处于事务之中，整理工作要交给
+    # VACUUM 或者 autovacuum 来做
     for location in locations:
         table_tuple_delete_one(table_name, location)
-    table_tuple_reorganize(table_name)
 
 
 def index_tuple_create(index_name, table_name, columns):
@@ -173,15 +347,15 @@ def index_tuple_create(index_name, table_name, columns):
     # 获取索引列的下标
     columns_indexes = [table_columns.index(c) for c in columns]
 
-    filename = get_index_filename(index_name)
-    tree = BPlusTree(filename)
+    relation = index_open(index_name)
+    tree = BPlusTree(relation.filename, relation=relation)
 
-    for location in table_tuple_get_all_locations(table_name):
-        tup = table_tuple_get_one(table_name, location)
-        key = BPlusTreeTuple(tuple(tup[i] for i in columns_indexes))
-        tree.insert(key, location)
+    # 与逐个插入相比，先排序，再自底向上地构建B+树，不需要查找叶子节点，
+    # 也不会发生分裂，每个节点都按照填充率装满
+    entries = scan_index_entries(table_name, columns_indexes)
+    tree.bulk_load(sort_index_entries(entries))
 
-    tree.serialize()
+    write_back_index(tree)
 
 
 def range_compare(value, start, end):
@@ -199,8 +373,7 @@ def index_tuple_get_range_locations(index_name, start=float('-inf'), end=float('
     """start, end 两个参数，是用来指定扫描索引中部分数据的，如果不给这两个参数赋值，
     那么，就默认拿这个索引中的全部数据.
     """
-    filename = get_index_filename(index_name)
-    tree = BPlusTree(filename, load_root_node(filename))
+    tree = index_tree_open(index_name)
     for location in tree.find_range(start, end):
         yield location
 
@@ -217,8 +390,7 @@ def index_tuple_get_range(index_name, start=None, end=None):
 
 
 def index_tuple_get_equal_value_locations(index_name, equal_value):
-    filename = get_index_filename(index_name)
-    tree = BPlusTree(filename, load_root_node(filename))
+    tree = index_tree_open(index_name)
     for location in tree.find(equal_value):
         yield location
 
@@ -231,8 +403,7 @@ def index_tuple_get_equal_value(index_name, equal_value):
 
 
 def covered_index_tuple_get_range(index_name, start=float('-inf'), end=float('inf')):
-    filename = get_index_filename(index_name)
-    tree = BPlusTree(filename, load_root_node(filename))
+    tree = index_tree_open(index_name)
     for key in tree.find_range(start, end, return_keys=True):
         # key 的数据类型是 BPlusTreeTuple
         yield key.tup
@@ -244,9 +415,8 @@ def covered_index_tuple_get_equal_value(index_name, equal_value):
 
 
 def index_tuple_insert_one(index_name, key, value):
-    filename = get_index_filename(index_name)
     xid = transaction_mgr.session_xid()
-    tree = BPlusTree(filename, load_root_node(filename))
+    tree = index_tree_open(index_name)
     tree.insert(BPlusTreeTuple(key), value)
 
     # 这个key的数据类型并不是字节集合，但是不影响其的序列化过程，
@@ -257,15 +427,13 @@ def index_tuple_insert_one(index_name, key, value):
         key
     ))
 
-    # todo: LSN
-    tree.serialize()
+    write_back_index(tree)
 
 
 def index_tuple_delete_one(index_name, key, location=None):
-    filename = get_index_filename(index_name)
     xid = transaction_mgr.session_xid()
 
-    tree = BPlusTree(filename, load_root_node(filename))
+    tree = index_tree_open(index_name)
     old_locations = tree.find(key)
     tree.delete(key, location)
 
@@ -277,8 +445,7 @@ def index_tuple_delete_one(index_name, key, location=None):
             key
         ))
 
-    # todo: LSN
-    tree.serialize()
+    write_back_index(tree)
 
 
 def index_tuple_update_one(index_name, key, old_value, value):
@@ -0,0 +1,170 @@
+import atexit
+import mmap
+import os
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from imoocdb.errors import FileReadError
+
+# 同时打开的文件描述符的上限，类似于 Postgres 中的 max_files_per_process
+MAX_OPEN_FILES = 64
+# 是否通过 mmap 来读取数据文件. 打开之后，读到的是指向 mmap 区域的 memoryview,
+# 反序列化时直接从中解析，省去了 pread 时 8kb 的内存分配与拷贝，
+# 适合大量只读扫描的场景
+MMAP_READ = False
+# 一次 pwritev 最多能提交的 buffer 数量
+try:
+    IOV_MAX = os.sysconf('SC_IOV_MAX')
+except (AttributeError, ValueError, OSError):
+    IOV_MAX = 1024
+
+
+class FileDescriptorManager:
+    """类似于 Postgres 中的 VFD (virtual file descriptor):
+    为每个文件保持一个打开的 fd, 避免每次读写数据页都要 open + seek + close.
+    打开的 fd 数量超过上限时，按照 LRU 的方式关闭最久没有使用的 fd.
+    self.mutex 只保护 fd 的查找、打开与关闭，真正的读写与 fsync 在锁外面进行,
+    期间 fd 被 pin 住 (引用计数), 不会被关闭，这样不同的线程可以同时读写"""
+
+    def __init__(self, max_open_files=MAX_OPEN_FILES, use_mmap=MMAP_READ):
+        self.max_open_files = max_open_files
+        self.use_mmap = use_mmap
+        # filename -> fd, 按照最近使用的顺序排列
+        self.fds = OrderedDict()
+        # filename -> mmap 对象
+        self.maps = {}
+        # fd -> 正在使用它的线程数量
+        self.pins = {}
+        # 被 close() 时还在使用中的 fd, 最后一个使用者用完之后再关闭
+        self.closing = set()
+        self.mutex = threading.Lock()
+
+    def _get_fd(self, filename):
+        # 调用者需要持有 self.mutex
+        fd = self.fds.get(filename)
+        if fd is not None:
+            self.fds.move_to_end(filename)
+            return fd
+        fd = os.open(filename, os.O_RDWR | os.O_CREAT, 0o644)
+        self.fds[filename] = fd
+        while len(self.fds) > self.max_open_files:
+            # 跳过正在使用中的 fd; 都在使用中的话，暂时超过上限
+            evicted_filename = next((name for name, evicted_fd in self.fds.items()
+                                     if name != filename and evicted_fd not in self.pins), None)
+            if evicted_filename is None:
+                break
+            evicted_fd = self.fds.pop(evicted_filename)
+            self.maps.pop(evicted_filename, None)
+            os.close(evicted_fd)
+        return fd
+
+    def _pin(self, filename):
+        # 调用者需要持有 self.mutex
+        fd = self._get_fd(filename)
+        self.pins[fd] = self.pins.get(fd, 0) + 1
+        return fd
+
+    def _unpin(self, fd):
+        with self.mutex:
+            self.pins[fd] -= 1
+            if self.pins[fd] == 0:
+                del self.pins[fd]
+                if fd in self.closing:
+                    self.closing.discard(fd)
+                    os.close(fd)
+
+    def _close_fd(self, fd):
+        # 调用者需要持有 self.mutex
+        if fd in self.pins:
+            self.closing.add(fd)
+        else:
+            os.close(fd)
+
+    @contextmanager
+    def _pinned_fd(self, filename):
+        with self.mutex:
+            fd = self._pin(filename)
+        try:
+            yield fd
+        finally:
+            self._unpin(fd)
+
+    def _get_map(self, filename, end):
+        # 调用者需要持有 self.mutex
+        fd = self._get_fd(filename)
+        m = self.maps.get(filename)
+        if m is None or len(m) < end:
+            # 文件变大了 (例如 checkpoint 写入了新的数据页), 需要重新映射.
+            # 旧的 mmap 不能主动 close, 因为外面可能还有指向它的 memoryview,
+            # 交给垃圾回收即可
+            size = os.fstat(fd).st_size
+            if size == 0:
+                return None
+            m = mmap.mmap(fd, size, access=mmap.ACCESS_READ)
+            self.maps[filename] = m
+        return m
+
+    def read(self, filename, offset, size):
+        """读取 [offset, offset + size) 的内容. mmap 模式下返回的是 memoryview,
+        调用者不要长期持有它. 读到文件末尾之后时，两种模式都抛出 FileReadError"""
+        if self.use_mmap:
+            # mmap 对象持有自己的 fd, 映射好之后，读取就不需要再持有锁了
+            with self.mutex:
+                m = self._get_map(filename, offset + size)
+            buff = b'' if m is None else memoryview(m)[offset: offset + size]
+        else:
+            # pread/pwrite 不依赖也不改变文件的偏移量，不需要再 seek,
+            # 多个线程可以同时使用同一个 fd
+            with self._pinned_fd(filename) as fd:
+                buff = os.pread(fd, size, offset)
+        # 读出来的内容不完整，说明数据页还没有落盘或者文件被截断了，
+        # 不能把半个数据页交给调用者去解析
+        if len(buff) != size:
+            raise FileReadError(f'read {len(buff)} bytes from {filename} at offset {offset}, '
+                                f'expected {size}.')
+        return buff
+
+    def write(self, filename, offset, data):
+        with self._pinned_fd(filename) as fd:
+            written = os.pwrite(fd, data, offset)
+        assert written == len(data)
+
+    def writev(self, filename, offset, buffers):
+        """把多个 buffer 从 offset 开始连续地写入文件，只需要一次系统调用"""
+        with self._pinned_fd(filename) as fd:
+            for i in range(0, len(buffers), IOV_MAX):
+                chunk = buffers[i: i + IOV_MAX]
+                size = sum(len(buff) for buff in chunk)
+                if hasattr(os, 'pwritev'):
+                    written = os.pwritev(fd, chunk, offset)
+                else:
+                    written = os.pwrite(fd, b''.join(chunk), offset)
+                assert written == size
+                offset += size
+
+    def fsync(self, filename):
+        # fsync 可能很慢，不能持有锁，否则其他文件的读写都要等它
+        with self._pinned_fd(filename) as fd:
+            os.fsync(fd)
+
+    def close(self, filename):
+        with self.mutex:
+            self.maps.pop(filename, None)
+            fd = self.fds.pop(filename, None)
+            if fd is not None:
+                self._close_fd(fd)
+
+    def close_all(self):
+        with self.mutex:
+            self.maps.clear()
+            for fd in self.fds.values():
+                self._close_fd(fd)
+            self.fds.clear()
+
+    def __len__(self):
+        return len(self.fds)
+
+
+fd_mgr = FileDescriptorManager()
+atexit.register(fd_mgr.close_all)
@@ -0,0 +1,105 @@
+import os
+
+from imoocdb.storage.common import get_fsm_filename
+from imoocdb.storage.slotted_page import PAGE_SIZE
+
+# 类似于 Postgres 的 free space map, 每个数据页的空闲空间只用 1 个字节来记录，
+# 称为 category. 这样，空闲空间只能精确到 FSM_CATEGORY_STEP 个字节，
+# 但是 fsm 文件会非常小 (每个数据页只占用 1 个字节)
+FSM_CATEGORIES = 256
+FSM_CATEGORY_STEP = PAGE_SIZE // FSM_CATEGORIES
+
+
+def space_to_category(space):
+    # 向下取整，保证记录下来的空闲空间只会比真实的少，不会比真实的多
+    return max(min(space // FSM_CATEGORY_STEP, FSM_CATEGORIES - 1), 0)
+
+
+def size_to_category(size):
+    # 向上取整，找到的数据页的空闲空间一定不少于 size
+    return (size + FSM_CATEGORY_STEP - 1) // FSM_CATEGORY_STEP
+
+
+class FreeSpaceMap:
+    def __init__(self, filename=None):
+        self.filename = filename
+        # 下标是 pageno, 值是该页的 category
+        self.categories = bytearray()
+        # 倒排：category -> 处于该 category 的 pageno 集合，
+        # 这样，寻找有足够空间的数据页时，最多只需要遍历 FSM_CATEGORIES 个桶，
+        # 与数据页的数量无关
+        self.buckets = [set() for _ in range(FSM_CATEGORIES)]
+        self.dirty = False
+
+    def __len__(self):
+        return len(self.categories)
+
+    def update(self, pageno, free_space):
+        category = space_to_category(free_space)
+        if pageno >= len(self.categories):
+            self.categories.extend(bytes(pageno + 1 - len(self.categories)))
+        old_category = self.categories[pageno]
+        if old_category == category and pageno in self.buckets[category]:
+            return
+        self.buckets[old_category].discard(pageno)
+        self.categories[pageno] = category
+        # category 为 0 的数据页，任何 record 都放不下了，不需要被找到
+        if category > 0:
+            self.buckets[category].add(pageno)
+        self.dirty = True
+
+    def get(self, pageno):
+        if pageno >= len(self.categories):
+            return 0
+        return self.categories[pageno] * FSM_CATEGORY_STEP
+
+    def search(self, size):
+        """返回一个至少有 size 个字节空闲空间的数据页，找不到则返回 -1"""
+        # 从空闲空间最多的桶开始找，这样新元组更倾向于放到比较空的页里面，
+        # 可以减少后续插入时 fsm 中 category 的频繁变化
+        for category in range(FSM_CATEGORIES - 1,
+                              size_to_category(size) - 1, -1):
+            if self.buckets[category]:
+                return next(iter(self.buckets[category]))
+        return -1
+
+    def serialize(self) -> bytes:
+        return bytes(self.categories)
+
+    @staticmethod
+    def deserialize(buff, filename=None) -> "FreeSpaceMap":
+        fsm = FreeSpaceMap(filename)
+        fsm.categories = bytearray(buff)
+        for pageno, category in enumerate(fsm.categories):
+            if category > 0:
+                fsm.buckets[category].add(pageno)
+        return fsm
+
+
+class FreeSpaceMapManager:
+    def __init__(self):
+        self.maps = {}
+
+    def get(self, relation) -> FreeSpaceMap:
+        if relation not in self.maps:
+            filename = get_fsm_filename(relation)
+            if os.path.exists(filename):
+                with open(filename, 'rb') as f:
+                    self.maps[relation] = FreeSpaceMap.deserialize(f.read(), filename)
+            else:
+                self.maps[relation] = FreeSpaceMap(filename)
+        return self.maps[relation]
+
+    def sync(self):
+        # fsm 只是一个提示信息，不需要写 redo log, 即使丢失或者不准确，
+        # 也只会导致空间利用率下降，不会导致数据错误
+        for relation, fsm in self.maps.items():
+            if not fsm.dirty:
+                continue
+            with open(fsm.filename, 'w+b') as f:
+                f.write(fsm.serialize())
+                os.fsync(f.fileno())
+            fsm.dirty = False
+
+
+free_space_map_mgr = FreeSpaceMapManager()
@@ -0,0 +1,127 @@
+import heapq
+import os
+import pickle
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+from imoocdb.constant import TEMP_DIRECTORY
+from imoocdb.storage.bplus_tree import BPlusTreeTuple
+from imoocdb.storage.common import table_tuple_get_pages, table_tuple_pinned_page, table_row_codec
+from imoocdb.storage.lru import buffer_pool, BAS_BULKREAD
+from imoocdb.storage.row import RowCodec
+from imoocdb.storage.slotted_page import Page
+
+# 下述参数参考了 Postgres 中 CREATE INDEX 的相关参数
+# 排序时最多使用的内存 (按照 index_entry_size() 估算), 超过之后把排好序的部分写到临时文件中,
+# 最后再进行多路归并, unit: byte
+MAINTENANCE_WORK_MEM = 64 * 1024 * 1024
+# 估算内存时，每个 (key, location) 固定部分的大小: 外层 tuple、BPlusTreeTuple、
+# location 以及其中的整数对象, unit: byte
+INDEX_ENTRY_OVERHEAD = 160
+# 提取 key 的工作进程数量，0 表示不使用多进程
+INDEX_BUILD_WORKERS = 0
+# 表的数据页数量超过该值时，才使用多进程提取 key, 否则进程间传递数据页的开销更大
+INDEX_BUILD_PARALLEL_MIN_PAGES = 64
+
+
+def page_index_entries(page, pageno, codec, columns_indexes):
+    """提取一个数据页中每个元组的 (key, location). 只解码索引列，不需要解码整个元组"""
+    return [(BPlusTreeTuple(tuple(codec.decode_column(view, i) for i in columns_indexes)),
+             (pageno, sid))
+            for sid, view in page.iter_record_views()]
+
+
+def _extract_page_entries(args):
+    # 在工作进程中执行. 工作进程看不到 buffer pool, 数据页是序列化之后传过来的
+    pageno, image, types, columns_indexes = args
+    return page_index_entries(Page.deserialize(image), pageno, RowCodec(types), columns_indexes)
+
+
+def scan_index_entries(table_name, columns_indexes, workers=None):
+    """按照表的顺序，返回每个元组的 (key, location)"""
+    if workers is None:
+        workers = INDEX_BUILD_WORKERS
+    codec = table_row_codec(table_name)
+    pages = table_tuple_get_pages(table_name)
+    strategy = None
+    if pages > buffer_pool.capacity // 4:
+        strategy = buffer_pool.get_access_strategy(BAS_BULKREAD)
+
+    if workers <= 0 or pages < INDEX_BUILD_PARALLEL_MIN_PAGES:
+        for pageno in range(pages):
+            with table_tuple_pinned_page(table_name, pageno, strategy) as page:
+                entries = page_index_entries(page, pageno, codec, columns_indexes)
+            yield from entries
+        return
+
+    def page_images():
+        for pageno in range(pages):
+            with table_tuple_pinned_page(table_name, pageno, strategy) as page:
+                image = page.serialize()
+            yield pageno, image, codec.types, columns_indexes
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        # map() 返回的结果与提交的顺序一致，所以仍然是表的顺序
+        for entries in executor.map(_extract_page_entries, page_images(), chunksize=16):
+            yield from entries
+
+
+def _read_run(f):
+    f.seek(0)
+    while True:
+        try:
+            yield pickle.load(f)
+        except EOFError:
+            return
+
+
+def index_entry_size(entry):
+    """估算一个 (key, location) 占用的内存. 只是用来决定什么时候写出一个 run,
+    不需要很精确，不要对每一项都序列化一次，那样比排序本身还要慢"""
+    size = INDEX_ENTRY_OVERHEAD
+    for value in entry[0].tup:
+        if type(value) is str or type(value) is bytes:
+            size += len(value) + 8
+        else:
+            size += 8
+    return size
+
+
+def _sort_key(entry):
+    return entry[0].sort_key
+
+
+def sort_index_entries(entries, work_mem=None):
+    """对 (key, location) 按照 key 排序. 超过 work_mem 时使用外排序：每攒够 work_mem
+    就排序之后写到一个临时文件中 (一个 run), 最后对所有的 run 进行多路归并.
+    排序是稳定的，相同 key 的元组仍然按照表的顺序排列"""
+    if work_mem is None:
+        work_mem = MAINTENANCE_WORK_MEM
+    if not os.path.exists(TEMP_DIRECTORY):
+        os.mkdir(TEMP_DIRECTORY)
+
+    runs = []
+    buffer = []
+    used = 0
+    try:
+        for entry in entries:
+            buffer.append(entry)
+            used += index_entry_size(entry)
+            if used >= work_mem:
+                buffer.sort(key=_sort_key)
+                # 临时文件关闭之后会被自动删除
+                f = tempfile.TemporaryFile(dir=TEMP_DIRECTORY, prefix='index_build_')
+                runs.append(f)
+                for item in buffer:
+                    pickle.dump(item, f)
+                buffer = []
+                used = 0
+        buffer.sort(key=_sort_key)
+        if not runs:
+            yield from buffer
+            return
+        # heapq.merge 遇到相同的 key 时，先返回排在前面的 run 中的，所以也是稳定的
+        yield from heapq.merge(*(_read_run(f) for f in runs), buffer, key=_sort_key)
+    finally:
+        for f in runs:
+            f.close()
@@ -64,6 +64,11 @@ class LockManager:
             raise LockConflictError(f'lock conflicts while {xid} '
                                     f'wants to get {resource} with {mode}.')
 
+    def try_acquire_lock(self, resource, xid, mode) -> bool:
+        """只尝试一次，加锁失败时直接返回 False, 不会等待. 给后台线程使用"""
+        assert mode in ('x', 's')
+        return self._acquire_lock(resource, xid, mode)
+
     def release_lock(self, resource, xid):
         with self.lock_mutex:
             if resource in self.locks and xid in self.locks[resource]['holders']:
@@ -1,9 +1,37 @@
+import atexit
+import logging
+import threading
+from collections import deque
+from contextlib import contextmanager
+
 from imoocdb.errors import LRUError
+from imoocdb.storage.relation import relation_cache
+from imoocdb.storage.replacement import ReplacementPolicy, ClockCache, TwoQueueCache, LRUKCache
+from imoocdb.storage.slotted_page import PAGE_SIZE
 
-# 理论上，当前数据库的内存使用，大约就应该是：
-# PAGE_SIZE * LRU_CAPACITY + 小部分其他开销 = 数据库进程总使用内存
-# innodb_buffer_pool_size, shared_buffers
 LRU_CAPACITY = 100
+# buffer pool 的大小，单位是字节，类似于 innodb_buffer_pool_size, shared_buffers.
+# 当前数据库的内存使用，大约就应该是：
+# BUFFER_POOL_SIZE + 小部分其他开销 = 数据库进程总使用内存
+BUFFER_POOL_SIZE = LRU_CAPACITY * PAGE_SIZE
+# buffer pool 的分区数量，类似于 Postgres 中的 NUM_BUFFER_PARTITIONS.
+# 每个分区有自己的锁，访问不同分区的线程之间不会互相阻塞
+BUFFER_POOL_PARTITIONS = 16
+# buffer pool 的页面置换策略，可选的取值见 REPLACEMENT_POLICIES
+BUFFER_POOL_POLICY = 'clock'
+
+# 类似于 Postgres 中的 BufferAccessStrategy:
+# 大表的顺序扫描、批量写入以及 vacuum 只在一个很小的环 (ring) 中循环使用数据页，
+# 不会把 buffer pool 中的热点数据页挤出去. 下面是每种策略的环的大小，单位是字节，
+# 同时不超过 buffer pool 的 1/8
+BAS_BULKREAD = 'bulkread'
+BAS_BULKWRITE = 'bulkwrite'
+BAS_VACUUM = 'vacuum'
+RING_SIZES = {
+    BAS_BULKREAD: 256 * 1024,
+    BAS_BULKWRITE: 16 * 1024 * 1024,
+    BAS_VACUUM: 256 * 1024,
+}
 
 
 class LRUNode:
@@ -14,9 +42,13 @@ class LRUNode:
         self.next = None
 
         # 额外的字段
-        # 用于判断当前 node 是否被上层业务代码使用
-        # 如果被显性pinned, 那么就意味着，该节点暂时还不能剔除（淘汰）
-        self.pinned = False
+        # 当前 node 被上层业务代码使用 (pin) 的次数.
+        # 只要还有人在使用，该节点就暂时还不能剔除（淘汰）
+        self.pin_count = 0
+
+    @property
+    def pinned(self):
+        return self.pin_count > 0
 
     def __repr__(self):
         return f'{self.key}:{self.value}'
@@ -30,14 +62,13 @@ class LRUNode:
         return hash(self.key)
 
 
-# todo: 当前LRU不是线程安全的，这在面对多个线程的时候，要加锁
-class LRUCache:
-    def __init__(self, capacity=LRU_CAPACITY):
-        self.capacity = capacity
-        self.cache = {}
-        # 我们做一个小优化：
-        # 先把被淘汰的数据暂存在这里 evicted
-        self.evicted = {}
+# 注意：LRUCache 本身不是线程安全的, BufferPool 中由每个分区各自的锁来保护
+class LRUCache(ReplacementPolicy):
+    """被 pin 住的节点会从链表中摘下来，unpin 之后再放回到最近访问的位置.
+    这样，淘汰的时候链表头部的节点一定是可以淘汰的，不需要跳过被 pin 住的节点"""
+
+    def __init__(self, capacity=LRU_CAPACITY, on_evict=None):
+        super().__init__(capacity, on_evict)
 
         # LRU中的链表, 这里面我们实现的是双向链表
         # dummy node 技巧!! 可以帮我们少写很多边界条件的判断逻辑
@@ -47,21 +78,31 @@ class LRUCache:
         self.head.next = self.tail
         self.tail.prev = self.head
 
-    def put(self, key, value):
-        if key in self.cache:
+    def put(self, key, value, cold=False):
+        node = self.cache.get(key)
+        if node is not None:
             # 此时，相当于访问LRU中已经存在的一个节点
             # 需要把这个节点提取到最前面的位置
-            self._remove(self.cache[key])
+            node.value = value
+            if not node.pinned:
+                self._remove(node)
+                self._add(node)
+            return
 
         node = LRUNode(key, value)
         self.cache[key] = node
-        self._add(node)
+        if cold:
+            # 直接放在最先被淘汰的位置上
+            self._add_first(node)
+        else:
+            self._add(node)
 
         # 开始进行淘汰判断，即超过capacity上限，需要从头部head进行剔除
-        if len(self.cache) > self.capacity:
+        while len(self.cache) > self.capacity:
             # 大于就要进行淘汰
             evicted_node = self.head.next
-            while evicted_node and evicted_node.pinned:
+            # 刚刚放入的新节点不能被淘汰
+            if evicted_node is node:
                 evicted_node = evicted_node.next
 
             if evicted_node is self.tail:
@@ -69,20 +110,40 @@ class LRUCache:
                 self._remove(node)
                 del self.cache[key]
                 raise LRUError('no available space for current node.')
+            try:
+                self._evict(evicted_node)
+            except Exception:
+                self._remove(node)
+                del self.cache[key]
+                raise
             self._remove(evicted_node)
             del self.cache[evicted_node.key]
-            self.evicted[evicted_node.key] = evicted_node.value
 
     def get(self, key):
         if key in self.cache:
             node = self.cache[key]
             # 下面一个删除 + 一个添加节点，就可以实现
-            # 该节点的位置调整
-            self._remove(node)
-            self._add(node)
+            # 该节点的位置调整. 被 pin 住的节点不在链表中
+            if not node.pinned:
+                self._remove(node)
+                self._add(node)
+            self.hits += 1
             return node.value
+        self.misses += 1
         return None
 
+    def pin(self, key):
+        node = super().pin(key)
+        if node.pin_count == 1:
+            self._remove(node)
+        return node
+
+    def unpin(self, key):
+        node = super().unpin(key)
+        if node.pin_count == 0:
+            self._add(node)
+        return node
+
     def _add(self, node):
         # 新节点从尾部进行插入，旧节点从头部剔除
         prev_node = self.tail.prev
@@ -92,6 +153,18 @@ class LRUCache:
 
         self.tail.prev = node
 
+    def _add_first(self, node):
+        next_node = self.head.next
+        self.head.next = node
+        node.prev = self.head
+        node.next = next_node
+        next_node.prev = node
+
+    def remove(self, key):
+        node = self.cache.pop(key)
+        if not node.pinned:
+            self._remove(node)
+
     @staticmethod
     def _remove(node: LRUNode):
         # 这就是为什么我们在LRU中必须实现双向链表的原因
@@ -100,15 +173,15 @@ class LRUCache:
         prev_node.next = next_node
         next_node.prev = prev_node
 
-    def pin(self, key):
-        if key not in self.cache:
-            raise LRUError(f'not found key {key}')
-        self.cache[key].pinned = True
-
-    def unpin(self, key):
-        if key not in self.cache:
-            raise LRUError(f'not found key {key}')
-        self.cache[key].pinned = False
+    def tail_keys(self, n):
+        """返回最久没有被访问的 n 个没有被 pin 住的 key, 也就是最先会被淘汰的那些"""
+        keys = []
+        node = self.head.next
+        while node is not None and node is not self.tail and len(keys) < n:
+            if not node.pinned:
+                keys.append(node.key)
+            node = node.next
+        return keys
 
     def items(self):
         # 思考：如果想遍历当前LRU中的所有元素，应该
@@ -116,41 +189,323 @@ class LRUCache:
         pass
 
 
-class BufferPool:
-    def __init__(self, buffer_size=LRU_CAPACITY):
-        self.lru_cache = LRUCache(buffer_size)
+REPLACEMENT_POLICIES = {
+    'lru': LRUCache,
+    'clock': ClockCache,
+    '2q': TwoQueueCache,
+    'lru-k': LRUKCache,
+}
+
+
+class BufferPartition:
+    """buffer pool 中的一个分区，有自己的锁、置换策略以及脏页集合"""
+
+    def __init__(self, pool, capacity, policy):
+        self.pool = pool
+        self.replacer = REPLACEMENT_POLICIES[policy](capacity, on_evict=self.evict)
         self.dirty_pages = set()
+        # 保护 replacer 与 dirty_pages
+        self.mutex = threading.RLock()
+        # key -> threading.Event, 正在从磁盘加载的数据页
+        self.loading = {}
+
+    def evict(self, key, page):
+        # 调用者持有 self.mutex
+        if key in self.dirty_pages:
+            with self.pool.flush_mutex:
+                # 拿到锁之后再判断一次，可能已经被 checkpoint 或者 bgwriter 写出了
+                if key in self.dirty_pages:
+                    if self.pool.page_writer is None:
+                        raise LRUError(f'cannot write back dirty page {key}')
+                    self.pool.page_writer(key, page)
+                    self.dirty_pages.discard(key)
+        relation_cache.page_evicted(key)
+
+    def put(self, key, page, dirty, cold=False):
+        # 调用者持有 self.mutex
+        self.replacer.put(key, page, cold)
+        if dirty:
+            self.dirty_pages.add(key)
+        relation_cache.page_loaded(key)
+
+
+class BufferAccessStrategy:
+    """记录通过该策略加载进来的数据页，超过环的大小之后，
+    把最早加载的数据页从 buffer pool 中移除 (脏页先写回磁盘).
+    通过该策略加载的数据页以 cold 的方式放入 buffer pool, 命中时也不会提升它们的位置.
+    一个 strategy 对象只给一次扫描/批量操作使用，不需要加锁"""
+
+    def __init__(self, pool, kind):
+        self.pool = pool
+        self.kind = kind
+        self.ring_size = max(min(RING_SIZES[kind] // PAGE_SIZE, pool.capacity // 8), 1)
+        self.ring = deque()
+
+    def add(self, key):
+        self.ring.append(key)
+        while len(self.ring) > self.ring_size:
+            self.pool.discard(self.ring.popleft())
+
+
+class BufferPool:
+    """buffer_size 的单位是字节，按照数据页的大小折算成能容纳的数据页数量.
+    数据页被淘汰时，脏页先写回磁盘 (write-back), 干净的数据页直接丢弃，
+    这样 buffer pool 占用的内存才是有上限的.
+
+    数据页按照 (relation, pageno) 的哈希值分散到若干个分区中，
+    每个分区单独加锁，多个会话同时访问 buffer pool 时，只有落在同一个分区上才会竞争.
+    注意：peek(), dirty_pages 等只读操作不加分区锁，依赖 GIL 保证 dict/set
+    单次操作的原子性. 这样 checkpoint 与 bgwriter 在持有 flush_mutex 时
+    就不会再去获取分区锁，而淘汰脏页时是先持有分区锁再获取 flush_mutex 的，
+    二者不会死锁.
+
+    持有数据页的引用期间，要通过 pinned() 把数据页 pin 住，否则它可能被淘汰，
+    之后对这个引用的修改就丢失了::
+
+        with buffer_pool.pinned(key) as page:
+            ...
+
+    与 Postgres 中的 PrivateRefCount 类似，每个线程单独记录自己 pin 住的数据页，
+    事务结束时以及 close() 时检查是否有没有释放的 pin"""
+
+    def __init__(self, buffer_size=BUFFER_POOL_SIZE, partitions=BUFFER_POOL_PARTITIONS,
+                 policy=BUFFER_POOL_POLICY):
+        if policy not in REPLACEMENT_POLICIES:
+            raise LRUError(f'unknown replacement policy {policy}')
+        self.buffer_size = buffer_size
+        self.policy = policy
+        capacity = max(buffer_size // PAGE_SIZE, 1)
+        partitions = min(partitions, capacity)
+        # 容量尽量平均地分配给每个分区
+        self.partitions = [
+            BufferPartition(self, capacity // partitions + (1 if i < capacity % partitions else 0),
+                            policy)
+            for i in range(partitions)
+        ]
+        # checkpoint, bgwriter 以及淘汰脏页时都会把脏页写到磁盘上，
+        # 它们之间不能同时进行
+        self.flush_mutex = threading.RLock()
+        # 把一个脏页写回磁盘的函数，参数是 key 与 page.
+        # 需要先刷 redo log (WAL), 由事务模块注册进来，避免循环引用
+        self.page_writer = None
+        # 每个线程 pin 住的数据页, key -> 次数
+        self.thread_local = threading.local()
+
+    def set_page_writer(self, page_writer):
+        self.page_writer = page_writer
+
+    def _partition(self, key) -> BufferPartition:
+        return self.partitions[hash(key) % len(self.partitions)]
+
+    @property
+    def capacity(self):
+        return sum(partition.replacer.capacity for partition in self.partitions)
+
+    @property
+    def dirty_pages(self):
+        """所有分区中脏页的快照"""
+        dirty_pages = set()
+        for partition in self.partitions:
+            dirty_pages.update(list(partition.dirty_pages))
+        return dirty_pages
+
+    def get_access_strategy(self, kind) -> BufferAccessStrategy:
+        return BufferAccessStrategy(self, kind)
+
+    def _private_pins(self) -> dict:
+        pins = getattr(self.thread_local, 'pins', None)
+        if pins is None:
+            pins = self.thread_local.pins = {}
+        return pins
+
+    def _pin(self, partition, key):
+        # 调用者持有 partition.mutex
+        node = partition.replacer.pin(key)
+        pins = self._private_pins()
+        pins[key] = pins.get(key, 0) + 1
+        return node.value
+
+    def pin(self, key):
+        """pin 住一个已经在 buffer pool 中的数据页，返回该数据页"""
+        partition = self._partition(key)
+        with partition.mutex:
+            return self._pin(partition, key)
+
+    def unpin(self, key):
+        pins = self._private_pins()
+        if pins.get(key, 0) <= 0:
+            # 已经被泄漏检查释放掉了
+            return
+        pins[key] -= 1
+        if pins[key] == 0:
+            del pins[key]
+        partition = self._partition(key)
+        with partition.mutex:
+            node = partition.replacer.cache.get(key)
+            if node is not None and node.pinned:
+                partition.replacer.unpin(key)
+
+    @contextmanager
+    def pinned(self, key, loader=None, dirty=False, strategy=None):
+        """在 with 语句块中 pin 住数据页，离开时自动 unpin.
+        指定了 loader 时，数据页不在 buffer pool 中就先加载进来，参数同 get_or_load()"""
+        if loader is None:
+            page = self.pin(key)
+        else:
+            page = self.get_or_load(key, loader, dirty, strategy, pin=True)
+        try:
+            yield page
+        finally:
+            self.unpin(key)
+
+    def check_pin_leaks(self):
+        """检查当前线程是否还有没有释放的 pin, 有的话释放掉并告警.
+        返回泄漏的数据页"""
+        pins = self._private_pins()
+        leaked = sorted(pins)
+        for key in leaked:
+            logging.warning('buffer pin leak: %s, pin count %d', key, pins[key])
+            partition = self._partition(key)
+            with partition.mutex:
+                node = partition.replacer.cache.get(key)
+                for _ in range(min(pins[key], node.pin_count if node else 0)):
+                    partition.replacer.unpin(key)
+        pins.clear()
+        return leaked
+
+    def close(self):
+        """检查所有线程是否还有没有释放的 pin, 返回泄漏的数据页"""
+        leaked = self.check_pin_leaks()
+        for partition in self.partitions:
+            with partition.mutex:
+                for key, node in list(partition.replacer.cache.items()):
+                    if not node.pinned:
+                        continue
+                    logging.warning('buffer pin leak: %s, pin count %d', key, node.pin_count)
+                    leaked.append(key)
+                    while node.pinned:
+                        partition.replacer.unpin(key)
+        return leaked
+
+    def get_or_load(self, key, loader, dirty=False, strategy=None, pin=False):
+        """获取数据页，不在 buffer pool 中时调用 loader() 加载.
+        多个线程同时加载同一个数据页时，只有一个线程会真正调用 loader(),
+        其他线程等待它加载完成. 加载的过程中不持有分区锁，不会阻塞该分区上的其他数据页.
+        指定了 strategy 时，数据页通过 strategy 的环来加载，见 BufferAccessStrategy.
+        pin 为 True 时，返回之前就把数据页 pin 住，调用者需要负责 unpin"""
+        partition = self._partition(key)
+        while True:
+            with partition.mutex:
+                if strategy is None:
+                    page = partition.replacer.get(key)
+                else:
+                    page = partition.replacer.probe(key)
+                if page is not None:
+                    if pin:
+                        self._pin(partition, key)
+                    return page
+                event = partition.loading.get(key)
+                if event is None:
+                    event = threading.Event()
+                    partition.loading[key] = event
+                    break
+            # 别的线程正在加载，等它加载完之后再重新查找
+            event.wait()
+
+        try:
+            page = loader()
+            with partition.mutex:
+                partition.put(key, page, dirty, cold=strategy is not None)
+                if pin:
+                    self._pin(partition, key)
+        finally:
+            with partition.mutex:
+                del partition.loading[key]
+            event.set()
+        # 不能在持有分区锁的时候调用，环中的数据页可能在其他分区
+        if strategy is not None:
+            strategy.add(key)
+        return page
+
+    def discard(self, key):
+        """把数据页从 buffer pool 中移除，脏页先写回磁盘. 被 pin 住的数据页不移除"""
+        partition = self._partition(key)
+        with partition.mutex:
+            node = partition.replacer.cache.get(key)
+            if node is None or node.pinned:
+                return False
+            partition.evict(key, node.value)
+            partition.replacer.remove(key)
+            return True
 
     def mark_dirty(self, key):
-        assert key in self.lru_cache.cache
-        self.dirty_pages.add(key)
+        partition = self._partition(key)
+        with partition.mutex:
+            assert key in partition.replacer.cache
+            partition.dirty_pages.add(key)
 
     def unmark_dirty(self, key):
-        self.dirty_pages.remove(key)
+        self._partition(key).dirty_pages.discard(key)
+
+    def is_dirty(self, key):
+        return key in self._partition(key).dirty_pages
+
+    def peek(self, key):
+        """获取数据页，但是不改变它在 LRU 中的位置"""
+        node = self._partition(key).replacer.cache.get(key)
+        if node is not None:
+            return node.value
+        return None
+
+    def tail_keys(self, n):
+        """每个分区中最先会被淘汰的数据页，一共大约 n 个.
+        需要获取分区锁，调用者不能持有 flush_mutex"""
+        per_partition = -(-n // len(self.partitions))
+        keys = []
+        for partition in self.partitions:
+            with partition.mutex:
+                keys += partition.replacer.tail_keys(per_partition)
+        return keys
+
+    def stats(self):
+        """所有分区的命中、未命中以及淘汰次数之和"""
+        stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+        for partition in self.partitions:
+            for name, value in partition.replacer.stats().items():
+                stats[name] += value
+        return stats
+
+    def dirty_ratio(self):
+        dirty = sum(len(partition.dirty_pages) for partition in self.partitions)
+        return dirty / self.capacity
 
     def get_all_dirty_pages(self):
         for key in sorted(self.dirty_pages):
-            if key in self.lru_cache.cache:
-                yield key, self.lru_cache.get(key)
-            elif key in self.lru_cache.evicted:
-                yield key, self.lru_cache.evicted[key]
-            else:
-                assert False
-
-    def find_max_pageno(self, relation_name):
-        result = list(sorted(filter(lambda t: t[0] == relation_name, self.dirty_pages)))
-        if len(result) == 0:
-            return -1
-        return result[-1][1]
+            page = self.peek(key)
+            # 遍历期间可能已经被淘汰并写回磁盘了
+            if page is not None:
+                yield key, page
 
     def __getitem__(self, item):
-        return self.lru_cache.get(item)
+        partition = self._partition(item)
+        with partition.mutex:
+            return partition.replacer.get(item)
+
+    def put(self, key, page, dirty=False):
+        """放入 (或者替换) 数据页. dirty 为 True 时同时标记为脏页"""
+        partition = self._partition(key)
+        with partition.mutex:
+            partition.put(key, page, dirty)
 
     def __setitem__(self, key, value):
-        return self.lru_cache.put(key, value)
+        self.put(key, value)
 
     def __contains__(self, item):
-        return item in self.lru_cache.cache
+        return item in self._partition(item).replacer.cache
+
+    def __len__(self):
+        return sum(len(partition.replacer.cache) for partition in self.partitions)
 
 
 buffer_pool = BufferPool()
+atexit.register(buffer_pool.close)
@@ -0,0 +1,90 @@
+import os
+import threading
+
+from imoocdb.storage.slotted_page import PAGE_SIZE
+
+
+class RelationDescriptor:
+    """类似于 Postgres 中的 RelationData (relcache), 在内存中缓存一张表的元信息，
+    这样，查询表有多少个数据页时，就不需要每次都去 stat 数据文件了"""
+
+    def __init__(self, relation, filename, header_size=0, kind='table'):
+        self.relation = relation
+        self.filename = filename
+        # 'table' 或者 'index', 与锁资源 (kind, relation) 中的 kind 一致
+        self.kind = kind
+        # 数据文件开头的文件头长度，数据页从它后面开始存放. 表没有文件头，
+        # 索引文件的文件头中存放的是根节点的 pageno
+        self.header_size = header_size
+        # 已经落盘的数据页数量，只在第一次打开该表的时候 stat 一次文件
+        if os.path.exists(filename):
+            size = os.stat(filename).st_size - header_size
+            assert size % PAGE_SIZE == 0
+            self.disk_pages = size // PAGE_SIZE
+        else:
+            self.disk_pages = 0
+        # 累计写到磁盘上的数据页数量 (同一个数据页写多次，就统计多次)
+        self.synced_pages = 0
+        # 已经分配过的最大的 pageno, 新分配的数据页可能还没有落盘
+        self.max_pageno = -1
+        # 当前在 buffer pool 中的数据页
+        self.resident_pages = set()
+        # 根据表结构生成的元组编解码器，第一次用到的时候才创建
+        self.row_codec = None
+        # 索引的根节点所在的 pageno, 第一次用到的时候才读取文件头
+        self.root_pageno = None
+        # 索引的空闲页链表中第一个 pageno, 与 root_pageno 一起从文件头中读取
+        self.free_pageno = None
+
+    @property
+    def pages(self):
+        # pageno 从 0 开始，因此，衡量具体page数量的时候，要加1
+        return max(self.max_pageno + 1, self.disk_pages)
+
+
+class RelationCache:
+    def __init__(self):
+        self.descriptors = {}
+        self.mutex = threading.Lock()
+
+    def get(self, relation) -> RelationDescriptor:
+        return self.descriptors.get(relation)
+
+    def open(self, relation, filename, header_size=0, kind='table') -> RelationDescriptor:
+        descriptor = self.descriptors.get(relation)
+        if descriptor is None:
+            with self.mutex:
+                descriptor = self.descriptors.get(relation)
+                if descriptor is None:
+                    descriptor = RelationDescriptor(relation, filename, header_size, kind)
+                    self.descriptors[relation] = descriptor
+        return descriptor
+
+    def extend(self, relation, pageno):
+        """分配了一个新的数据页"""
+        descriptor = self.descriptors[relation]
+        with self.mutex:
+            descriptor.max_pageno = max(descriptor.max_pageno, pageno)
+
+    def pages_synced(self, relation, pagenos):
+        """checkpoint 或者 bgwriter 把 pagenos 这些数据页写到了磁盘上"""
+        descriptor = self.descriptors[relation]
+        with self.mutex:
+            # 文件的长度由写出的最大的 pageno 决定
+            descriptor.disk_pages = max(descriptor.disk_pages, max(pagenos) + 1)
+            descriptor.synced_pages += len(pagenos)
+
+    def page_loaded(self, key):
+        relation, pageno = key
+        descriptor = self.descriptors.get(relation)
+        if descriptor is not None:
+            descriptor.resident_pages.add(pageno)
+
+    def page_evicted(self, key):
+        relation, pageno = key
+        descriptor = self.descriptors.get(relation)
+        if descriptor is not None:
+            descriptor.resident_pages.discard(pageno)
+
+
+relation_cache = RelationCache()
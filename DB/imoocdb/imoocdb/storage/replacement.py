@@ -0,0 +1,412 @@
+import heapq
+import itertools
+from collections import OrderedDict, deque
+
+from imoocdb.errors import LRUError
+
+
+class ReplacementPolicy:
+    """buffer pool 的页面置换策略.
+    子类需要实现 get(), put(), remove() 与 tail_keys(), 并且用 self.cache 保存
+    key -> node 的映射, node 上至少要有 value, pin_count 与 pinned 三个属性.
+    put() 时 cold=True 表示该数据页只会被访问一次 (例如大表的顺序扫描),
+    不要把它当作热点，它应该最先被淘汰"""
+
+    def __init__(self, capacity, on_evict=None):
+        self.capacity = capacity
+        # 节点被淘汰时的回调，参数是被淘汰的 key 与 value.
+        # 回调抛出异常时，淘汰失败，节点仍然保留在缓存中
+        self.on_evict = on_evict
+        self.cache = {}
+        # 没有指定 on_evict 时，被淘汰的数据暂存在这里 evicted
+        self.evicted = {}
+        # 统计信息
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        raise NotImplementedError
+
+    def put(self, key, value, cold=False):
+        raise NotImplementedError
+
+    def remove(self, key):
+        """直接移除，不调用 on_evict"""
+        raise NotImplementedError
+
+    def probe(self, key):
+        """获取数据页，但是不把它当作一次访问，不影响淘汰的顺序"""
+        node = self.cache.get(key)
+        if node is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return node.value
+
+    def tail_keys(self, n):
+        """返回最先会被淘汰的 n 个 key"""
+        raise NotImplementedError
+
+    def _evict(self, node):
+        # 先回调，回调成功之后，调用者才能把节点移除
+        if self.on_evict:
+            self.on_evict(node.key, node.value)
+        else:
+            self.evicted[node.key] = node.value
+        self.evictions += 1
+
+    def pin(self, key):
+        """pin 是引用计数的，pin 了几次，就要 unpin 几次"""
+        if key not in self.cache:
+            raise LRUError(f'not found key {key}')
+        node = self.cache[key]
+        node.pin_count += 1
+        return node
+
+    def unpin(self, key):
+        if key not in self.cache:
+            raise LRUError(f'not found key {key}')
+        node = self.cache[key]
+        if node.pin_count <= 0:
+            raise LRUError(f'key {key} is not pinned')
+        node.pin_count -= 1
+        return node
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
+
+    def __len__(self):
+        return len(self.cache)
+
+
+class CacheNode:
+    def __init__(self, key, value):
+        self.key = key
+        self.value = value
+        self.pin_count = 0
+
+    @property
+    def pinned(self):
+        return self.pin_count > 0
+
+    def __repr__(self):
+        return f'{self.key}:{self.value}'
+
+
+# 与 Postgres 中一样，usage_count 的上限
+CLOCK_MAX_USAGE_COUNT = 5
+
+
+class ClockNode(CacheNode):
+    def __init__(self, key, value):
+        super().__init__(key, value)
+        self.usage_count = 1
+        # 在 frames 中的位置
+        self.frame = -1
+
+
+class ClockCache(ReplacementPolicy):
+    """类似于 Postgres 中的 clock-sweep 算法:
+    命中时只需要增加 usage_count, 不需要移动任何节点.
+    淘汰时，时钟指针扫过每一个位置，usage_count 减一，遇到 0 的就淘汰"""
+
+    def __init__(self, capacity, on_evict=None):
+        super().__init__(capacity, on_evict)
+        self.frames = []
+        self.free_frames = []
+        self.hand = 0
+
+    def get(self, key):
+        node = self.cache.get(key)
+        if node is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        if node.usage_count < CLOCK_MAX_USAGE_COUNT:
+            node.usage_count += 1
+        return node.value
+
+    def put(self, key, value, cold=False):
+        node = self.cache.get(key)
+        if node is not None:
+            node.value = value
+            if node.usage_count < CLOCK_MAX_USAGE_COUNT:
+                node.usage_count += 1
+            return
+
+        # 先腾出位置，再放入新节点，这样淘汰失败时不需要回滚
+        while len(self.cache) >= self.capacity:
+            self._evict(self._sweep())
+            victim = self.frames[self.hand]
+            self.frames[self.hand] = None
+            self.free_frames.append(self.hand)
+            del self.cache[victim.key]
+
+        node = ClockNode(key, value)
+        if cold:
+            # 时钟指针下一次扫到它的时候就会被淘汰
+            node.usage_count = 0
+        if self.free_frames:
+            node.frame = self.free_frames.pop()
+            self.frames[node.frame] = node
+        else:
+            node.frame = len(self.frames)
+            self.frames.append(node)
+        self.cache[key] = node
+
+    def remove(self, key):
+        node = self.cache.pop(key)
+        self.frames[node.frame] = None
+        self.free_frames.append(node.frame)
+
+    def _sweep(self):
+        # 找到一个可以淘汰的节点，时钟指针停在它的位置上.
+        # 每个节点最多被扫过 CLOCK_MAX_USAGE_COUNT + 1 次，
+        # 超过这个次数还没有找到，说明所有的节点都被 pin 住了
+        for _ in range(len(self.frames) * (CLOCK_MAX_USAGE_COUNT + 1) + 1):
+            self.hand = (self.hand + 1) % len(self.frames)
+            node = self.frames[self.hand]
+            if node is None or node.pinned:
+                continue
+            if node.usage_count > 0:
+                node.usage_count -= 1
+                continue
+            return node
+        raise LRUError('no available space for current node.')
+
+    def tail_keys(self, n):
+        # 从时钟指针的位置往后看，usage_count 越小越先被淘汰
+        nodes = []
+        for i in range(len(self.frames)):
+            node = self.frames[(self.hand + 1 + i) % len(self.frames)]
+            if node is not None and not node.pinned:
+                nodes.append(node)
+        nodes.sort(key=lambda node: node.usage_count)
+        return [node.key for node in nodes[:n]]
+
+
+class TwoQueueCache(ReplacementPolicy):
+    """2Q 算法 (Johnson & Shasha, 1994):
+    第一次访问的数据页进入 FIFO 队列 a1in, 被淘汰之后只在 a1out 中保留 key;
+    在 a1out 中还能找到的数据页再次被访问时，才进入 LRU 队列 am.
+    一次顺序扫描只会冲刷 a1in, 不会影响 am 中的热点数据页"""
+
+    # a1in 与 a1out 占 capacity 的比例, 论文中推荐的取值
+    KIN_RATIO = 0.25
+    KOUT_RATIO = 0.5
+
+    def __init__(self, capacity, on_evict=None):
+        super().__init__(capacity, on_evict)
+        self.a1in = OrderedDict()
+        self.a1out = OrderedDict()
+        self.am = OrderedDict()
+
+    @property
+    def kin(self):
+        return max(int(self.capacity * self.KIN_RATIO), 1)
+
+    @property
+    def kout(self):
+        return max(int(self.capacity * self.KOUT_RATIO), 1)
+
+    def get(self, key):
+        node = self.cache.get(key)
+        if node is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        if key in self.am:
+            self.am.move_to_end(key)
+        # 在 a1in 中被访问，不改变位置：短时间内的重复访问不算热点
+        return node.value
+
+    def put(self, key, value, cold=False):
+        node = self.cache.get(key)
+        if node is not None:
+            node.value = value
+            if key in self.am:
+                self.am.move_to_end(key)
+            return
+
+        while len(self.cache) >= self.capacity:
+            self._reclaim()
+
+        node = CacheNode(key, value)
+        if cold:
+            # 放在 a1in 的队首，下一个被淘汰
+            self.a1in[key] = node
+            self.a1in.move_to_end(key, last=False)
+        elif key in self.a1out:
+            del self.a1out[key]
+            self.am[key] = node
+        else:
+            self.a1in[key] = node
+        self.cache[key] = node
+
+    def remove(self, key):
+        del self.cache[key]
+        self.a1in.pop(key, None)
+        self.am.pop(key, None)
+
+    @staticmethod
+    def _first_unpinned(queue):
+        for node in queue.values():
+            if not node.pinned:
+                return node
+        return None
+
+    def _reclaim(self):
+        if len(self.a1in) > self.kin or not self.am:
+            queues = (self.a1in, self.am)
+        else:
+            queues = (self.am, self.a1in)
+        for queue in queues:
+            node = self._first_unpinned(queue)
+            if node is None:
+                continue
+            self._evict(node)
+            del queue[node.key]
+            del self.cache[node.key]
+            if queue is self.a1in:
+                self.a1out[node.key] = None
+                while len(self.a1out) > self.kout:
+                    self.a1out.popitem(last=False)
+            return
+        raise LRUError('no available space for current node.')
+
+    def tail_keys(self, n):
+        if len(self.a1in) > self.kin or not self.am:
+            queues = (self.a1in, self.am)
+        else:
+            queues = (self.am, self.a1in)
+        nodes = itertools.chain(*(queue.values() for queue in queues))
+        return [node.key for node in itertools.islice(
+            (node for node in nodes if not node.pinned), n)]
+
+
+class LRUKNode(CacheNode):
+    def __init__(self, key, value, history):
+        super().__init__(key, value)
+        # 最近 K 次访问的逻辑时间
+        self.history = history
+        # 该节点在堆中最新的条目的序号，序号不一致的条目已经过期了
+        self.heap_seq = -1
+
+
+class LRUKCache(ReplacementPolicy):
+    """LRU-K 算法 (O'Neil et al., 1993):
+    淘汰倒数第 K 次访问距今最久的数据页，访问次数不足 K 次的视为无穷远，
+    它们之间按照 LRU 的方式淘汰. 只被扫描过一次的数据页会最先被淘汰.
+    被淘汰的数据页的访问历史会保留一段时间，再次加载时还能用上.
+    节点按照 backward K-distance 放在一个最小堆中，每次访问都放入一个新的条目，
+    旧的条目不删除，出堆的时候再跳过 (lazy deletion)，这样淘汰时不需要扫描所有的节点"""
+
+    def __init__(self, capacity, on_evict=None, k=2):
+        super().__init__(capacity, on_evict)
+        self.k = k
+        self.clock = 0
+        # 被淘汰的数据页的访问历史，最多保留 capacity 个
+        self.retained = OrderedDict()
+        # (backward K-distance, seq, key), seq 相同 distance 的节点按照入堆的顺序淘汰
+        self.heap = []
+        self.seq = itertools.count()
+
+    def _touch(self, history):
+        self.clock += 1
+        history.append(self.clock)
+
+    def _push(self, node):
+        node.heap_seq = next(self.seq)
+        heapq.heappush(self.heap, (self._backward_distance(node), node.heap_seq, node.key))
+        # 过期的条目太多的时候，重建一次堆，避免只命中、不淘汰的时候堆无限增长
+        if len(self.heap) > 2 * len(self.cache) + self.capacity:
+            self.heap = [entry for entry in self.heap if self._is_live(entry)]
+            heapq.heapify(self.heap)
+
+    def _is_live(self, entry):
+        _, seq, key = entry
+        node = self.cache.get(key)
+        return node is not None and node.heap_seq == seq
+
+    def _pop_victim(self):
+        """从堆中取出最先被淘汰的、没有被 pin 住的节点"""
+        pinned = []
+        victim = None
+        while self.heap:
+            entry = heapq.heappop(self.heap)
+            if not self._is_live(entry):
+                continue
+            node = self.cache[entry[2]]
+            if node.pinned:
+                pinned.append(entry)
+                continue
+            victim = node
+            break
+        # 被 pin 住的节点之后还可能被淘汰，放回去
+        for entry in pinned:
+            heapq.heappush(self.heap, entry)
+        return victim
+
+    def get(self, key):
+        node = self.cache.get(key)
+        if node is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._touch(node.history)
+        self._push(node)
+        return node.value
+
+    def put(self, key, value, cold=False):
+        node = self.cache.get(key)
+        if node is not None:
+            node.value = value
+            self._touch(node.history)
+            self._push(node)
+            return
+
+        while len(self.cache) >= self.capacity:
+            victim = self._pop_victim()
+            if victim is None:
+                raise LRUError('no available space for current node.')
+            try:
+                self._evict(victim)
+            except Exception:
+                # 淘汰失败，节点仍然保留在缓存中
+                self._push(victim)
+                raise
+            del self.cache[victim.key]
+            self.retained[victim.key] = victim.history
+            while len(self.retained) > self.capacity:
+                self.retained.popitem(last=False)
+
+        if cold:
+            # 逻辑时间 0 比任何一次真实的访问都要早，下一个被淘汰
+            history = deque([0], maxlen=self.k)
+        else:
+            history = self.retained.pop(key, None) or deque(maxlen=self.k)
+            self._touch(history)
+        node = LRUKNode(key, value, history)
+        self.cache[key] = node
+        self._push(node)
+
+    def remove(self, key):
+        # 堆中的条目不需要删除，出堆的时候会被跳过
+        node = self.cache.pop(key)
+        self.retained[key] = node.history
+        while len(self.retained) > self.capacity:
+            self.retained.popitem(last=False)
+
+    def _backward_distance(self, node):
+        # 返回值越小越先被淘汰
+        history = node.history
+        if len(history) < self.k:
+            # 无穷远，按照最后一次访问的时间淘汰
+            return 0, history[-1]
+        return 1, history[0]
+
+    def tail_keys(self, n):
+        entries = heapq.nsmallest(n, (entry for entry in self.heap
+                                      if self._is_live(entry) and not self.cache[entry[2]].pinned))
+        return [key for _, _, key in entries]
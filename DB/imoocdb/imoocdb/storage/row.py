@@ -0,0 +1,112 @@
+import struct
+
+from imoocdb.errors import TupleCodecError
+
+LITTLE_ORDER = 'little'
+INT_STRUCT = struct.Struct('<q')
+TEXT_END_STRUCT = struct.Struct('<I')
+
+
+class RowCodec:
+    """根据表结构 (CatalogTableForm.types) 对元组进行编解码，取代 pickle.
+
+    元组的格式为:
+        | null bitmap | 定长区 | 变长区 |
+    - null bitmap: 每列占 1 个 bit, 为 1 表示该列的值是 NULL
+    - 定长区: 每列占一个定长字段. int 列直接存放 8 字节的值;
+      text 列存放 4 字节的结束位置 (相对于变长区的起始位置),
+      该列的起始位置就是前一个 text 列的结束位置
+    - 变长区: 所有 text 列 utf-8 编码之后的内容，依次存放
+    由于定长区中每一列的位置都是固定的，解码某一列时，不需要解码整个元组.
+    """
+
+    def __init__(self, types):
+        self.types = list(types)
+        self.bitmap_size = (len(self.types) + 7) // 8
+        fmt = ['<', f'{self.bitmap_size}s']
+        # 每一列在定长区中的位置
+        self.offsets = []
+        # 每一个 text 列的前一个 text 列是哪一列，第一个 text 列为 -1
+        self.prev_text_column = []
+        offset = self.bitmap_size
+        prev_text_column = -1
+        for i, type_ in enumerate(self.types):
+            self.offsets.append(offset)
+            self.prev_text_column.append(prev_text_column)
+            if type_ is int:
+                fmt.append('q')
+                offset += 8
+            elif type_ is str:
+                fmt.append('I')
+                offset += 4
+                prev_text_column = i
+            else:
+                raise NotImplementedError(f'not supported this type {type_}.')
+        # 预编译，避免每次编解码都要重新解析格式
+        self.struct = struct.Struct(''.join(fmt))
+        self.fixed_size = self.struct.size
+
+    def encode(self, tup) -> bytes:
+        if len(tup) != len(self.types):
+            raise TupleCodecError(f'expected {len(self.types)} columns but got {len(tup)}.')
+        bitmap = 0
+        fixed = []
+        var = []
+        end = 0
+        try:
+            for i, (value, type_) in enumerate(zip(tup, self.types)):
+                if value is None:
+                    bitmap |= 1 << i
+                    fixed.append(end if type_ is str else 0)
+                elif type_ is str:
+                    # 与 Postgres 的赋值转换类似，其他类型的值写入 text 列时，
+                    # 转换成字符串保存
+                    buff = (value if isinstance(value, str) else str(value)).encode()
+                    var.append(buff)
+                    end += len(buff)
+                    fixed.append(end)
+                elif isinstance(value, int):
+                    # bool 也是 int 的子类，True/False 按照 1/0 保存
+                    fixed.append(int(value))
+                elif isinstance(value, float) and value.is_integer():
+                    fixed.append(int(value))
+                else:
+                    # 只做没有损失的转换: 3.7 不能截断成 3, '12' 也不能当作 12
+                    raise TupleCodecError(f'cannot encode {value!r} into the int column {i}.')
+            return self.struct.pack(
+                bitmap.to_bytes(self.bitmap_size, LITTLE_ORDER), *fixed
+            ) + b''.join(var)
+        except (struct.error, ValueError, TypeError) as e:
+            raise TupleCodecError(f'cannot encode the tuple {tup}: {e}.')
+
+    def decode(self, buff) -> tuple:
+        """buff 可以是 bytes, 也可以是 memoryview"""
+        if len(buff) == 0:
+            return ()
+        values = self.struct.unpack_from(buff)
+        bitmap = int.from_bytes(values[0], LITTLE_ORDER)
+        tup = []
+        start = self.fixed_size
+        for i, type_ in enumerate(self.types):
+            value = values[i + 1]
+            if type_ is str:
+                end = self.fixed_size + value
+                # str() 可以直接从 memoryview 中解码，不需要先拷贝成 bytes
+                value = str(buff[start: end], 'utf-8')
+                start = end
+            if bitmap & (1 << i):
+                value = None
+            tup.append(value)
+        return tuple(tup)
+
+    def decode_column(self, buff, i):
+        """只解码第 i 列"""
+        if buff[i // 8] & (1 << (i % 8)):
+            return None
+        offset = self.offsets[i]
+        if self.types[i] is int:
+            return INT_STRUCT.unpack_from(buff, offset)[0]
+        end = TEXT_END_STRUCT.unpack_from(buff, offset)[0]
+        prev = self.prev_text_column[i]
+        start = 0 if prev < 0 else TEXT_END_STRUCT.unpack_from(buff, self.offsets[prev])[0]
+        return str(buff[self.fixed_size + start: self.fixed_size + end], 'utf-8')
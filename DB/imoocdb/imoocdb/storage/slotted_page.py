@@ -1,3 +1,7 @@
+import struct
+import sys
+from array import array
+
 from imoocdb.errors import PageError
 
 PAGE_SIZE = 8 * 1024  # 8kb
@@ -13,16 +17,34 @@ def bytes_to_uint8(buff):
 
 
 class BaseStructure:
+    # 每个字段在 struct 中的格式，默认是 8 字节的无符号整数
+    FIELD_FORMAT = 'Q'
+
+    def _to_values(self):
+        return [getattr(self, field_name) for field_name in self.serializable_fields()]
+
+    def _from_values(self, values):
+        for field_name, value in zip(self.serializable_fields(), values):
+            setattr(self, field_name, value)
+
     def serialize(self) -> bytes:
-        buff = bytearray()
-        for field_name in self.serializable_fields():
-            buff += (uint8_to_bytes(getattr(self, field_name)))
-        return bytes(buff)
+        return self.get_struct().pack(*self._to_values())
+
+    def pack_into(self, buff, offset):
+        # 直接写入到调用者预先分配好的 buffer 中，避免产生中间对象
+        self.get_struct().pack_into(buff, offset, *self._to_values())
+
+    @classmethod
+    def get_struct(cls) -> struct.Struct:
+        # 每个类只编译一次 struct 格式
+        if '_struct' not in cls.__dict__:
+            cls._struct = struct.Struct(
+                '<' + cls.FIELD_FORMAT * len(cls.serializable_fields()))
+        return cls._struct
 
     @classmethod
     def size(cls):
-        # 先这么写，避免添加字段后的霰弹式修改
-        return len(cls.serializable_fields()) * 8
+        return cls.get_struct().size
 
     @classmethod
     def serializable_fields(cls):
@@ -31,13 +53,13 @@ class BaseStructure:
     @classmethod
     def deserialize(cls, buff):
         assert len(buff) == cls.size()
-        page_header = cls()
-        position = 0
-        for field_name in cls.serializable_fields():
-            value = bytes_to_uint8(buff[position: position + 8])
-            setattr(page_header, field_name, value)
-            position += 8
-        return page_header
+        return cls.unpack_from(buff, 0)
+
+    @classmethod
+    def unpack_from(cls, buff, offset):
+        obj = cls()
+        obj._from_values(cls.get_struct().unpack_from(buff, offset))
+        return obj
 
     def __eq__(self, other):
         if not isinstance(other, type(self)):
@@ -55,6 +77,15 @@ class BaseStructure:
         return hash(values)
 
 
+# 数据页格式的版本号，存放在 flags 字段的最高字节中，
+# flags 剩下的部分留给上层使用 (如 B+ 树用来标记叶子节点)
+# 版本 1: slot 的每个字段都是 8 字节
+# 版本 2: slot 的每个字段都是 4 字节
+PAGE_VERSION = 2
+PAGE_VERSION_SHIFT = 56
+PAGE_FLAGS_MASK = (1 << PAGE_VERSION_SHIFT) - 1
+
+
 class PageHeader(BaseStructure):
     def __init__(self):
         """Header 是定长的！！！"""
@@ -76,6 +107,19 @@ class PageHeader(BaseStructure):
         self.free_space_start = 0  # free space start: Postgres lower
         self.free_space_end = 0  # free space end: Postgres upper
 
+        # 不是单独的字段，序列化时与 flags 合并在一起
+        self.version = PAGE_VERSION
+
+    def _to_values(self):
+        values = super()._to_values()
+        values[1] = (self.version << PAGE_VERSION_SHIFT) | (self.flags & PAGE_FLAGS_MASK)
+        return values
+
+    def _from_values(self, values):
+        super()._from_values(values)
+        self.version = self.flags >> PAGE_VERSION_SHIFT
+        self.flags &= PAGE_FLAGS_MASK
+
     @classmethod
     def serializable_fields(cls):
         return 'lsn', 'flags', 'reserved', 'free_space_start', 'free_space_end'
@@ -88,6 +132,8 @@ class RecordState:
 
 
 class Slot(BaseStructure):
+    FIELD_FORMAT = 'I'
+
     def __init__(self):
         """Slot 是定长的！！！"""
         self.offset = 0
@@ -99,14 +145,103 @@ class Slot(BaseStructure):
         return 'offset', 'length', 'state'
 
 
+class SlotV1(Slot):
+    """版本 1 的 slot, 只用于读取旧格式的数据页"""
+    FIELD_FORMAT = 'Q'
+
+
+class SlotRef:
+    """指向 SlotDirectory 中某一个 slot 的视图，读写都会直接作用在数组上"""
+    __slots__ = ('values', 'base')
+
+    def __init__(self, values, sid):
+        self.values = values
+        self.base = sid * SLOT_FIELDS
+
+    @property
+    def offset(self):
+        return self.values[self.base]
+
+    @offset.setter
+    def offset(self, value):
+        self.values[self.base] = value
+
+    @property
+    def length(self):
+        return self.values[self.base + 1]
+
+    @length.setter
+    def length(self, value):
+        self.values[self.base + 1] = value
+
+    @property
+    def state(self):
+        return self.values[self.base + 2]
+
+    @state.setter
+    def state(self, value):
+        self.values[self.base + 2] = value
+
+
+SLOT_FIELDS = len(Slot.serializable_fields())
+
+
+class SlotDirectory:
+    """slot 目录. 不再为每个 slot 创建一个 Slot 对象，而是把所有 slot 的
+    (offset, length, state) 依次平铺在一个 array 里面，
+    这样反序列化时，整个 slot 目录只需要一次内存拷贝"""
+
+    def __init__(self, values=None):
+        self.values = values if values is not None else array('I')
+        assert self.values.itemsize * SLOT_FIELDS == Slot.size()
+
+    def __len__(self):
+        return len(self.values) // SLOT_FIELDS
+
+    def __getitem__(self, sid):
+        if sid < 0:
+            sid += len(self)
+        if sid < 0 or sid >= len(self):
+            raise IndexError('slot index out of range')
+        return SlotRef(self.values, sid)
+
+    def __iter__(self):
+        for sid in range(len(self)):
+            yield SlotRef(self.values, sid)
+
+    def append(self, slot):
+        self.values.extend((slot.offset, slot.length, slot.state))
+
+    def tobytes(self) -> bytes:
+        if NEED_BYTESWAP:
+            values = array('I', self.values)
+            values.byteswap()
+            return values.tobytes()
+        return self.values.tobytes()
+
+    @staticmethod
+    def frombytes(buff) -> "SlotDirectory":
+        values = array('I')
+        values.frombytes(buff)
+        if NEED_BYTESWAP:
+            values.byteswap()
+        return SlotDirectory(values)
+
+
+# 数据页统一使用小端序存储，array 使用的则是本机字节序
+NEED_BYTESWAP = sys.byteorder != LITTLE_ORDER
+
+
 class Page:
     def __init__(self, header=None):
         if header:
             self.page_header = header
         else:
             self.page_header = PageHeader()
-        self.slot_directory = list()
+        self.slot_directory = SlotDirectory()
         self.records = bytearray()  # 用于存放数据元组 tuple，或者index的key
+        # 上层 (如 B+ 树) 对该页内容的解析结果的缓存，修改 record 或者 slot 时清空
+        self.decoded = None
 
     @property
     def total_record_size(self):
@@ -116,6 +251,39 @@ class Page:
     def total_slot_directory_size(self):
         return len(self.slot_directory) * Slot.size()
 
+    @property
+    def total_live_record_size(self):
+        values = self.slot_directory.values
+        return sum(values[i + 1] for i in range(0, len(values), SLOT_FIELDS)
+                   if values[i + 2] == RecordState.NORMAL)
+
+    @property
+    def total_retained_record_size(self):
+        # 被标记清除的 record 要保留到 VACUUM 为止：回滚 update 时要用原来的 slot
+        # 原地恢复，VACUUM 也要根据它的内容删除索引中对应的 location
+        values = self.slot_directory.values
+        return sum(values[i + 1] for i in range(0, len(values), SLOT_FIELDS)
+                   if values[i + 2] != RecordState.UNUSED)
+
+    @property
+    def reclaimable_space(self):
+        # 被标记清除的 record 以及原地更新留下的空洞，VACUUM 之后都可以重新使用
+        return self.total_record_size - self.total_live_record_size
+
+    @property
+    def dead_slot_count(self):
+        values = self.slot_directory.values
+        return sum(1 for i in range(0, len(values), SLOT_FIELDS)
+                   if values[i + 2] != RecordState.NORMAL)
+
+    @property
+    def available_space(self):
+        # compact() 之后，该页最多还能容纳的 (新 slot + record) 字节数.
+        # 被标记清除的 record 要等到 VACUUM 才能回收，不算在内.
+        # 减 1 是因为 allocate_slot 中要求总大小严格小于 PAGE_SIZE
+        return (PAGE_SIZE - 1 - self.page_header.size() -
+                self.total_slot_directory_size - self.total_retained_record_size)
+
     def allocate_slot(self, record):
         # 我们在 allocate_slot 这个方法里面，没有修改任何状态
         # 调用者，别忘了自己来修改Page的状态！
@@ -145,45 +313,114 @@ class Page:
         self.page_header.free_space_end = PAGE_SIZE - len(self.records)
 
     def insert(self, record: bytes) -> int:
+        self.decoded = None
         slot = self.allocate_slot(record)
+        if not slot and len(record) + Slot.size() <= self.available_space:
+            # 连续的空闲空间不够了，但是整理之后是够的
+            self.compact()
+            slot = self.allocate_slot(record)
         if not slot:
             raise PageError('out of space in the page.')
-        self.slot_directory.append(slot)
-        self.records += record
         # 严格意义上，slotted page 的 新record 是加在最前面的，即：
         # self.records = (record + self.records)
         # 但是，我们可以通过total_size这个机制，实现逻辑等价
         slot.state = RecordState.NORMAL
+        self.slot_directory.append(slot)
+        self.records += record
         # 返回 slot 的下标，对于 堆表 来说，可以作为唯一的id，
         # 即 tid (tuple id)
         return len(self.slot_directory) - 1
 
     def delete(self, sid) -> bool:
+        self.decoded = None
         if sid >= len(self.slot_directory):
             raise PageError('invalid sid.')
-        slot: Slot
-        slot = self.slot_directory[sid]
         # 用到的是标记清除法，如果原地删除，对于我们的Page来讲，很简单
         # 但是，有一个场景会很麻烦：索引的更新，例如
         # 我们有一个元组 tid = 1, 那么，其他的元组id 可能是 2,3,4, ...
         # 如果说，直接把 tid = 1 的元组删了，空间页回收了，那么，其他的
         # 该元组后面的元组的 tid 也要对应 -1, 即 1,2,3, ...
         # 所以这样，对索引的更新就会工作量非常大
-        slot.state = RecordState.DEAD
+        self.slot_directory.values[sid * SLOT_FIELDS + 2] = RecordState.DEAD
         return True
 
+    def restore(self, sid):
+        """撤销 delete: 被标记清除的 record 在 VACUUM 之前一直保留在页中，
+        直接把原来的 slot 恢复为有效即可，sid 不变，也不需要新的空间"""
+        self.decoded = None
+        if sid >= len(self.slot_directory):
+            raise PageError('invalid sid.')
+        i = sid * SLOT_FIELDS
+        if self.slot_directory.values[i + 2] != RecordState.DEAD:
+            raise PageError(f'slot {sid} is not dead.')
+        self.slot_directory.values[i + 2] = RecordState.NORMAL
+
     def select(self, sid) -> bytes:
         if sid >= len(self.slot_directory):
             raise PageError('invalid sid.')
-        slot: Slot
-        slot = self.slot_directory[sid]
+        offset, length, state = self.slot_directory.values[
+                                sid * SLOT_FIELDS: (sid + 1) * SLOT_FIELDS]
         # 由于我们采用了标记清除的机制，所以，我们此时要判断一下该标记
-        if slot.state != RecordState.NORMAL:
+        if state != RecordState.NORMAL:
             return bytes()
-        record = bytes(self.records[slot.offset: slot.offset + slot.length])
-        return record
+        return bytes(self.records[offset: offset + length])
+
+    def select_view(self, sid) -> memoryview:
+        """与 select 相同，但是返回的是指向 record 区域的 memoryview, 没有拷贝.
+        注意：memoryview 存在期间，records 不能改变大小 (否则会抛出 BufferError),
+        因此调用者用完之后要及时 release, 推荐的写法是:
+            with page.select_view(sid) as view:
+                ...
+        """
+        if sid >= len(self.slot_directory):
+            raise PageError('invalid sid.')
+        offset, length, state = self.slot_directory.values[
+                                sid * SLOT_FIELDS: (sid + 1) * SLOT_FIELDS]
+        if state != RecordState.NORMAL:
+            return memoryview(b'')
+        return memoryview(self.records)[offset: offset + length]
+
+    def iter_record_views(self):
+        """与 iter_records 相同，但是返回的是 memoryview. 每个 memoryview 只在
+        调用者处理它的期间有效，迭代到下一个 record 时就会被释放，调用者
+        如果需要保留内容，要自己拷贝出来"""
+        values = self.slot_directory.values
+        with memoryview(self.records) as records:
+            for sid in range(len(self.slot_directory)):
+                i = sid * SLOT_FIELDS
+                length = values[i + 1]
+                if values[i + 2] != RecordState.NORMAL or length == 0:
+                    continue
+                offset = values[i]
+                with records[offset: offset + length] as view:
+                    yield sid, view
+
+    def iter_records(self):
+        """按 slot 顺序遍历该页中所有有效的 record, 返回 (sid, record) 二元组.
+        被标记清除的 slot 直接跳过，不需要像 select 那样逐个判断后再返回空值."""
+        values = self.slot_directory.values
+        records = self.records
+        # 先把 slot 数量固定下来，避免遍历过程中新插入的 record 被重复扫描
+        for sid in range(len(self.slot_directory)):
+            i = sid * SLOT_FIELDS
+            length = values[i + 1]
+            if values[i + 2] != RecordState.NORMAL or length == 0:
+                continue
+            offset = values[i]
+            yield sid, bytes(records[offset: offset + length])
+
+    def iter_dead_records(self):
+        """遍历被标记清除，但是 record 还没有被整理掉的 slot"""
+        values = self.slot_directory.values
+        for sid in range(len(self.slot_directory)):
+            i = sid * SLOT_FIELDS
+            offset, length, state = values[i], values[i + 1], values[i + 2]
+            if state == RecordState.NORMAL or length == 0:
+                continue
+            yield sid, bytes(self.records[offset: offset + length])
 
     def update(self, sid, record: bytes) -> int:
+        self.decoded = None
         # 有两种实现方法：
         # 一种是先删除，再新增
         # 另一种是直接覆盖
@@ -198,7 +435,6 @@ class Page:
             # 我们可以在此时，进行后续元素的整体搬移，也可以后续批量去做组织
             return sid
         # 第一种：
-        slot = self.slot_directory[sid]
         old_state = slot.state
         try:
             self.delete(sid)
@@ -208,30 +444,74 @@ class Page:
             raise e
         return new_sid
 
-    def serialize(self) -> bytes:
+    def compact(self):
+        """整理 record 区域：去掉原地更新留下的空洞.
+        slot 的下标保持不变，因此不会影响到索引中记录的 location.
+        被标记清除的 record 也保留下来，它可能是还没有结束的事务删除的，
+        回滚时还要用到；VACUUM 时 vacuum() 会先去掉这些 slot, 再进行整理."""
+        self.decoded = None
+        values = self.slot_directory.values
+        records = bytearray()
+        for i in range(0, len(values), SLOT_FIELDS):
+            if values[i + 2] != RecordState.UNUSED:
+                offset = values[i]
+                record = self.records[offset: offset + values[i + 1]]
+                values[i] = len(records)
+                records += record
+            else:
+                values[i] = 0
+                values[i + 1] = 0
+        self.records = records
+
+    def vacuum(self):
+        """回收被标记清除的 slot, 并整理 record 区域.
+        与 compact 不同，存活元组的 sid 会发生变化，返回 {旧 sid: 新 sid},
+        调用者要负责据此修正索引中记录的 location."""
+        self.decoded = None
+        moved = {}
+        values = self.slot_directory.values
+        new_values = array('I')
+        for sid in range(len(self.slot_directory)):
+            i = sid * SLOT_FIELDS
+            if values[i + 2] != RecordState.NORMAL:
+                continue
+            new_sid = len(new_values) // SLOT_FIELDS
+            if new_sid != sid:
+                moved[sid] = new_sid
+            new_values.extend(values[i: i + SLOT_FIELDS])
+        self.slot_directory = SlotDirectory(new_values)
+        self.compact()
+        return moved
+
+    def serialize(self) -> bytearray:
         free_space_size = (self.page_header.free_space_end -
                            self.page_header.free_space_start)
         assert PAGE_SIZE == (self.page_header.size() +
                              self.total_slot_directory_size +
                              free_space_size +
                              self.total_record_size)
-        slot_directory_bytes = bytearray()
-        for slot in self.slot_directory:
-            slot_directory_bytes += slot.serialize()
-        return (
-                self.page_header.serialize() +
-                bytes(slot_directory_bytes) +
-                bytes(free_space_size) +
-                bytes(self.records)
-        )
+        # 预先分配好整个数据页，各部分直接写入对应的位置，
+        # 中间的空闲空间天然就是 0
+        buff = bytearray(PAGE_SIZE)
+        self.page_header.pack_into(buff, 0)
+        buff[self.page_header.size(): self.page_header.free_space_start] = \
+            self.slot_directory.tobytes()
+        buff[self.page_header.free_space_end:] = self.records
+        return buff
 
     @staticmethod
     def deserialize(buff) -> "Page":
         header = PageHeader.deserialize(buff[:PageHeader.size()])
         page = Page(header)
-        for slot_offset in range(header.size(), header.free_space_start, Slot.size()):
-            slot = Slot.deserialize(buff[slot_offset: slot_offset + Slot.size()])
-            page.slot_directory.append(slot)
+        slot_area = buff[header.size(): header.free_space_start]
+        if header.version >= 2:
+            page.slot_directory = SlotDirectory.frombytes(slot_area)
+        else:
+            # 旧格式的数据页，读取之后按照新格式保存
+            for slot in SlotV1.get_struct().iter_unpack(slot_area):
+                page.slot_directory.values.extend(slot)
+            header.version = PAGE_VERSION
+            header.free_space_start = header.size() + page.total_slot_directory_size
 
         page.records = bytearray(buff[header.free_space_end:])
         return page
@@ -0,0 +1,86 @@
+import threading
+
+
+class RelationStat:
+    def __init__(self):
+        # 上次整理之后，新产生的死元组数量以及被更新的元组数量
+        self.dead_tuples = 0
+        self.updated_tuples = 0
+        # 存在死元组或者空洞，需要被整理的数据页
+        self.garbage_pages = set()
+        # pageno -> 修改过该数据页的事务 xid 集合
+        # 被还没有结束的事务修改过的数据页不能整理，因为这些事务回滚时，
+        # undo log 是按照 (pageno, sid) 来定位元组的，整理会改变 sid
+        self.page_xids = {}
+
+
+class RelationStatManager:
+    def __init__(self):
+        self.stats = {}
+        self.mutex = threading.Lock()
+
+    def _get(self, relation) -> RelationStat:
+        if relation not in self.stats:
+            self.stats[relation] = RelationStat()
+        return self.stats[relation]
+
+    def _touch(self, stat, pageno, xid):
+        if pageno not in stat.page_xids:
+            stat.page_xids[pageno] = set()
+        stat.page_xids[pageno].add(xid)
+
+    def report_insert(self, relation, pageno, xid):
+        with self.mutex:
+            self._touch(self._get(relation), pageno, xid)
+
+    def report_delete(self, relation, pageno, xid):
+        with self.mutex:
+            stat = self._get(relation)
+            self._touch(stat, pageno, xid)
+            stat.dead_tuples += 1
+            stat.garbage_pages.add(pageno)
+
+    def report_update(self, relation, pageno, xid):
+        with self.mutex:
+            stat = self._get(relation)
+            self._touch(stat, pageno, xid)
+            stat.updated_tuples += 1
+            stat.garbage_pages.add(pageno)
+
+    def report_vacuum(self, relation, pageno):
+        with self.mutex:
+            stat = self._get(relation)
+            stat.garbage_pages.discard(pageno)
+            # 所有的数据页都整理完了，计数器才清零
+            if not stat.garbage_pages:
+                stat.dead_tuples = 0
+                stat.updated_tuples = 0
+
+    def page_active_xids(self, relation, pageno, active_xids):
+        """返回修改过该数据页，并且还没有结束的事务"""
+        with self.mutex:
+            stat = self._get(relation)
+            if pageno not in stat.page_xids:
+                return set()
+            # 顺便清理掉已经结束的事务
+            xids = stat.page_xids[pageno] & active_xids
+            if xids:
+                stat.page_xids[pageno] = xids
+            else:
+                del stat.page_xids[pageno]
+            return set(xids)
+
+    def is_page_busy(self, relation, pageno, active_xids):
+        return bool(self.page_active_xids(relation, pageno, active_xids))
+
+    def get(self, relation):
+        with self.mutex:
+            stat = self._get(relation)
+            return stat.dead_tuples, stat.updated_tuples, sorted(stat.garbage_pages)
+
+    def relations(self):
+        with self.mutex:
+            return list(self.stats.keys())
+
+
+relation_stat_mgr = RelationStatManager()
@@ -1,33 +1,121 @@
 import os
 import threading
 
-from imoocdb.storage.bplus_tree import BPlusTree, load_root_node, BPlusTreeTuple
-from imoocdb.storage.common import table_tuple_get_page, get_index_filename, sync_table_page
-from imoocdb.storage.lru import buffer_pool
+from imoocdb.storage.bplus_tree import BPlusTree, BPlusTreeTuple
+from imoocdb.storage.common import table_tuple_get_page, table_tuple_pinned_page, index_tree_open, \
+    sync_table_pages
+from imoocdb.storage.fsm import free_space_map_mgr
+from imoocdb.storage.lru import buffer_pool, BAS_BULKWRITE
+from imoocdb.storage.relation import RelationDescriptor, relation_cache
+from imoocdb.storage.slotted_page import Page
+from imoocdb.storage.stat import relation_stat_mgr
 from imoocdb.storage.transaction.redo import RedoLogManager, RedoRecord, RedoAction
 from imoocdb.storage.transaction.undo import UndoLogManager, UndoOperation
 
 INVALID_XID = -1
 
 
+def write_back_pages(relation: RelationDescriptor, pages):
+    """把同一张表 (或者索引) 的若干个脏页写回磁盘, pages 是 (pageno, page) 列表.
+    调用者需要持有 buffer_pool.flush_mutex.
+    返回写出时每个数据页的 LSN, 用于判断写出之后数据页有没有被再次修改"""
+    redo_mgr = transaction_mgr.redo_mgr
+    undo_mgr = transaction_mgr.undo_mgr
+    # WAL: 修改这些数据页的 redo log 必须先于数据页落盘
+    redo_mgr.flush_to(max(page.page_header.lsn for _, page in pages))
+    # 被还没有结束的事务修改过的数据页，这些事务的 undo log 也要先落盘,
+    # 否则崩溃之后就没有办法回滚了
+    active_xids = set(undo_mgr.active_transactions)
+    xids = set()
+    for pageno, _ in pages:
+        xids |= relation_stat_mgr.page_active_xids(relation.relation, pageno, active_xids)
+    for xid in sorted(xids):
+        undo_mgr.flush(xid)
+
+    lsns = [(pageno, page.page_header.lsn) for pageno, page in pages]
+    sync_table_pages(relation, [(pageno, page.serialize()) for pageno, page in pages])
+    return lsns
+
+
+def write_back_index(tree: BPlusTree):
+    """索引的修改没有 redo log, 所以修改之后，被修改过的索引页要立即写回磁盘.
+    先写索引页，再更新文件头中根节点的 pageno"""
+    relation = tree.relation.relation
+    if not tree.dirty_nodes():
+        return
+    # 索引页中可能有当前事务还没有提交的修改，放入 buffer pool 之后就可能被
+    # 淘汰或者被 bgwriter 写出，所以它的 undo log 要先落盘
+    xid = transaction_mgr.session_xid()
+    if xid != INVALID_XID:
+        transaction_mgr.undo_mgr.flush(xid)
+    # 索引项指向的元组，它的 redo log 要先于索引页落盘，所以用当前的 LSN 标记被修改的节点.
+    # 放入 buffer pool 时会获取分区锁，不能在持有 flush_mutex 的时候调用
+    pages = tree.write_pages(transaction_mgr.get_current_lsn())
+    with buffer_pool.flush_mutex:
+        lsns = write_back_pages(tree.relation, pages)
+        tree.write_root()
+        for (pageno, page), (_, lsn) in zip(pages, lsns):
+            key = (relation, pageno)
+            if buffer_pool.peek(key) is page and page.page_header.lsn == lsn:
+                buffer_pool.unmark_dirty(key)
+
+
+def index_tuple_reorganize(index_name, deletes, inserts):
+    """把整理数据页 (VACUUM) 之后对索引的修正应用到索引上.
+    崩溃恢复时可能会重复应用已经落盘的修正，所以要保证重复执行的结果不变"""
+    tree = index_tree_open(index_name)
+    # 先全部删除，再全部插入，避免相同 key 的新旧 location 互相干扰
+    for key, location in deletes:
+        tree.delete(BPlusTreeTuple(key), location)
+    for key, location in inserts:
+        key = BPlusTreeTuple(key)
+        if location not in tree.find(key):
+            tree.insert(key, location)
+    write_back_index(tree)
+
+
+def write_back_page(key, page):
+    # 数据页被 buffer pool 淘汰时调用
+    relation, pageno = key
+    # 在 buffer pool 中的数据页，它所属的表 (或者索引) 一定已经打开过了
+    write_back_pages(relation_cache.get(relation), [(pageno, page)])
+
+
 def checkpoint():
     # 注意：checkpoint 过程的时候，数据页不能进行修改
     # 不然，我们checkpoint 落到磁盘中的数据，会存在中间态
     # checkpoint 要有锁
     # todo: 实现锁
-    transaction_mgr.redo_mgr.write(
-        RedoRecord(
-            INVALID_XID, RedoAction.CHECKPOINT, None, None, b''
-        )
-    )
+    redo_mgr = transaction_mgr.redo_mgr
+    # 重放的起点：在它之前的 redo log 修改过的数据页，这时都已经被标记为脏页了，
+    # 下面会全部写出. 之后并发写入的 redo log 则要在恢复时重放
+    redo_lsn = transaction_mgr.get_current_lsn()
+
+    # 接着，我们要把脏页识别出来，然后把他们刷到磁盘中.
+    # 按照表进行分组，每张表的数据页按照 pageno 顺序写入，
+    # 这样连续的数据页可以合并写，并且每个文件只需要 fsync 一次
+    with buffer_pool.flush_mutex:
+        relation_pages = {}
+        for key, page in buffer_pool.get_all_dirty_pages():
+            relation, pageno = key
+            relation_pages.setdefault(relation, []).append((pageno, page))
+        for relation, pages in relation_pages.items():
+            lsns = write_back_pages(relation_cache.get(relation), pages)
+            for (pageno, page), (_, lsn) in zip(pages, lsns):
+                key = (relation, pageno)
+                # 写出之后又被修改过 (或者被替换掉) 的数据页，仍然是脏页.
+                # 索引页每次修改都会换成一个新的 Page 对象
+                if buffer_pool.peek(key) is page and page.page_header.lsn == lsn:
+                    buffer_pool.unmark_dirty(key)
+    # 数据页都落盘之后，再把 fsm 落盘
+    free_space_map_mgr.sync()
 
-    # 接着，我们要把脏页识别出来，然后把他们刷到磁盘中
-    for key, page in buffer_pool.get_all_dirty_pages():
-        relation, pageno = key
-        sync_table_page(relation, pageno, page)
-        buffer_pool.unmark_dirty(key)
-        if key in buffer_pool.lru_cache.evicted:
-            pass
+    # 所有的数据页都写出并且 fsync 之后，才能写 checkpoint 记录. 否则中途崩溃的话，
+    # 恢复时会从这条记录之后开始重放，跳过还没有写出的数据页需要的 redo log
+    redo_mgr.write(RedoRecord(
+        INVALID_XID, RedoAction.CHECKPOINT, None, None, redo_lsn
+    ))
+    redo_mgr.flush()
 
 
 class TransactionManager:
@@ -59,18 +147,34 @@ class TransactionManager:
 
         checkpoint_lsn = 0
         replay_lsn = 0
+        # 整理数据页之后，还没有确认落盘的索引修正: index_name -> (table_name, data).
+        # 索引修正与 checkpoint 无关，所以要从头开始找
+        index_reorganizes = {}
         for redo_record in self.redo_mgr.replay():
             # 我们是先加的 LSN，意味着，拿到的这个LSN
             # 对应的是 redo record 的 tail 位置
             replay_lsn += len(redo_record)
             if redo_record.action == RedoAction.CHECKPOINT:
-                checkpoint_lsn = replay_lsn
+                # data 是这次 checkpoint 开始时的 LSN, 从那里开始重放.
+                # 旧版本的 checkpoint 记录写在刷脏页之前，data 是 b''
+                if isinstance(redo_record.data, int):
+                    checkpoint_lsn = redo_record.data
+                else:
+                    checkpoint_lsn = replay_lsn
+            elif redo_record.action == RedoAction.INDEX_REORGANIZE:
+                index_reorganizes[redo_record.relation] = (redo_record.location, redo_record.data)
+            elif redo_record.action == RedoAction.TABLE_REORGANIZE_END:
+                for index_name, (table_name, _) in list(index_reorganizes.items()):
+                    if table_name == redo_record.relation:
+                        del index_reorganizes[index_name]
 
         # 此时，我们要么，找到一个最后的 checkpoint_lsn，要么没有找到
         # 没有找到，意味着一次 checkpoint 都没有做，那 checkpoint_lsn 本身
         # 就是0
         replay_lsn = checkpoint_lsn
         transactions = []
+        # 重放过程会访问大量的数据页，通过 ring buffer 加载，避免 buffer pool 被冲刷
+        strategy = buffer_pool.get_access_strategy(BAS_BULKWRITE)
         for redo_record in self.redo_mgr.replay(start_lsn=checkpoint_lsn):
             replay_lsn += len(redo_record)
 
@@ -85,7 +189,7 @@ class TransactionManager:
                 transactions.append(xid)
             elif action == RedoAction.TABLE_INSERT:
                 pageno, sid = location
-                page = table_tuple_get_page(relation, pageno)
+                page = table_tuple_get_page(relation, pageno, strategy)
                 # 重要：比较header中的LSN 大小，来判断是否应用该redo log
                 # 如果该 redo log 的 LSN 比该page的大，那么有资格应用到
                 # 该page上，否则，意味着该page本身就不旧于该redo log
@@ -93,23 +197,53 @@ class TransactionManager:
                     new_sid = page.insert(data)
                     page.set_header(replay_lsn)
                     assert new_sid == sid
+                    # 重放之后的数据页也是脏页，被淘汰时要写回磁盘
+                    buffer_pool.mark_dirty((relation, pageno))
+            elif action == RedoAction.TABLE_INSERT_MANY:
+                pageno, sids = location
+                page = table_tuple_get_page(relation, pageno, strategy)
+                if page.page_header.lsn < replay_lsn:
+                    for sid, record in zip(sids, data):
+                        new_sid = page.insert(record)
+                        assert new_sid == sid
+                    page.set_header(replay_lsn)
+                    buffer_pool.mark_dirty((relation, pageno))
             elif action == RedoAction.TABLE_DELETE:
                 pageno, sid = location
-                page = table_tuple_get_page(relation, pageno)
+                page = table_tuple_get_page(relation, pageno, strategy)
                 if page.page_header.lsn < replay_lsn:
                     page.delete(sid)
                     page.set_header(replay_lsn)
+                    buffer_pool.mark_dirty((relation, pageno))
             elif action == RedoAction.TABLE_UPDATE:
                 pageno, sid = location
-                page = table_tuple_get_page(relation, pageno)
+                page = table_tuple_get_page(relation, pageno, strategy)
                 if page.page_header.lsn < replay_lsn:
                     page.update(sid, data)
                     page.set_header(replay_lsn)
+                    buffer_pool.mark_dirty((relation, pageno))
+            elif action == RedoAction.TABLE_REORGANIZE:
+                pageno, _ = location
+                page = table_tuple_get_page(relation, pageno, strategy)
+                if page.page_header.lsn < replay_lsn:
+                    # 记录的是整个数据页，直接替换即可
+                    page = Page.deserialize(data)
+                    page.set_header(replay_lsn)
+                    buffer_pool[(relation, pageno)] = page
+                    buffer_pool.mark_dirty((relation, pageno))
             elif action == RedoAction.ABORT:
                 self.perform_undo(xid, replay_lsn)
             elif action == RedoAction.COMMIT:
                 transactions.remove(xid)
 
+        # 整理数据页的过程中崩溃了，数据页已经通过 redo 恢复成整理之后的样子，
+        # 但是索引可能还没有 (完全) 修正，需要把修正再应用一遍
+        for index_name, (_, (deletes, inserts)) in index_reorganizes.items():
+            index_tuple_reorganize(index_name, deletes, inserts)
+        for table_name in {table_name for table_name, _ in index_reorganizes.values()}:
+            self.redo_mgr.write(RedoRecord(INVALID_XID, RedoAction.TABLE_REORGANIZE_END,
+                                           table_name, None, b''))
+
         # redo 日志都重放完之后，存在一部分事务没有提交的场景，也就是
         # 这些redo 日志没有写 commit 标记，那么，我们应该把这些事务回滚
         for xid in transactions:
@@ -137,8 +271,12 @@ class TransactionManager:
         self.redo_mgr.write(RedoRecord(self.thread_local.xid, RedoAction.COMMIT,
                                        None, None, b''))
         self.undo_mgr.commit_transaction(xid)
+        # 事务结束时，所有的数据页都应该已经 unpin 了
+        buffer_pool.check_pin_leaks()
 
     def abort_transaction(self, xid):
+        # 出错的算子可能没有来得及 unpin 数据页
+        buffer_pool.check_pin_leaks()
         lsn = self.redo_mgr.write(RedoRecord(xid, RedoAction.ABORT,
                                              None, None, b''))
         self.undo_mgr.flush(xid)
@@ -153,41 +291,50 @@ class TransactionManager:
     def perform_undo(self, xid, lsn):
         # 这些record本身就已经是从文件尾部往前读取的了，因为做过了reverse
         for undo_record in self.undo_mgr.parse_record(xid):
+            # 修改数据页期间要一直 pin 住它，否则数据页可能在修改之后、
+            # mark_dirty() 之前被并发的淘汰丢掉，回滚就丢失了
             if undo_record.operation == UndoOperation.TABLE_DELETE:
                 pageno, sid = undo_record.location
-                page = table_tuple_get_page(undo_record.relation, pageno)
-                page.delete(sid)
-                page.set_header(lsn)
-                # todo: buffer 标记为脏页
-                buffer_pool.mark_dirty((undo_record.relation, pageno))
+                with table_tuple_pinned_page(undo_record.relation, pageno) as page:
+                    page.delete(sid)
+                    page.set_header(lsn)
+                    buffer_pool.mark_dirty((undo_record.relation, pageno))
+            elif undo_record.operation == UndoOperation.TABLE_DELETE_MANY:
+                pageno, sids = undo_record.location
+                with table_tuple_pinned_page(undo_record.relation, pageno) as page:
+                    for sid in sids:
+                        page.delete(sid)
+                    page.set_header(lsn)
+                    buffer_pool.mark_dirty((undo_record.relation, pageno))
             elif undo_record.operation == UndoOperation.TABLE_INSERT:
+                # 被删除的元组在原来的 slot 上恢复，sid 不变，索引中的 location 才有效.
+                # 不能重新 insert: 被标记清除的 record 还占着空间，数据页可能已经放不下了
                 pageno, sid = undo_record.location
-                page = table_tuple_get_page(undo_record.relation, pageno)
-                page.insert(undo_record.data)
-                page.set_header(lsn)
-                buffer_pool.mark_dirty((undo_record.relation, pageno))
+                with table_tuple_pinned_page(undo_record.relation, pageno) as page:
+                    page.restore(sid)
+                    page.set_header(lsn)
+                    buffer_pool.mark_dirty((undo_record.relation, pageno))
             elif undo_record.operation == UndoOperation.TABLE_UPDATE:
                 pageno, sid = undo_record.location
-                page = table_tuple_get_page(undo_record.relation, pageno)
-                page.update(sid, undo_record.data)
-                page.set_header(lsn)
-                buffer_pool.mark_dirty((undo_record.relation, pageno))
+                with table_tuple_pinned_page(undo_record.relation, pageno) as page:
+                    page.update(sid, undo_record.data)
+                    page.set_header(lsn)
+                    buffer_pool.mark_dirty((undo_record.relation, pageno))
             elif undo_record.operation == UndoOperation.INDEX_INSERT:
                 index_name = undo_record.relation
                 key = undo_record.data
                 value = undo_record.location
-                filename = get_index_filename(index_name)
-                tree = BPlusTree(filename, load_root_node(filename))
+                tree = index_tree_open(index_name)
                 tree.insert(BPlusTreeTuple(key), value)
-                tree.serialize()
+                write_back_index(tree)
             elif undo_record.operation == UndoOperation.INDEX_DELETE:
                 index_name = undo_record.relation
                 key = undo_record.data
                 value = undo_record.location
-                filename = get_index_filename(index_name)
-                tree = BPlusTree(filename, load_root_node(filename))
+                tree = index_tree_open(index_name)
                 tree.delete(key, value)
-                tree.serialize()
+                write_back_index(tree)
 
 
 transaction_mgr = TransactionManager()
+buffer_pool.set_page_writer(write_back_page)
@@ -1,5 +1,6 @@
 import os
 import pickle
+import threading
 
 from imoocdb.constant import REDOLOG_FILENAME
 
@@ -19,7 +20,18 @@ class RedoAction:
     INDEX_UPDATE = 8
 
     # 其他的
+    # data 是 checkpoint 开始刷脏页之前的 LSN, 恢复时从这里开始重放
     CHECKPOINT = 9
+    # 整理数据页 (vacuum), data 是整理之后的整个数据页
+    TABLE_REORGANIZE = 10
+    # 向同一个数据页中批量插入元组, location 是 (pageno, [sid, ...]),
+    # data 是对应的 record 列表
+    TABLE_INSERT_MANY = 11
+    # 整理数据页之后对索引的修正, relation 是索引名, location 是表名,
+    # data 是 (要删除的 [(key, location), ...], 要插入的 [(key, location), ...])
+    INDEX_REORGANIZE = 12
+    # 表的所有索引都已经修正完毕并落盘, relation 是表名
+    TABLE_REORGANIZE_END = 13
     # undo log 的操作
     # ...
     # 系统表/数据字典的修改 catalog
@@ -71,32 +83,42 @@ class RedoLogManager:
         self.write_lsn = 0
         # 只统计，落到磁盘里面的LSN
         self.flush_lsn = 0
+        # 前台事务、checkpoint 以及淘汰脏页时都可能写 redo log
+        self.mutex = threading.RLock()
 
     def max_lsn(self):
         return self.write_lsn
 
     def write(self, record: RedoRecord):
-        # todo: 加个锁，防止并发问题
-        self.log_buffer.append(record)
-        self.write_lsn += len(record)
+        with self.mutex:
+            self.log_buffer.append(record)
+            self.write_lsn += len(record)
+            lsn = self.write_lsn
 
-        # 刷log buffer
-        if (record.action == RedoAction.COMMIT or
-                len(self.log_buffer) > REDOLOG_BUFFER_SIZE
-        ):
-            self.flush()
+            # 刷log buffer
+            if (record.action == RedoAction.COMMIT or
+                    len(self.log_buffer) > REDOLOG_BUFFER_SIZE
+            ):
+                self.flush()
 
-        return self.write_lsn
+        return lsn
 
     def flush(self):
-        with open(self.log_filename, 'ab') as f:
-            for record in self.log_buffer:
-                f.write(record.to_bytes())
-                self.flush_lsn += len(record)
-            # 要确保redo log 真的都落到磁盘里面
-            # f.flush() 不行
-            os.fsync(f.fileno())
-        self.log_buffer.clear()
+        with self.mutex:
+            with open(self.log_filename, 'ab') as f:
+                for record in self.log_buffer:
+                    f.write(record.to_bytes())
+                    self.flush_lsn += len(record)
+                # 要确保redo log 真的都落到磁盘里面
+                # f.flush() 不行
+                os.fsync(f.fileno())
+            self.log_buffer.clear()
+
+    def flush_to(self, lsn):
+        """确保 lsn 之前的 redo log 都已经落盘"""
+        with self.mutex:
+            if lsn > self.flush_lsn:
+                self.flush()
 
     @staticmethod
     def replay(filename=REDOLOG_FILENAME, start_lsn=0):
@@ -1,5 +1,6 @@
 import pickle
 import os
+import threading
 
 from imoocdb.constant import UNDOLOG_DIRECTORY
 
@@ -15,6 +16,8 @@ class UndoOperation:
     ABORT = 5
     INDEX_INSERT = 6
     INDEX_DELETE = 7
+    # 批量插入的回滚，location 是 (pageno, [sid, ...])
+    TABLE_DELETE_MANY = 8
     # 其他的，还可以包括：
     # table schema 表结构的变化
     # ...
@@ -63,23 +66,30 @@ class UndoLogManager:
     def __init__(self, file_directory=UNDOLOG_DIRECTORY):
         self.file_directory = file_directory
         self.active_transactions = {}
+        # 淘汰脏页时，可能需要替其他线程的事务刷 undo log
+        self.mutex = threading.RLock()
 
     def write(self, record: UndoRecord):
         xid = record.xid
-        assert xid in self.active_transactions
-        self.active_transactions[xid].append(record)
+        with self.mutex:
+            assert xid in self.active_transactions
+            self.active_transactions[xid].append(record)
 
     def flush(self, xid):
-        if not os.path.exists(self.file_directory):
-            os.mkdir(self.file_directory)
-
-        filename = os.path.join(self.file_directory, str(xid))
-        with open(filename, 'ab') as f:
-            # undo log 也是可以做到批量刷新来提高性能的
-            for record in self.active_transactions[xid]:
-                f.write(record.to_bytes())
-            os.fsync(f.fileno())
-        self.active_transactions[xid].clear()
+        with self.mutex:
+            if xid not in self.active_transactions:
+                # 事务已经结束了，undo log 在结束时就已经落盘了
+                return
+            if not os.path.exists(self.file_directory):
+                os.mkdir(self.file_directory)
+
+            filename = os.path.join(self.file_directory, str(xid))
+            with open(filename, 'ab') as f:
+                # undo log 也是可以做到批量刷新来提高性能的
+                for record in self.active_transactions[xid]:
+                    f.write(record.to_bytes())
+                os.fsync(f.fileno())
+            self.active_transactions[xid].clear()
 
     def start_transaction(self, xid):
         self.active_transactions[xid] = [
@@ -94,9 +104,10 @@ class UndoLogManager:
             operation=UndoOperation.COMMIT,
             relation=None, location=None, data=b''
         )
-        self.write(undo_record)
-        self.flush(xid)
-        del self.active_transactions[xid]
+        with self.mutex:
+            self.write(undo_record)
+            self.flush(xid)
+            del self.active_transactions[xid]
 
     def abort_transaction(self, xid):
         undo_record = UndoRecord(
@@ -104,9 +115,10 @@ class UndoLogManager:
             operation=UndoOperation.ABORT,
             relation=None, location=None, data=b''
         )
-        self.write(undo_record)
-        self.flush(xid)
-        del self.active_transactions[xid]
+        with self.mutex:
+            self.write(undo_record)
+            self.flush(xid)
+            del self.active_transactions[xid]
 
     def parse_record(self, xid):
         filename = os.path.join(self.file_directory, str(xid))
@@ -6,6 +6,7 @@ import pytest
 from imoocdb.catalog import CatalogTableForm, CatalogIndexForm
 from imoocdb.catalog.entry import catalog_index, catalog_table
 from imoocdb.main import init_database
+from imoocdb.storage import autovacuum, bgwriter
 from imoocdb.storage.entry import table_tuple_insert_one, index_tuple_create
 from imoocdb.storage.transaction.entry import transaction_mgr
 
@@ -36,6 +37,11 @@ def setup():
     if os.path.exists(TEST_DATA_DIRECTORY):
         shutil.rmtree(TEST_DATA_DIRECTORY)
 
+    # 测试用例中有很多直接调用存储层接口的地方，不会加锁，
+    # 所以不要让 autovacuum 和 bgwriter 在后台并发地修改、写出数据页，
+    # 需要的测试用例自己调用
+    autovacuum.AUTOVACUUM = False
+    bgwriter.BGWRITER = False
     init_database(TEST_DATA_DIRECTORY)
 
     catalog_table.insert(CatalogTableForm('t1', ['id', 'name'], [int, str]))
@@ -0,0 +1,59 @@
+import time
+
+from imoocdb.main import exec_imoocdb_query
+from imoocdb.storage.autovacuum import AutoVacuumWorker, AUTOVACUUM_VACUUM_THRESHOLD
+from imoocdb.storage.common import table_tuple_get_pages, table_tuple_get_page
+from imoocdb.storage.entry import table_tuple_get_all, table_tuple_delete_one, table_tuple_scan
+from imoocdb.storage.lock.lock import lock_manager
+from imoocdb.storage.stat import relation_stat_mgr
+from imoocdb.storage.transaction.entry import transaction_mgr
+
+
+def test_autovacuum():
+    exec_imoocdb_query('create table t_autovacuum (id int, name text)')
+    values = ', '.join(f"({i}, 'name{i}')" for i in range(200))
+    exec_imoocdb_query(f'insert into t_autovacuum values {values}')
+    worker = AutoVacuumWorker()
+
+    # 没有达到阈值，不会整理
+    exec_imoocdb_query('delete from t_autovacuum where t_autovacuum.id < 10')
+    worker.run_once()
+    dead_tuples, _, pagenos = relation_stat_mgr.get('t_autovacuum')
+    assert dead_tuples == 10 and pagenos == [0]
+
+    # 还没有结束的事务修改过的数据页，不能整理
+    xid = transaction_mgr.start_transaction()
+    locations = [location for location, tup in table_tuple_scan('t_autovacuum')
+                 if tup[0] < 10 + AUTOVACUUM_VACUUM_THRESHOLD]
+    for location in locations:
+        table_tuple_delete_one('t_autovacuum', location)
+    worker.run_once()
+    assert relation_stat_mgr.get('t_autovacuum')[2] == [0]
+    transaction_mgr.commit_transaction(xid)
+
+    expected = list(table_tuple_get_all('t_autovacuum'))
+    worker.run_once()
+    assert relation_stat_mgr.get('t_autovacuum') == (0, 0, [])
+    assert list(table_tuple_get_all('t_autovacuum')) == expected
+    for pageno in range(table_tuple_get_pages('t_autovacuum')):
+        assert table_tuple_get_page('t_autovacuum', pageno).dead_slot_count == 0
+
+
+def test_autovacuum_skip_locked_table():
+    exec_imoocdb_query('create table t_autovacuum_lock (id int, name text)')
+    values = ', '.join(f"({i}, 'name{i}')" for i in range(200))
+    exec_imoocdb_query(f'insert into t_autovacuum_lock values {values}')
+    exec_imoocdb_query(f'delete from t_autovacuum_lock where t_autovacuum_lock.id < {AUTOVACUUM_VACUUM_THRESHOLD}')
+
+    # 前台持有表锁的时候，autovacuum 不等待，直接跳过这张表
+    lock_manager.acquire_lock(('table', 't_autovacuum_lock'), 100000, 's')
+    try:
+        start = time.monotonic()
+        AutoVacuumWorker.vacuum_table('t_autovacuum_lock')
+        assert time.monotonic() - start < 0.5
+        assert relation_stat_mgr.get('t_autovacuum_lock')[2] == [0]
+    finally:
+        lock_manager.release_lock(('table', 't_autovacuum_lock'), 100000)
+
+    AutoVacuumWorker.vacuum_table('t_autovacuum_lock')
+    assert relation_stat_mgr.get('t_autovacuum_lock')[2] == []
@@ -0,0 +1,84 @@
+import os
+import threading
+
+from imoocdb.main import exec_imoocdb_query
+from imoocdb.storage.bgwriter import BackgroundWriter
+from imoocdb.storage.common import table_open, table_tuple_get_pages, index_open
+from imoocdb.storage.entry import table_tuple_insert_one
+from imoocdb.storage.lock.lock import lock_manager
+from imoocdb.storage.lru import buffer_pool
+from imoocdb.storage.slotted_page import PAGE_SIZE
+from imoocdb.storage.transaction.entry import transaction_mgr
+
+
+def dirty_pages(table_name):
+    return sorted(key for key in buffer_pool.dirty_pages if key[0] == table_name)
+
+
+def test_bgwriter():
+    exec_imoocdb_query('create table t_bgwriter (id int, name text)')
+    values = ', '.join(f"({i}, 'name{i}')" for i in range(500))
+    exec_imoocdb_query(f'insert into t_bgwriter values {values}')
+    pages = table_tuple_get_pages('t_bgwriter')
+    assert len(dirty_pages('t_bgwriter')) == pages
+
+    # 还没有结束的事务修改过的数据页，先不写出
+    xid = transaction_mgr.start_transaction()
+    pageno, _ = table_tuple_insert_one('t_bgwriter', (500, 'name500'))
+    worker = BackgroundWriter(dirty_ratio=0)
+    worker.run_once()
+    assert dirty_pages('t_bgwriter') == [('t_bgwriter', pageno)]
+    relation = table_open('t_bgwriter')
+    assert os.stat(relation.filename).st_size == relation.disk_pages * PAGE_SIZE
+    transaction_mgr.commit_transaction(xid)
+
+    worker.run_once()
+    assert dirty_pages('t_bgwriter') == []
+    assert relation.disk_pages == pages
+
+
+def test_bgwriter_lock_order(monkeypatch):
+    exec_imoocdb_query('create table t_bgwriter_lock (id int, name text)')
+    exec_imoocdb_query("insert into t_bgwriter_lock values (1, 'a'), (2, 'b')")
+    tail_keys = buffer_pool.tail_keys
+    flush_mutex_free = []
+
+    def check_tail_keys(n):
+        # 淘汰脏页的线程持有分区锁之后，要能拿到 flush_mutex
+        def evict():
+            if buffer_pool.flush_mutex.acquire(blocking=False):
+                buffer_pool.flush_mutex.release()
+                flush_mutex_free.append(True)
+            else:
+                flush_mutex_free.append(False)
+        t = threading.Thread(target=evict)
+        t.start()
+        t.join()
+        return tail_keys(n)
+
+    monkeypatch.setattr(buffer_pool, 'tail_keys', check_tail_keys)
+    BackgroundWriter(dirty_ratio=0).run_once()
+    assert flush_mutex_free == [True]
+    assert not dirty_pages('t_bgwriter_lock')
+
+
+def test_bgwriter_index_lock():
+    exec_imoocdb_query('create table t_bgwriter_index (id int, name text)')
+    exec_imoocdb_query('create index idx_bgwriter on t_bgwriter_index (id)')
+    exec_imoocdb_query("insert into t_bgwriter_index values (1, 'a')")
+    transaction_mgr.redo_mgr.flush()
+    relation = index_open('idx_bgwriter')
+    key = ('idx_bgwriter', relation.root_pageno)
+    buffer_pool.mark_dirty(key)
+
+    # 索引正在被修改 (持有索引锁) 时，不能写出索引页
+    lock_manager.acquire_lock(('index', 'idx_bgwriter'), 100000, 'x')
+    try:
+        with buffer_pool.flush_mutex:
+            assert BackgroundWriter.write_relation('idx_bgwriter', [relation.root_pageno]) == 0
+        assert buffer_pool.is_dirty(key)
+    finally:
+        lock_manager.release_lock(('index', 'idx_bgwriter'), 100000)
+    with buffer_pool.flush_mutex:
+        assert BackgroundWriter.write_relation('idx_bgwriter', [relation.root_pageno]) == 1
+    assert not buffer_pool.is_dirty(key)
@@ -1,5 +1,12 @@
 import os
-from imoocdb.storage.bplus_tree import BPlusTree, BPlusTreeTuple
+
+import pytest
+
+from imoocdb.errors import BPlusTreeError
+from imoocdb.storage import bplus_tree
+from imoocdb.storage.bplus_tree import BPlusTree, BPlusTreeTuple, BPlusTreeNode, NODE_CAPACITY, \
+    BPLUS_TREE_FILLFACTOR, BPLUS_TREE_MERGE_THRESHOLD, FREE_LIST_END
+from imoocdb.storage.slotted_page import PAGE_SIZE, Page
 
 
 def test_bplus_tree():
@@ -36,6 +43,19 @@ def test_bplus_tree():
     assert result == list(range(0, 100))
 
 
+def test_bplus_tree_insert_after_delete():
+    tree = BPlusTree()
+    for i in range(0, 200):
+        tree.insert(i, i)
+    for i in range(0, 200):
+        tree.delete(i)
+    # 叶子节点都被删空了，插入时也要落到正确的叶子节点上
+    for i in range(150, 200):
+        tree.insert(i, i)
+    assert tree.find_range() == list(range(150, 200))
+    assert tree.find(175) == [175]
+
+
 def test_bplus_tree_tuple():
     t1 = BPlusTreeTuple((None, 1, 2))
     t2 = BPlusTreeTuple((1, 1, 2))
@@ -59,6 +79,40 @@ def test_bplus_tree_tuple():
     assert (tree.find_range()) == [(0, 1), (0, 2), (0, 4), (0, 3)]
 
 
+def test_bplus_tree_decoded_page(monkeypatch):
+    tree = BPlusTree()
+    for i in range(2000):
+        tree.insert(BPlusTreeTuple((i,)), (i, 0))
+    assert not tree.root.is_leaf
+    leaf = tree.load_node(tree.root.children[0])
+
+    calls = []
+    loads = bplus_tree.pickle.loads
+    monkeypatch.setattr(bplus_tree.pickle, 'loads', lambda buff: calls.append(1) or loads(buff))
+    for node in (tree.root, leaf):
+        page = node.to_page()
+        # to_page() 生成的数据页，直接使用序列化时的结果，不需要再反序列化
+        copy = BPlusTreeNode()
+        copy.from_page(page)
+        assert not calls
+        # 从磁盘读上来的数据页只反序列化一次
+        page = Page.deserialize(page.serialize())
+        for _ in range(2):
+            decoded = BPlusTreeNode()
+            decoded.from_page(page)
+            assert (decoded.is_leaf, decoded.keys, decoded.values, decoded.nbytes) == \
+                   (node.is_leaf, node.keys, node.values, node.size)
+            assert [c.pageno for c in decoded.children] == [c.pageno for c in node.children]
+        assert len(calls) == len(page.slot_directory)
+        calls.clear()
+        # 修改节点不会影响缓存的解析结果
+        decoded.keys.pop()
+        assert len(page.decoded[1]) == len(node.keys)
+        # 数据页被修改之后，缓存失效
+        page.delete(0)
+        assert page.decoded is None
+
+
 def test_bplus_tree_serialize():
     filename = 'test.idx'
     if os.path.exists(filename):
@@ -79,3 +133,238 @@ def test_bplus_tree_serialize():
     # for i in range(100):
     #     tree2.insert(BPlusTreeTuple((None, 1)), (100, i))
     # print(tree2.find_range())
+
+
+def test_bplus_tree_incremental_serialize():
+    filename = 'test_incremental.idx'
+    if os.path.exists(filename):
+        os.unlink(filename)
+
+    # key 比较大，每个节点中只能放下几个 key, 树的高度才能长起来
+    def key(i):
+        return BPlusTreeTuple((f'{i:04d}' + 'x' * 1000,))
+
+    tree = BPlusTree(filename)
+    for i in range(30):
+        tree.insert(key(i), i)
+    tree.serialize(lsn=1)
+    assert not tree.dirty_nodes()
+    size = os.stat(filename).st_size
+
+    # 只有被修改过的叶子节点需要写出，原地覆盖写，文件不会变大
+    tree2 = BPlusTree.deserialize(filename)
+    tree2.delete(key(15))
+    tree2.insert(key(15), 1000)
+    dirty = tree2.dirty_nodes()
+    assert len(dirty) == 1 and dirty[0].is_leaf
+    tree2.serialize(lsn=2)
+    assert os.stat(filename).st_size == size
+
+    # 根节点分裂之后，新的数据页追加到文件尾部，文件头指向新的根节点
+    root = tree2.root.pageno
+    for i in range(60):
+        tree2.insert(key(200 + i), i)
+    tree2.serialize(lsn=3)
+    assert tree2.root.pageno != root
+    assert os.stat(filename).st_size > size
+
+    tree3 = BPlusTree.deserialize(filename)
+    assert tree3.root.pageno == tree2.root.pageno
+    assert tree3.find(key(15)) == [1000]
+    assert len(tree3.find_range()) == 90
+    assert tree3.find_leaf_node(key(15)).lsn == 2
+    os.unlink(filename)
+
+
+def test_bplus_tree_duplicate_keys_bisect():
+    node = BPlusTree().root
+    node.keys = [1, 2, 2, 2, 3, 3, 4, 5, 6]
+    assert BPlusTree._find_leftmost_key_index(node, 2) == 1
+    assert BPlusTree._find_rightmost_key_index(node, 2) == 4
+    assert list(BPlusTree._find_indexes(node.keys, 3)) == [4, 5]
+    assert list(BPlusTree._find_indexes(node.keys, 7)) == []
+
+    # 相同的 key 跨越了多个叶子节点，查询条件是普通的 tuple
+    tree = BPlusTree()
+    for i in range(60):
+        tree.insert(BPlusTreeTuple((i % 3, None if i % 2 else i)), i)
+    assert sorted(tree.find((1, None))) == [i for i in range(60) if i % 3 == 1 and i % 2]
+    # 开区间：不包含 start 与 end 本身
+    assert tree.find_range((0, 30), (1, None)) == [36, 42, 48, 54]
+    assert tree.find_range((0, None), (1, None)) == list(range(0, 60, 6))
+
+
+def test_bplus_tree_page_fill_fanout():
+    tree = BPlusTree()
+    for i in range(2000):
+        tree.insert(BPlusTreeTuple((i,)), (i // 100, i % 100))
+    # 一个叶子节点能放下几百个 key, 两层就够了
+    assert not tree.root.is_leaf and tree.root.children[0].is_leaf
+    leaves = [tree.load_node(child) for child in tree.root.children]
+    assert min(len(leaf.keys) for leaf in leaves) > 100
+    # 顺序插入时，分裂出来的左边节点按照填充率保留数据，而不是对半分
+    for leaf in leaves[:-1]:
+        assert leaf.size <= NODE_CAPACITY
+        assert leaf.size >= NODE_CAPACITY * (BPLUS_TREE_FILLFACTOR - 5) // 100
+    for leaf in leaves:
+        leaf.to_page()
+    assert tree.find_range() == [(i // 100, i % 100) for i in range(2000)]
+
+    with pytest.raises(BPlusTreeError):
+        tree.insert(BPlusTreeTuple(('x' * PAGE_SIZE,)), (0, 0))
+
+
+def test_bplus_tree_split_path():
+    # key 比较大，扇出很小，树会长得很高，分裂会一直传递到根节点
+    def key(i):
+        return BPlusTreeTuple((f'{i:05d}' + 'x' * 1500,))
+
+    tree = BPlusTree()
+    order = [(i * 7919) % 1000 for i in range(1000)]
+    for i in order:
+        tree.insert(key(i // 2), i)
+
+    height = 1
+    node = tree.root
+    while not node.is_leaf:
+        node = tree.load_node(node.children[0])
+        height += 1
+    assert height >= 4
+    _check_tree(tree)
+    assert [k.tup for k in tree.find_range(return_keys=True)] == [key(i // 2).tup for i in range(1000)]
+    for i in range(0, 1000, 2):
+        assert sorted(tree.find(key(i // 2))) == [i, i + 1]
+
+
+def _check_tree(tree):
+    """检查B+树的结构，返回从左到右的叶子节点"""
+    leaves = []
+
+    def visit(node, lower, upper):
+        node = tree.load_node(node)
+        assert not node.free
+        if node is not tree.root:
+            assert node.keys and node.size <= NODE_CAPACITY
+        # 父节点中的 keys[i] 是 children[i + 1] 的下界
+        assert all(lower <= k for k in node.keys if lower is not None)
+        assert all(k <= upper for k in node.keys if upper is not None)
+        if node.is_leaf:
+            leaves.append(node)
+            return
+        assert len(node.children) == len(node.keys) + 1
+        bounds = [lower] + node.keys + [upper]
+        for i, child in enumerate(node.children):
+            visit(child, bounds[i], bounds[i + 1])
+
+    visit(tree.root, None, None)
+    # 叶子节点链表与树中叶子节点的顺序一致
+    node = leaves[0]
+    for leaf in leaves[1:]:
+        assert tree.load_node(node.next_leaf) is leaf
+        node = leaf
+    assert node.next_leaf is None
+    return leaves
+
+
+def _free_pages(tree):
+    pages = []
+    pageno = tree.free_pageno
+    while pageno != FREE_LIST_END:
+        node = BPlusTreeNode()
+        node.pageno = pageno
+        node = tree.load_node(node)
+        assert node.free
+        pages.append(pageno)
+        pageno = node.next_free
+    return pages
+
+
+def test_bplus_tree_delete_merge():
+    def key(i):
+        return BPlusTreeTuple((f'{i:05d}' + 'x' * 500,))
+
+    tree = BPlusTree()
+    for i in range(2000):
+        tree.insert(key(i), i)
+    pages = tree.node_count
+    _check_tree(tree)
+
+    # 删除 90% 的 key 之后，叶子节点合并，不会留下空的叶子节点
+    for i in [(i * 7919) % 2000 for i in range(2000)]:
+        if i % 10:
+            tree.delete(key(i))
+    leaves = _check_tree(tree)
+    assert len(leaves) < pages // 5
+    assert all(leaf.size >= NODE_CAPACITY * BPLUS_TREE_MERGE_THRESHOLD // 100 for leaf in leaves[:-1])
+    assert tree.find_range() == list(range(0, 2000, 10))
+    free_pages = _free_pages(tree)
+    assert len(free_pages) >= pages - len(leaves) * 2
+
+    # 新的节点优先复用空闲页
+    for i in range(5, 2000, 10):
+        tree.insert(key(i), i)
+    _check_tree(tree)
+    assert tree.node_count == pages
+    assert len(_free_pages(tree)) < len(free_pages)
+    assert tree.find_range() == list(range(0, 2000, 5))
+
+    # 全部删除之后，树的高度也降下来了
+    for i in range(0, 2000, 5):
+        tree.delete(key(i))
+    assert tree.root.is_leaf and tree.find_range() == []
+    assert len(_free_pages(tree)) == pages - 1
+
+
+def test_bplus_tree_delete_duplicate_values():
+    def key(i):
+        return BPlusTreeTuple((i, 'x' * 200))
+
+    tree = BPlusTree()
+    for i in range(3000):
+        tree.insert(key(i % 3), i)
+    # 相同的 key 跨越了很多个叶子节点，逐个按照 value 删除
+    for i in range(1, 3000, 3):
+        if i % 2:
+            tree.delete(key(1), i)
+    _check_tree(tree)
+    assert tree.find(key(1)) == [i for i in range(1, 3000, 3) if i % 2 == 0]
+    assert tree.find(key(0)) == list(range(0, 3000, 3))
+    tree.delete(key(0))
+    _check_tree(tree)
+    assert tree.find_range() == tree.find(key(1)) + tree.find(key(2))
+
+
+def test_bplus_tree_free_list_serialize():
+    filename = 'test_free_list.idx'
+    if os.path.exists(filename):
+        os.unlink(filename)
+
+    def key(i):
+        return BPlusTreeTuple((f'{i:04d}' + 'x' * 1000,))
+
+    tree = BPlusTree(filename)
+    for i in range(300):
+        tree.insert(key(i), i)
+    tree.serialize(lsn=1)
+    size = os.stat(filename).st_size
+
+    tree = BPlusTree.deserialize(filename)
+    for i in range(100, 300):
+        tree.delete(key(i))
+    tree.serialize(lsn=2)
+    free_pages = _free_pages(tree)
+    assert free_pages
+
+    # 空闲页链表保存在文件头中，重新打开之后，继续复用这些数据页
+    tree = BPlusTree.deserialize(filename)
+    assert _free_pages(tree) == free_pages
+    assert tree.find_range() == list(range(100))
+    for i in range(100, 300):
+        tree.insert(key(i), i + 1)
+    tree.serialize(lsn=3)
+    assert os.stat(filename).st_size == size
+
+    tree = BPlusTree.deserialize(filename)
+    _check_tree(tree)
+    assert tree.find_range() == list(range(100)) + list(range(101, 301))
+    os.unlink(filename)
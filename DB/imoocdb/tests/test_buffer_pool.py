@@ -0,0 +1,200 @@
+import os
+import threading
+import time
+
+import pytest
+
+from imoocdb.main import exec_imoocdb_query
+from imoocdb.storage.common import table_open, table_tuple_get_page
+from imoocdb.errors import LRUError
+from imoocdb.storage.entry import table_tuple_get_all, table_tuple_scan, table_tuple_insert_one, \
+    table_tuple_update_one, table_tuple_delete_one
+from imoocdb.storage.lru import BufferPool, buffer_pool, REPLACEMENT_POLICIES, BAS_BULKREAD, BAS_BULKWRITE
+from imoocdb.storage.slotted_page import PAGE_SIZE, Page
+from imoocdb.storage.transaction.entry import transaction_mgr
+
+
+def test_buffer_pool_size():
+    pool = BufferPool(10 * PAGE_SIZE, partitions=4)
+    assert pool.capacity == 10
+    assert [p.replacer.capacity for p in pool.partitions] == [3, 3, 2, 2]
+    pool = BufferPool(PAGE_SIZE // 2)
+    assert pool.capacity == 1
+    assert len(pool.partitions) == 1
+
+
+def test_buffer_pool_get_or_load():
+    pool = BufferPool(64 * PAGE_SIZE)
+    calls = []
+
+    def load():
+        calls.append(1)
+        time.sleep(0.05)
+        return Page()
+
+    pages = []
+    threads = [threading.Thread(target=lambda: pages.append(pool.get_or_load(('t', 0), load)))
+               for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    # 同一个数据页只会被加载一次
+    assert len(calls) == 1
+    assert len(pages) == 8
+    assert all(page is pages[0] for page in pages)
+    assert len(pool) == 1 and not pool.dirty_pages
+
+    pool.get_or_load(('t', 1), Page, dirty=True)
+    assert pool.dirty_pages == {('t', 1)}
+    pool.unmark_dirty(('t', 1))
+    assert not pool.is_dirty(('t', 1))
+
+
+def test_buffer_pool_write_back():
+    exec_imoocdb_query('create table t_write_back (id int, name text)')
+    relation = table_open('t_write_back')
+    capacities = [p.replacer.capacity for p in buffer_pool.partitions]
+    for p in buffer_pool.partitions:
+        p.replacer.capacity = 1
+    try:
+        # 每分配一个新的数据页，就把同一个分区中原来的数据页挤出去了
+        values = ', '.join(f"({i}, '{'x' * 2000}')" for i in range(100))
+        exec_imoocdb_query(f'insert into t_write_back values {values}')
+        pages = relation.pages
+        assert len(buffer_pool) <= len(buffer_pool.partitions) < pages
+        # 被淘汰的脏页都写回了磁盘，redo log 也先于数据页落盘
+        resident = [pageno for pageno in range(pages) if ('t_write_back', pageno) in buffer_pool]
+        assert transaction_mgr.redo_mgr.flush_lsn >= max(
+            buffer_pool.peek(('t_write_back', pageno)).page_header.lsn for pageno in resident)
+        for pageno in range(pages):
+            if pageno in resident:
+                continue
+            assert not buffer_pool.is_dirty(('t_write_back', pageno))
+            with open(relation.filename, 'rb') as f:
+                f.seek(pageno * PAGE_SIZE)
+                page = Page.deserialize(f.read(PAGE_SIZE))
+            assert list(page.iter_records())
+
+        # 从磁盘上重新读取的数据与之前一致
+        results = list(table_tuple_get_all('t_write_back'))
+        assert [r[0] for r in results] == list(range(100))
+        assert os.stat(relation.filename).st_size == relation.disk_pages * PAGE_SIZE
+    finally:
+        for p, capacity in zip(buffer_pool.partitions, capacities):
+            p.replacer.capacity = capacity
+
+
+@pytest.mark.parametrize('policy', sorted(REPLACEMENT_POLICIES))
+def test_buffer_access_strategy(policy):
+    pool = BufferPool(16 * PAGE_SIZE, partitions=1, policy=policy)
+    written = []
+    pool.set_page_writer(lambda key, page: written.append(key))
+    hot = [('hot', i) for i in range(8)]
+    for _ in range(2):
+        for key in hot:
+            pool.get_or_load(key, Page)
+
+    # 大表的顺序扫描只在一个很小的环中循环使用数据页
+    strategy = pool.get_access_strategy(BAS_BULKREAD)
+    assert strategy.ring_size == 2
+    for i in range(100):
+        pool.get_or_load(('scan', i), Page, strategy=strategy)
+    assert all(key in pool for key in hot)
+    assert len(pool) == len(hot) + strategy.ring_size
+
+    # 环中被替换出去的脏页要先写回磁盘
+    strategy = pool.get_access_strategy(BAS_BULKWRITE)
+    for i in range(4):
+        pool.get_or_load(('bulk', i), Page, dirty=True, strategy=strategy)
+    assert written == [('bulk', 0), ('bulk', 1)]
+    assert pool.dirty_pages == {('bulk', 2), ('bulk', 3)}
+    assert all(key in pool for key in hot)
+
+
+@pytest.mark.parametrize('policy', sorted(REPLACEMENT_POLICIES))
+def test_buffer_pool_pinned(policy):
+    pool = BufferPool(2 * PAGE_SIZE, partitions=1, policy=policy)
+    with pool.pinned(('t', 0), Page) as page:
+        # pin 是引用计数的
+        with pool.pinned(('t', 0)) as same_page:
+            assert same_page is page
+        for i in range(1, 10):
+            pool.get_or_load(('t', i), Page)
+        # 被 pin 住的数据页不会被淘汰
+        assert pool.peek(('t', 0)) is page
+        assert not pool.discard(('t', 0))
+    assert pool.stats()['evictions'] == 8
+    pool.get_or_load(('t', 10), Page)
+    pool.get_or_load(('t', 11), Page)
+    assert ('t', 0) not in pool
+
+    with pytest.raises(LRUError):
+        with pool.pinned(('t', 0)):
+            pass
+
+
+def test_buffer_pool_pin_leak():
+    pool = BufferPool(4 * PAGE_SIZE, partitions=1)
+    pool.get_or_load(('t', 0), Page, pin=True)
+    pool.get_or_load(('t', 1), Page, pin=True)
+    pool.pin(('t', 1))
+    assert pool.check_pin_leaks() == [('t', 0), ('t', 1)]
+    assert not any(node.pinned for node in pool.partitions[0].replacer.cache.values())
+    # 泄漏检查释放之后，再 unpin 不会出错
+    pool.unpin(('t', 0))
+
+    # 其他线程泄漏的 pin 在 close() 时检查
+    t = threading.Thread(target=lambda: pool.pin(('t', 1)))
+    t.start()
+    t.join()
+    assert pool.check_pin_leaks() == []
+    assert pool.close() == [('t', 1)]
+    assert pool.close() == []
+
+
+def test_table_scan_pins_page():
+    exec_imoocdb_query('create table t_scan_pin (id int, name text)')
+    exec_imoocdb_query("insert into t_scan_pin values (1, 'a'), (2, 'b')")
+    scan = table_tuple_scan('t_scan_pin')
+    next(scan)
+    # 遍历当前数据页的过程中，该数据页是被 pin 住的
+    assert buffer_pool.check_pin_leaks() == [('t_scan_pin', 0)]
+    scan.close()
+    scan = table_tuple_scan('t_scan_pin')
+    assert len(list(scan)) == 2
+    assert buffer_pool.check_pin_leaks() == []
+
+
+def test_rollback_pins_page(monkeypatch):
+    exec_imoocdb_query('create table t_rollback_pin (id int, name text)')
+    exec_imoocdb_query("insert into t_rollback_pin values (1, 'a'), (2, 'b')")
+    xid = transaction_mgr.start_transaction()
+    table_tuple_insert_one('t_rollback_pin', (3, 'c'))
+    table_tuple_update_one('t_rollback_pin', (0, 0), (1, 'x'))
+    table_tuple_delete_one('t_rollback_pin', (0, 1))
+
+    mark_dirty = buffer_pool.mark_dirty
+    marked = []
+
+    def check_pinned(key):
+        # 回滚修改数据页期间，数据页是被 pin 住的，不会被并发地淘汰
+        partition = buffer_pool._partition(key)
+        assert partition.replacer.cache[key].pinned
+        marked.append(key)
+        mark_dirty(key)
+
+    monkeypatch.setattr(buffer_pool, 'mark_dirty', check_pinned)
+    transaction_mgr.abort_transaction(xid)
+    assert len(marked) == 3
+    assert [r[:1] for r in table_tuple_get_all('t_rollback_pin')] == [(1,), (2,)]
+    assert buffer_pool.check_pin_leaks() == []
+
+
+def test_table_page_miss_counted_once():
+    exec_imoocdb_query('create table t_page_miss (id int, name text)')
+    misses = buffer_pool.stats()['misses']
+    table_tuple_get_page('t_page_miss', 0)
+    assert buffer_pool.stats()['misses'] == misses + 1
+    table_tuple_get_page('t_page_miss', 0)
+    assert buffer_pool.stats()['misses'] == misses + 1
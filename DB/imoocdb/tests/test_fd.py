@@ -0,0 +1,96 @@
+import os
+import threading
+
+import pytest
+
+from imoocdb.errors import FileReadError
+from imoocdb.storage import fd
+from imoocdb.storage.fd import FileDescriptorManager
+
+
+def test_file_descriptor_manager(tmp_path):
+    fd_mgr = FileDescriptorManager(max_open_files=2)
+    filenames = [str(tmp_path / f'{i}.tbl') for i in range(3)]
+    for i, filename in enumerate(filenames):
+        # 先写后面的位置，再写前面的位置，确认是按照偏移量写入的
+        fd_mgr.write(filename, 4, b'bbbb')
+        fd_mgr.write(filename, 0, bytes([i]) * 4)
+    # 超过上限之后，最久没有使用的 fd 会被关闭
+    assert len(fd_mgr) == 2
+    assert filenames[0] not in fd_mgr.fds
+
+    for i, filename in enumerate(filenames):
+        assert fd_mgr.read(filename, 0, 8) == bytes([i]) * 4 + b'bbbb'
+        assert os.stat(filename).st_size == 8
+    fd_mgr.close_all()
+    assert len(fd_mgr) == 0
+
+
+def test_mmap_read(tmp_path):
+    fd_mgr = FileDescriptorManager(use_mmap=True)
+    filename = str(tmp_path / 'mmap.tbl')
+    with pytest.raises(FileReadError):
+        fd_mgr.read(filename, 0, 4)
+    fd_mgr.write(filename, 0, b'aaaa')
+    view = fd_mgr.read(filename, 0, 4)
+    assert isinstance(view, memoryview) and view == b'aaaa'
+    # 文件变大之后，要重新映射
+    fd_mgr.write(filename, 4, b'bbbb')
+    assert fd_mgr.read(filename, 4, 4) == b'bbbb'
+    del view
+    fd_mgr.close_all()
+
+
+@pytest.mark.parametrize('use_mmap', [False, True])
+def test_read_past_eof(tmp_path, use_mmap):
+    fd_mgr = FileDescriptorManager(use_mmap=use_mmap)
+    filename = str(tmp_path / 'eof.tbl')
+    fd_mgr.write(filename, 0, b'aaaa')
+    # 无论是 pread 还是 mmap, 读不完整都要报错
+    for offset, size in ((0, 8), (2, 4), (4, 4), (100, 4)):
+        with pytest.raises(FileReadError):
+            fd_mgr.read(filename, offset, size)
+    assert fd_mgr.read(filename, 0, 4) == b'aaaa'
+    fd_mgr.close_all()
+
+
+def test_writev(tmp_path):
+    fd_mgr = FileDescriptorManager()
+    filename = str(tmp_path / 'writev.tbl')
+    fd_mgr.writev(filename, 2, [b'aa', bytearray(b'bb'), b'cc'])
+    assert fd_mgr.read(filename, 0, 8) == b'\x00\x00aabbcc'
+    fd_mgr.close_all()
+
+
+def test_io_outside_mutex(tmp_path, monkeypatch):
+    fd_mgr = FileDescriptorManager(max_open_files=1)
+    slow_file = str(tmp_path / 'slow.tbl')
+    fast_file = str(tmp_path / 'fast.tbl')
+    fd_mgr.write(slow_file, 0, b'aaaa')
+    fd_mgr.write(fast_file, 0, b'bbbb')
+
+    started = threading.Event()
+    finish = threading.Event()
+    fsync = os.fsync
+
+    def slow_fsync(fileno):
+        started.set()
+        assert finish.wait(5)
+        fsync(fileno)
+
+    monkeypatch.setattr(fd.os, 'fsync', slow_fsync)
+    t = threading.Thread(target=fd_mgr.fsync, args=(slow_file,))
+    t.start()
+    assert started.wait(5)
+    try:
+        # fsync 期间，其他文件的读写不需要等待; 正在使用的 fd 不会因为超过上限被关闭
+        assert fd_mgr.read(fast_file, 0, 4) == b'bbbb'
+        assert slow_file in fd_mgr.fds
+    finally:
+        finish.set()
+        t.join()
+    # fsync 结束之后，再打开其他文件时，超过上限的 fd 就可以被关闭了
+    fd_mgr.write(str(tmp_path / 'other.tbl'), 0, b'cccc')
+    assert len(fd_mgr) == 1
+    fd_mgr.close_all()
+    assert not fd_mgr.pins and not fd_mgr.closing
@@ -0,0 +1,61 @@
+from imoocdb.catalog import CatalogTableForm
+from imoocdb.catalog.entry import catalog_table
+from imoocdb.storage.common import table_tuple_get_pages
+from imoocdb.storage.entry import (table_tuple_insert_one, table_tuple_delete_one,
+                                   table_tuple_get_all, table_tuple_reorganize)
+from imoocdb.storage.fsm import FreeSpaceMap, FSM_CATEGORY_STEP, free_space_map_mgr
+from imoocdb.storage.transaction.entry import transaction_mgr
+
+
+def test_free_space_map():
+    fsm = FreeSpaceMap()
+    assert fsm.search(1) == -1
+
+    fsm.update(0, 10)
+    fsm.update(1, 100)
+    fsm.update(2, 1000)
+    # 精度是 FSM_CATEGORY_STEP, 记录下来的空间只会比真实的少
+    assert fsm.search(1000 // FSM_CATEGORY_STEP * FSM_CATEGORY_STEP) == 2
+    assert fsm.search(1000) == -1
+    assert fsm.search(FSM_CATEGORY_STEP) in (1, 2)
+
+    fsm.update(2, 0)
+    assert fsm.search(200) == -1
+    assert fsm.search(50) == 1
+    assert fsm.get(1) == 96
+
+    fsm2 = FreeSpaceMap.deserialize(fsm.serialize())
+    assert fsm2.categories == fsm.categories
+    assert fsm2.search(50) == 1
+
+
+def test_insert_reuse_free_space():
+    catalog_table.insert(CatalogTableForm('t_fsm', ['id', 'name'], [int, str]))
+    xid = transaction_mgr.start_transaction()
+    locations = []
+    while table_tuple_get_pages('t_fsm') < 2:
+        locations.append(table_tuple_insert_one('t_fsm', (len(locations), 'x' * 100)))
+    assert locations[-1][0] == 1
+
+    # 删除第一个数据页中的数据. 被删除的 record 要保留到 VACUUM 为止
+    # (回滚时还要用到), 之后再插入的时候，这部分空间应该被重新利用，
+    # 而不是一直往后面追加新的数据页
+    deleted = 0
+    for location in locations:
+        if location[0] == 0:
+            table_tuple_delete_one('t_fsm', location)
+            deleted += 1
+    assert free_space_map_mgr.get('t_fsm').get(0) < 100
+    transaction_mgr.commit_transaction(xid)
+    table_tuple_reorganize('t_fsm')
+    assert free_space_map_mgr.get('t_fsm').get(0) > 100 * deleted
+
+    xid = transaction_mgr.start_transaction()
+    reused_pagenos = set()
+    for i in range(deleted):
+        pageno, _ = table_tuple_insert_one('t_fsm', (i, 'y' * 100))
+        reused_pagenos.add(pageno)
+    assert 0 in reused_pagenos
+    assert table_tuple_get_pages('t_fsm') == 2
+    assert len(list(table_tuple_get_all('t_fsm'))) == len(locations)
+    transaction_mgr.commit_transaction(xid)
@@ -0,0 +1,72 @@
+import os
+
+from imoocdb.constant import TEMP_DIRECTORY
+from imoocdb.main import exec_imoocdb_query
+from imoocdb.storage import index_build
+from imoocdb.storage.bplus_tree import BPlusTree, BPlusTreeTuple, NODE_CAPACITY
+from imoocdb.storage.common import index_open
+from imoocdb.storage.entry import index_tuple_get_range_locations, index_tuple_get_equal_value_locations, \
+    table_tuple_scan
+from imoocdb.storage.index_build import sort_index_entries, index_entry_size
+
+
+def test_external_sort():
+    entries = [(BPlusTreeTuple(((i * 37) % 100 if i % 10 else None,)), (i // 10, i % 10))
+               for i in range(1000)]
+    # work_mem 很小，会产生很多个 run, 最后进行多路归并
+    results = list(sort_index_entries(iter(entries), work_mem=1024))
+    # 稳定排序：相同 key 的元组仍然按照表的顺序排列
+    assert results == sorted(entries, key=lambda e: e[0].sort_key)
+    assert not [f for f in os.listdir(TEMP_DIRECTORY) if f.startswith('index_build_')]
+
+    # 不序列化，按照 key 的长度估算内存
+    short = (BPlusTreeTuple(('a',)), (0, 0))
+    long = (BPlusTreeTuple(('a' * 1000,)), (0, 0))
+    assert index_entry_size(long) - index_entry_size(short) == 999
+
+
+def test_bulk_load():
+    items = [(BPlusTreeTuple((i // 3,)), (i, 0)) for i in range(5000)]
+    tree = BPlusTree()
+    tree.bulk_load(items, fillfactor=80)
+    assert not tree.root.is_leaf
+    leaves = [tree.load_node(child) for child in tree.root.children]
+    for leaf in leaves[:-1]:
+        assert NODE_CAPACITY * 70 // 100 < leaf.size <= NODE_CAPACITY * 80 // 100
+    assert tree.find_range() == [value for _, value in items]
+    assert tree.find(BPlusTreeTuple((100,))) == [(300, 0), (301, 0), (302, 0)]
+
+    # 构建出来的B+树，可以继续插入、删除
+    for i in range(5000):
+        tree.insert(BPlusTreeTuple((i % 100,)), (i, 1))
+    tree.delete(BPlusTreeTuple((50,)))
+    assert len(tree.find(BPlusTreeTuple((49,)))) == 3 + 50
+    assert tree.find(BPlusTreeTuple((50,))) == []
+    assert len(tree.find_range()) == 10000 - 53
+
+    tree = BPlusTree()
+    tree.bulk_load([])
+    assert tree.root.is_leaf and tree.find_range() == []
+
+
+def test_create_index_parallel(monkeypatch):
+    exec_imoocdb_query('create table t_index_build (id int, name text)')
+    values = ', '.join(f"({i % 50}, 'name{i}')" for i in range(3000))
+    exec_imoocdb_query(f'insert into t_index_build values {values}')
+
+    monkeypatch.setattr(index_build, 'INDEX_BUILD_WORKERS', 2)
+    monkeypatch.setattr(index_build, 'INDEX_BUILD_PARALLEL_MIN_PAGES', 1)
+    monkeypatch.setattr(index_build, 'MAINTENANCE_WORK_MEM', 16 * 1024)
+    exec_imoocdb_query('create index idx_index_build on t_index_build (id)')
+
+    rows = list(table_tuple_scan('t_index_build'))
+    expected = [location for location, tup in sorted(rows, key=lambda r: r[1][0])]
+    assert list(index_tuple_get_range_locations('idx_index_build')) == expected
+    assert list(index_tuple_get_equal_value_locations('idx_index_build', (7,))) == \
+           [location for location, tup in rows if tup[0] == 7]
+    relation = index_open('idx_index_build')
+    assert relation.disk_pages == relation.pages > 1
+
+    # 之后的插入仍然走逐个插入的逻辑
+    exec_imoocdb_query("insert into t_index_build values (7, 'new')")
+    assert len(list(index_tuple_get_equal_value_locations('idx_index_build', (7,)))) == 61
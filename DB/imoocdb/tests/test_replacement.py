@@ -0,0 +1,118 @@
+import random
+
+import pytest
+
+from imoocdb.errors import LRUError
+from imoocdb.storage.lru import BufferPool, REPLACEMENT_POLICIES
+from imoocdb.storage.replacement import ClockCache, TwoQueueCache, LRUKCache
+from imoocdb.storage.slotted_page import PAGE_SIZE
+
+
+@pytest.mark.parametrize('policy', sorted(REPLACEMENT_POLICIES))
+def test_replacement_policy(policy):
+    evicted = []
+    cache = REPLACEMENT_POLICIES[policy](3, on_evict=lambda k, v: evicted.append(k))
+    for i in range(3):
+        cache.put(i, i)
+    assert cache.get(0) == 0
+    assert cache.get(4) is None
+    cache.put(3, 3)
+    assert len(cache) == 3 and len(evicted) == 1
+    assert evicted[0] not in cache.cache
+    assert cache.stats() == {'hits': 1, 'misses': 1, 'evictions': 1}
+
+    # 回调失败时，不淘汰任何数据页
+    def fail(k, v):
+        raise IOError('write back failed')
+    cache.on_evict = fail
+    with pytest.raises(IOError):
+        cache.put(5, 5)
+    assert 5 not in cache.cache and len(cache) == 3
+
+    # 全部被 pin 住时，没有办法再放入新的数据页
+    for key in list(cache.cache):
+        cache.pin(key)
+    with pytest.raises(LRUError):
+        cache.put(6, 6)
+    assert cache.tail_keys(3) == []
+
+
+def test_clock_sweep():
+    cache = ClockCache(3)
+    for i in range(3):
+        cache.put(i, i)
+    # 命中只增加 usage_count, 不移动节点
+    cache.get(0)
+    cache.get(0)
+    cache.put(3, 3)
+    assert 0 in cache.cache
+    assert len(cache.evicted) == 1
+    assert cache.tail_keys(1) != [0]
+
+
+def test_2q_scan_resistant():
+    cache = TwoQueueCache(8)
+    # 0, 1 被访问了两次，进入 am
+    for key in (0, 1):
+        cache.put(key, key)
+    for key in range(100, 108):
+        cache.put(key, key)
+    for key in (0, 1):
+        assert cache.get(key) is None
+        cache.put(key, key)
+    assert set(cache.am) == {0, 1}
+    # 一次顺序扫描不会冲刷 am 中的数据页
+    for key in range(200, 300):
+        if cache.get(key) is None:
+            cache.put(key, key)
+    assert cache.get(0) == 0 and cache.get(1) == 1
+
+
+def test_lru_k_scan_resistant():
+    cache = LRUKCache(4)
+    for key in (0, 1):
+        cache.put(key, key)
+        cache.get(key)
+    for key in range(100, 200):
+        if cache.get(key) is None:
+            cache.put(key, key)
+    assert cache.get(0) == 0 and cache.get(1) == 1
+
+
+def test_lru_k_eviction_order():
+    evicted = []
+    cache = LRUKCache(16, on_evict=lambda k, v: evicted.append(k))
+    rng = random.Random(0)
+    pinned = []
+    for _ in range(5000):
+        key = rng.randrange(64)
+        if cache.get(key) is not None:
+            continue
+        if len(cache) >= cache.capacity:
+            # 与逐个比较所有节点的结果一致
+            nodes = [node for node in cache.cache.values() if not node.pinned]
+            expected = min(nodes, key=cache._backward_distance).key
+            cache.put(key, key)
+            assert evicted[-1] == expected
+        else:
+            cache.put(key, key)
+        # 同时最多 pin 住 4 个节点
+        if rng.random() < 0.1 and key not in pinned:
+            cache.pin(key)
+            pinned.append(key)
+            if len(pinned) > 4:
+                cache.unpin(pinned.pop(0))
+    # 过期的条目不会无限增长
+    assert len(cache.heap) <= 2 * len(cache) + cache.capacity
+
+
+def test_buffer_pool_policy():
+    for policy in REPLACEMENT_POLICIES:
+        pool = BufferPool(4 * PAGE_SIZE, partitions=1, policy=policy)
+        for i in range(10):
+            pool[('t', i)] = i
+        assert len(pool) == 4
+        assert pool[('t', 9)] == 9
+        assert pool.stats() == {'hits': 1, 'misses': 0, 'evictions': 6}
+    with pytest.raises(LRUError):
+        BufferPool(policy='fifo')
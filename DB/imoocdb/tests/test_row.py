@@ -0,0 +1,36 @@
+import pytest
+
+from imoocdb.errors import TupleCodecError
+from imoocdb.storage.row import RowCodec
+
+
+def test_row_codec():
+    codec = RowCodec([int, str, str, int])
+    for tup in [(1, 'xiaoming', 'BJ', -5),
+                (2, None, '北京', None),
+                (None, '', None, 2 ** 62)]:
+        buff = codec.encode(tup)
+        assert codec.decode(buff) == tup
+        for i, value in enumerate(tup):
+            assert codec.decode_column(buff, i) == value
+    assert codec.decode(b'') == ()
+    # 定长区 + 变长区的长度
+    assert len(codec.encode((1, 'ming', 'BJ', 2))) == 1 + 8 + 4 + 4 + 8 + 6
+
+
+def test_row_codec_error():
+    codec = RowCodec([int, str])
+    # 写入 text 列的值会被转换成字符串
+    assert codec.decode(codec.encode((1, 2))) == (1, '2')
+    with pytest.raises(TupleCodecError):
+        codec.encode((1,))
+    with pytest.raises(TupleCodecError):
+        codec.encode(('abc', 'a'))
+    with pytest.raises(TupleCodecError):
+        codec.encode((2 ** 64, 'a'))
+    # int 列只接受没有损失的转换
+    assert codec.decode(codec.encode((True, 'a'))) == (1, 'a')
+    assert codec.decode(codec.encode((3.0, 'a'))) == (3, 'a')
+    for value in (3.7, '12', b'1', float('nan')):
+        with pytest.raises(TupleCodecError):
+            codec.encode((value, 'a'))
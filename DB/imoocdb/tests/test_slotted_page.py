@@ -1,4 +1,7 @@
-from imoocdb.storage.slotted_page import PageHeader, Page
+import pytest
+
+from imoocdb.errors import PageError
+from imoocdb.storage.slotted_page import PageHeader, Page, Slot, SlotV1, PAGE_SIZE, PAGE_VERSION
 
 
 def test_page_header():
@@ -56,4 +59,112 @@ def test_slotted_page():
     assert buff == page2.serialize()
 
 
+def test_compact_page():
+    page = Page()
+    sid1 = page.insert(b'a' * 100)
+    sid2 = page.insert(b'b' * 100)
+    sid3 = page.insert(b'c' * 100)
+    page.delete(sid2)
+    page.update(sid3, b'c')
+    page.set_header(1)
+    assert page.reclaimable_space == 199
+
+    available_space = page.available_space
+    page.compact()
+    page.set_header(2)
+    # 只去掉原地更新留下的空洞，被标记清除的 record 保留到 VACUUM 为止
+    assert page.reclaimable_space == 100
+    assert page.total_record_size == 201
+    assert page.available_space == available_space
+    # slot 的下标不变
+    assert page.select(sid1) == b'a' * 100
+    assert page.select(sid2) == b''
+    assert page.select(sid3) == b'c'
+    assert list(page.iter_dead_records()) == [(sid2, b'b' * 100)]
+    # 回滚时可以在原来的 slot 上原地恢复
+    assert page.update(sid2, b'b' * 100) == sid2
+
+    page2 = Page.deserialize(page.serialize())
+    assert page2.select(sid3) == b'c'
+
+
+def test_insert_compact_page():
+    page = Page()
+    sids = []
+    while True:
+        try:
+            sids.append(page.insert(b'x' * 100))
+        except Exception:
+            break
+    for sid in sids[:10]:
+        page.update(sid, b'x')
+    for sid in sids[10:20]:
+        page.delete(sid)
+    # 连续的空闲空间不够了，插入的时候会自动整理原地更新留下的空洞
+    sid = page.insert(b'y' * 500)
+    page.set_header(1)
+    assert page.select(sid) == b'y' * 500
+    assert page.select(sids[0]) == b'x'
+    assert page.select(sids[-1]) == b'x' * 100
+    # 被删除的 record 还在，没有被整理掉
+    assert [s for s, _ in page.iter_dead_records()] == sids[10:20]
+    with pytest.raises(PageError):
+        page.insert(b'z' * 700)
+
+
+
+def test_page_v1_compatibility():
+    page = Page()
+    page.page_header.flags = 1
+    page.insert(b'hello')
+    sid = page.insert(b'world')
+    page.delete(sid)
+    page.set_header(1)
+    assert Slot.size() == 12
+
+    # 手动构造一个版本 1 格式的数据页: 每个 slot 的字段都是 8 字节，flags 中没有版本号
+    header = PageHeader()
+    header.lsn = 1
+    header.flags = 1
+    header.version = 0
+    header.free_space_start = header.size() + SlotV1.size() * 2
+    header.free_space_end = PAGE_SIZE - len(page.records)
+    buff = bytearray(PAGE_SIZE)
+    buff[:header.size()] = header.serialize()
+    for i, slot in enumerate(page.slot_directory):
+        v1_slot = SlotV1()
+        v1_slot.offset, v1_slot.length, v1_slot.state = slot.offset, slot.length, slot.state
+        offset = header.size() + i * SlotV1.size()
+        buff[offset: offset + SlotV1.size()] = v1_slot.serialize()
+    buff[header.free_space_end:] = page.records
+
+    page2 = Page.deserialize(bytes(buff))
+    assert page2.page_header.version == PAGE_VERSION
+    assert page2.page_header.flags == 1
+    assert page2.select(0) == b'hello'
+    assert page2.select(sid) == b''
+    # 读出来之后，按照新格式保存
+    assert page2.serialize() == page.serialize()
+
+
+
+def test_select_view():
+    page = Page()
+    sid1 = page.insert(b'hello')
+    sid2 = page.insert(b'world')
+    page.delete(sid2)
+    with page.select_view(sid1) as view:
+        assert isinstance(view, memoryview) and view == b'hello'
+    assert page.select_view(sid2) == b''
+
+    views = []
+    for sid, view in page.iter_record_views():
+        views.append((sid, bytes(view)))
+    assert views == list(page.iter_records()) == [(sid1, b'hello')]
+    # memoryview 都已经释放了，数据页可以继续修改
+    page.insert(b'foo')
+    page.set_header(1)
+    assert page.select(2) == b'foo'
+
+
 test_slotted_page()
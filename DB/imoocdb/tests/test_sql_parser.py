@@ -33,3 +33,9 @@ def test_parse_ddl_statement():
     ast = query_parse('CREATE TABLE t1 (id int, name text, gender int)')
     assert str(ast) == "<CreateTable> table=<Identifier> parts=t1 columns=[['id', 'int'], ['name', 'text'], ['gender', 'int']]"
 
+
+def test_parse_command_statement():
+    ast = query_parse('VACUUM t1')
+    assert str(ast) == '<Command> command=VACUUM args=[<Identifier> parts=t1]'
+    ast = query_parse('vacuum')
+    assert str(ast) == '<Command> command=VACUUM args=None'
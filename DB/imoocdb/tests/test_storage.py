@@ -1,9 +1,31 @@
+import os
+
+import pytest
+
+from imoocdb.storage.common import table_open, table_tuple_get_pages, table_tuple_get_page, index_open, \
+    sync_table_pages, get_table_filename
 from imoocdb.storage.entry import (table_tuple_get_all,
+                                   table_tuple_scan,
+                                   table_tuple_get_one,
                                    index_tuple_get_range,
                                    index_tuple_get_equal_value,
                                    covered_index_tuple_get_range,
                                    covered_index_tuple_get_equal_value,
+                                   table_tuple_allocate_page,
+                                   table_tuple_insert_many,
+                                   index_tuple_get_equal_value_locations,
+                                   index_tuple_get_range_locations,
                                    )
+from imoocdb.catalog import CatalogTableForm
+from imoocdb.catalog.entry import catalog_table, catalog_index
+from imoocdb.main import exec_imoocdb_query
+from imoocdb.storage import bplus_tree
+from imoocdb.storage.transaction import entry as transaction_entry
+from imoocdb.storage.lru import buffer_pool
+from imoocdb.storage.relation import relation_cache
+from imoocdb.storage.slotted_page import PAGE_SIZE
+from imoocdb.storage.transaction.entry import checkpoint, transaction_mgr
+from imoocdb.storage.transaction.redo import RedoAction
 
 
 def test_table_tuple():
@@ -19,6 +41,84 @@ def test_table_tuple():
 
     assert expected_results == real_results
 
+
+def test_table_tuple_scan():
+    locations = []
+    tuples = []
+    for location, tup in table_tuple_scan('t2'):
+        locations.append(location)
+        tuples.append(tup)
+    assert tuples == [(1, 'ming', 'BJ'), (5, 'hong', 'SH'), (3, 'li', 'SZ')]
+    for location, tup in zip(locations, tuples):
+        assert table_tuple_get_one('t2', location) == tup
+
+
+def test_table_tuple_insert_many():
+    catalog_table.insert(CatalogTableForm('t_many', ['id', 'name'], [int, str]))
+    tuples = [(i, 'name' * 10) for i in range(500)]
+    redo_mgr = transaction_mgr.redo_mgr
+    redo_mgr.flush()
+    start_lsn = os.path.getsize(redo_mgr.log_filename)
+    xid = transaction_mgr.start_transaction()
+    locations = table_tuple_insert_many('t_many', tuples)
+    transaction_mgr.commit_transaction(xid)
+
+    assert list(table_tuple_scan('t_many')) == list(zip(locations, tuples))
+    pagenos = sorted(set(pageno for pageno, _ in locations))
+    assert len(pagenos) > 1 and pagenos == list(range(table_tuple_get_pages('t_many')))
+    # 每个数据页只有一条 redo log
+    records = [r for r in redo_mgr.replay(redo_mgr.log_filename, start_lsn)
+               if r.relation == 't_many']
+    assert [r.action for r in records] == [RedoAction.TABLE_INSERT_MANY] * len(pagenos)
+
+
+def test_relation_descriptor():
+    relation = table_open('t_relation')
+    assert relation.disk_pages == 0 and table_tuple_get_pages('t_relation') == 0
+    for _ in range(3):
+        pageno = table_tuple_allocate_page('t_relation')
+        table_tuple_get_page('t_relation', pageno).set_header(0)
+    assert table_tuple_get_pages('t_relation') == 3
+    assert relation.resident_pages == {0, 1, 2}
+
+    checkpoint()
+    assert relation.disk_pages == 3 and relation.synced_pages == 3
+    assert os.stat(relation.filename).st_size == 3 * PAGE_SIZE
+    # 再次落盘同一个数据页，是覆盖写，文件不会变大. 只统计真正写出的数据页
+    table_tuple_get_page('t_relation', 1).set_header(1)
+    buffer_pool.mark_dirty(('t_relation', 1))
+    checkpoint()
+    assert os.stat(relation.filename).st_size == 3 * PAGE_SIZE
+    assert relation.disk_pages == 3 and relation.synced_pages == 4
+
+
+def test_checkpoint_record_after_pages(monkeypatch):
+    redo_mgr = transaction_mgr.redo_mgr
+    exec_imoocdb_query('create table t_checkpoint (id int, name text)')
+    exec_imoocdb_query("insert into t_checkpoint values (1, 'a')")
+    redo_lsn = transaction_mgr.get_current_lsn()
+
+    def checkpoints():
+        return [r.data for r in redo_mgr.replay(redo_mgr.log_filename)
+                if r.action == RedoAction.CHECKPOINT]
+
+    # 刷脏页的过程中崩溃了，不能留下 checkpoint 记录
+    count = len(checkpoints())
+
+    def crash(*args):
+        raise RuntimeError('crash')
+
+    monkeypatch.setattr(transaction_entry, 'sync_table_pages', crash)
+    with pytest.raises(RuntimeError):
+        checkpoint()
+    assert len(checkpoints()) == count
+    monkeypatch.undo()
+
+    # checkpoint 记录中保存的是开始刷脏页之前的 LSN, 恢复时从那里开始重放
+    checkpoint()
+    assert checkpoints()[-1] == redo_lsn
+    assert redo_mgr.flush_lsn == redo_mgr.write_lsn
+
 #
 # def test_index_tuple():
 #     # Python 的生成器 generator
@@ -31,6 +131,75 @@ def test_table_tuple():
 #     assert (list(results)) == [(1, 'xiaoming')]
 
 
+def test_index_pages_in_buffer_pool(monkeypatch):
+    exec_imoocdb_query('create table t_index_pages (id int, name text)')
+    exec_imoocdb_query('create index idx_pages on t_index_pages (id)')
+    values = ', '.join(f"({i}, 'name{i}')" for i in range(500))
+    exec_imoocdb_query(f'insert into t_index_pages values {values}')
+    relation = index_open('idx_pages')
+    assert relation.pages > 1 and relation.resident_pages
+    # 修改之后的索引页已经写回了磁盘，不再是脏页
+    assert not any(buffer_pool.is_dirty(('idx_pages', pageno)) for pageno in range(relation.pages))
+    assert os.stat(relation.filename).st_size == relation.header_size + relation.pages * PAGE_SIZE
+    locations = list(index_tuple_get_equal_value_locations('idx_pages', (42,)))
+    assert len(locations) == 1
+
+    # 重复的查询直接从 buffer pool 中读取索引页，不需要再读文件
+    def read(*args):
+        raise AssertionError('should not read the index file')
+    with monkeypatch.context() as m:
+        m.setattr(bplus_tree.fd_mgr, 'read', read)
+        assert list(index_tuple_get_equal_value_locations('idx_pages', (42,))) == locations
+
+    # 被淘汰之后，重新从磁盘上 (跳过文件头) 加载
+    for pageno in range(relation.pages):
+        buffer_pool.discard(('idx_pages', pageno))
+    assert not relation.resident_pages
+    assert list(index_tuple_get_equal_value_locations('idx_pages', (42,))) == locations
+
+    # 索引不能与已有的表或者索引重名
+    exec_imoocdb_query('create index idx_pages on t_index_pages (name)')
+    exec_imoocdb_query('create index t1 on t_index_pages (name)')
+    assert len(catalog_index.select(lambda r: r.table_name == 't_index_pages')) == 1
+
+
+def test_sync_index_pages(tmp_path):
+    # 索引文件有文件头，数据页要写在文件头之后. 按照传入的 relation 写，
+    # 不会把索引名当作表名重新打开
+    relation = relation_cache.open('idx_sync_pages', str(tmp_path / 'idx_sync_pages.idx'),
+                                   header_size=bplus_tree.HEADER_SIZE, kind='index')
+    images = [(1, b'b' * PAGE_SIZE), (0, b'a' * PAGE_SIZE)]
+    assert sync_table_pages(relation, images) == 2
+    with open(relation.filename, 'rb') as f:
+        f.seek(relation.header_size)
+        assert f.read() == b'a' * PAGE_SIZE + b'b' * PAGE_SIZE
+    assert relation.disk_pages == 2 and relation.synced_pages == 2
+    assert not os.path.exists(get_table_filename('idx_sync_pages'))
+
+
+def test_index_free_pages():
+    exec_imoocdb_query('create table t_index_free (name text, id int)')
+    exec_imoocdb_query('create index idx_free on t_index_free (name)')
+    values = ', '.join(f"('{i:04d}{'x' * 300}', {i})" for i in range(600))
+    exec_imoocdb_query(f'insert into t_index_free values {values}')
+    relation = index_open('idx_free')
+    pages = relation.pages
+
+    # 删除之后，合并掉的索引页放入空闲页链表，文件头中也记录了链表
+    exec_imoocdb_query('delete from t_index_free where t_index_free.id > 49')
+    assert relation.free_pageno != bplus_tree.FREE_LIST_END
+    with open(relation.filename, 'rb') as f:
+        assert bplus_tree.unpack_header(f.read(bplus_tree.HEADER_SIZE)) == \
+               (relation.root_pageno, relation.free_pageno)
+    assert len(list(index_tuple_get_range_locations('idx_free'))) == 50
+
+    # 再次插入时复用空闲页，索引文件没有变大
+    values = ', '.join(f"('{i:04d}{'x' * 300}', {i})" for i in range(50, 600))
+    exec_imoocdb_query(f'insert into t_index_free values {values}')
+    assert relation.pages == pages
+    assert len(list(index_tuple_get_range_locations('idx_free'))) == 600
+
+
 def test_covered_index_tuple():
     results = covered_index_tuple_get_range('idx', (2,), (4,))
     assert (list(results)) == [(3,)]
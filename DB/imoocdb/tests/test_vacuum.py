@@ -0,0 +1,170 @@
+import pytest
+
+from imoocdb.errors import RollbackError, LockConflictError
+from imoocdb.executor.operator.physical_operator import CommandOperator
+from imoocdb.main import exec_imoocdb_query
+from imoocdb.storage import entry
+from imoocdb.storage.lock import lock
+from imoocdb.storage.lock.lock import lock_manager
+from imoocdb.storage.transaction.entry import transaction_mgr, index_tuple_reorganize
+from imoocdb.storage.transaction.redo import RedoAction
+from imoocdb.storage.common import table_tuple_get_pages, table_tuple_get_page
+from imoocdb.storage.entry import (table_tuple_get_all, table_tuple_scan, table_tuple_update_one,
+                                   table_tuple_reorganize, index_tuple_get_equal_value,
+                                   index_tuple_get_range_locations)
+
+
+def test_vacuum():
+    exec_imoocdb_query('create table t_vacuum (id int, name text)')
+    exec_imoocdb_query('create index idx_vacuum on t_vacuum (id)')
+    values = ', '.join(f"({i}, 'name{i}')" for i in range(200))
+    exec_imoocdb_query(f'insert into t_vacuum values {values}')
+    exec_imoocdb_query('delete from t_vacuum where t_vacuum.id < 150')
+    # 原地更新为更短的元组，会在 record 区域中留下空洞
+    xid = transaction_mgr.start_transaction()
+    for location, tup in list(table_tuple_scan('t_vacuum')):
+        if tup[0] > 190:
+            table_tuple_update_one('t_vacuum', location, (tup[0], 'a'))
+    transaction_mgr.commit_transaction(xid)
+
+    expected = list(table_tuple_get_all('t_vacuum'))
+    assert len(expected) == 50
+    exec_imoocdb_query('vacuum t_vacuum')
+
+    assert list(table_tuple_get_all('t_vacuum')) == expected
+    for pageno in range(table_tuple_get_pages('t_vacuum')):
+        page = table_tuple_get_page('t_vacuum', pageno)
+        assert page.dead_slot_count == 0
+        assert page.reclaimable_space == 0
+
+    # 索引中的 location 要跟着元组一起移动
+    locations = {tup[0]: location for location, tup in table_tuple_scan('t_vacuum')}
+    assert sorted(index_tuple_get_range_locations('idx_vacuum')) == sorted(locations.values())
+    for i in (150, 175, 199):
+        assert list(index_tuple_get_equal_value('idx_vacuum', (i,))) == \
+               list(table_tuple_get_all('t_vacuum'))[i - 150: i - 149]
+
+
+def test_rollback_relocated_update():
+    exec_imoocdb_query('create table t_relocate (id int, name text)')
+    exec_imoocdb_query("insert into t_relocate values (1, 'a'), (2, 'b')")
+    expected = list(table_tuple_scan('t_relocate'))
+
+    xid = transaction_mgr.start_transaction()
+    # 更长的元组放不下，被搬移到了同一个数据页中的新 slot 上
+    new_sid = table_tuple_update_one('t_relocate', (0, 0), (1, 'x' * 100))
+    assert new_sid != 0
+    # 插入时的整理不会丢掉被标记清除的 record
+    page = table_tuple_get_page('t_relocate', 0)
+    page.compact()
+    page.set_header(page.page_header.lsn)
+    transaction_mgr.abort_transaction(xid)
+
+    # 回滚之后，旧的元组在原来的 slot 上，新的 slot 被标记清除
+    assert list(table_tuple_scan('t_relocate')) == expected
+    assert [sid for sid, _ in page.iter_dead_records()] == [new_sid]
+
+
+def test_vacuum_index_redo(monkeypatch):
+    exec_imoocdb_query('create table t_vacuum_redo (id int, name text)')
+    exec_imoocdb_query('create index idx_vacuum_redo on t_vacuum_redo (id)')
+    values = ', '.join(f"({i}, 'name{i}')" for i in range(100))
+    exec_imoocdb_query(f'insert into t_vacuum_redo values {values}')
+    exec_imoocdb_query('delete from t_vacuum_redo where t_vacuum_redo.id < 50')
+
+    # 模拟数据页整理完之后、修正索引之前发生了崩溃
+    def crash(*args):
+        raise RuntimeError('crash')
+
+    monkeypatch.setattr(entry, 'index_tuple_reorganize', crash)
+    with pytest.raises(RuntimeError):
+        table_tuple_reorganize('t_vacuum_redo')
+    monkeypatch.undo()
+
+    # 对索引的修正已经记录到了 redo log 中，并且没有结束标记
+    records = [r for r in transaction_mgr.redo_mgr.replay()
+               if r.relation in ('idx_vacuum_redo', 't_vacuum_redo') and
+               r.action in (RedoAction.INDEX_REORGANIZE, RedoAction.TABLE_REORGANIZE_END)]
+    assert [r.action for r in records] == [RedoAction.INDEX_REORGANIZE]
+    deletes, inserts = records[0].data
+    assert deletes and inserts
+
+    # 恢复时可能重复应用，结果要保持不变
+    for _ in range(2):
+        index_tuple_reorganize('idx_vacuum_redo', deletes, inserts)
+        locations = [location for location, _ in table_tuple_scan('t_vacuum_redo')]
+        assert sorted(index_tuple_get_range_locations('idx_vacuum_redo')) == sorted(locations)
+
+
+def _exec_and_rollback(monkeypatch, query):
+    # 提交时失败，exec_imoocdb_query 会回滚整个事务
+    def fail(xid):
+        raise RollbackError('commit failed')
+
+    monkeypatch.setattr(transaction_mgr, 'commit_transaction', fail)
+    exec_imoocdb_query(query)
+    monkeypatch.undo()
+
+
+def _fill_first_page(table_name):
+    exec_imoocdb_query(f'create table {table_name} (id int, name text)')
+    exec_imoocdb_query(f'create index idx_{table_name} on {table_name} (id)')
+    values = ', '.join(f"({i}, 'name{i}')" for i in range(1000))
+    exec_imoocdb_query(f'insert into {table_name} values {values}')
+    assert table_tuple_get_pages(table_name) > 1
+    assert table_tuple_get_page(table_name, 0).available_space < 100
+
+
+def test_rollback_delete_full_page(monkeypatch):
+    _fill_first_page('t_rollback_delete')
+    expected = list(table_tuple_scan('t_rollback_delete'))
+    _exec_and_rollback(monkeypatch, 'delete from t_rollback_delete where t_rollback_delete.id < 20')
+
+    # 被删除的元组在原来的 slot 上恢复，索引中的 location 仍然有效
+    assert list(table_tuple_scan('t_rollback_delete')) == expected
+    assert list(index_tuple_get_equal_value('idx_t_rollback_delete', (2,))) == [(2, 'name2')]
+    assert exec_imoocdb_query('select * from t_rollback_delete '
+                              'where t_rollback_delete.id = 2').rows == [(2, 'name2')]
+
+
+def test_rollback_update_other_page(monkeypatch):
+    _fill_first_page('t_rollback_update')
+    expected = list(table_tuple_scan('t_rollback_update'))
+    pages = table_tuple_get_pages('t_rollback_update')
+    # 更长的元组在第一个数据页中放不下，被搬移到了其他的数据页中
+    _exec_and_rollback(monkeypatch, f"update t_rollback_update set t_rollback_update.name = '{'x' * 200}' "
+                                    f"where t_rollback_update.id < 5")
+    assert table_tuple_get_pages('t_rollback_update') >= pages
+
+    assert list(table_tuple_scan('t_rollback_update')) == expected
+    assert list(index_tuple_get_equal_value('idx_t_rollback_update', (2,))) == [(2, 'name2')]
+    assert exec_imoocdb_query('select * from t_rollback_update '
+                              'where t_rollback_update.id = 2').rows == [(2, 'name2')]
+
+
+def test_vacuum_lock_owner(monkeypatch):
+    exec_imoocdb_query('create table t_vacuum_lock (id int, name text)')
+    exec_imoocdb_query('create index idx_vacuum_lock on t_vacuum_lock (id)')
+    monkeypatch.setattr(lock, 'lock_wait_timeout', 0)
+
+    # 另一个 VACUUM 正持有索引锁：不能被当作同一个持有者重入
+    xids = []
+    acquire_lock = lock_manager.acquire_lock
+
+    def record_xid(resource, xid, mode):
+        xids.append(xid)
+        acquire_lock(resource, xid, mode)
+
+    monkeypatch.setattr(lock_manager, 'acquire_lock', record_xid)
+    CommandOperator.vacuum('t_vacuum_lock')
+    other_xid = xids[0]
+    acquire_lock(('index', 'idx_vacuum_lock'), other_xid, 'x')
+    try:
+        with pytest.raises(LockConflictError):
+            CommandOperator.vacuum('t_vacuum_lock')
+        assert xids[-1] != other_xid
+        # 加锁失败时，只释放自己加上的表锁，别人的索引锁还在
+        assert ('table', 't_vacuum_lock') not in lock_manager.locks
+        assert lock_manager.locks[('index', 'idx_vacuum_lock')]['holders'] == [other_xid]
+    finally:
+        lock_manager.release_lock(('index', 'idx_vacuum_lock'), other_xid)